@@ -0,0 +1,82 @@
+"""
+Batch US-EPA AQI computation.
+
+Takes whole arrays of concentrations (NumPy arrays, lists or array.array)
+and returns AQI values in one vectorized pass instead of a Python loop of
+``calculate_aqi`` calls. Each sub-index is a breakpoint lookup (searchsorted)
+followed by linear interpolation. Values above the last breakpoint continue
+along the last segment, like ``calculate_aqi`` does for PM2.5. ``pm25_aqi``
+returns exactly what ``calculate_aqi`` returns for the same input.
+
+Units: PM2.5 and PM10 in µg/m³, O3 and NO2 in ppb, CO in ppm. NaN marks a
+missing value: its sub-index is -1 and it never wins the dominant pollutant.
+"""
+import numpy as np
+
+# Dominant-pollutant codes, indexes into this tuple
+POLLUTANTS = ("pm25", "pm10", "o3", "no2", "co")
+
+# Upper concentration of each category and the AQI at that concentration. The
+# lower end of a category is the upper end of the previous one (starting at 0),
+# matching the formula in calculate_aqi.
+_BREAKPOINTS = {
+    "pm25": ((12.0, 35.4, 55.4, 150.4, 250.4, 350.4), (50, 100, 150, 200, 300, 400)),
+    "pm10": ((54, 154, 254, 354, 424, 504, 604), (50, 100, 150, 200, 300, 400, 500)),
+    "o3": ((54, 70, 85, 105, 200), (50, 100, 150, 200, 300)),
+    "no2": ((53, 100, 360, 649, 1249, 1649, 2049), (50, 100, 150, 200, 300, 400, 500)),
+    "co": ((4.4, 9.4, 12.4, 15.4, 30.4, 40.4, 50.4), (50, 100, 150, 200, 300, 400, 500)),
+}
+
+
+def _tables(conc_hi, index_hi):
+    c_hi = np.asarray(conc_hi, dtype=np.float64)
+    i_hi = np.asarray(index_hi, dtype=np.float64)
+    c_lo = np.concatenate(([0.0], c_hi[:-1]))
+    i_lo = np.concatenate(([0.0], i_hi[:-1]))
+    return c_hi, c_lo, i_lo, (i_hi - i_lo) / (c_hi - c_lo)
+
+
+_TABLES = {name: _tables(*bp) for name, bp in _BREAKPOINTS.items()}
+
+
+def sub_index(pollutant: str, values) -> np.ndarray:
+    """AQI sub-index (int64) for one pollutant over an array of concentrations
+    or a single value (then a 0-d array)."""
+    c_hi, c_lo, i_lo, slope = _TABLES[pollutant]
+    x = np.asarray(values, dtype=np.float64)
+    seg = np.minimum(np.searchsorted(c_hi, x, side="left"), len(c_hi) - 1)
+    result = np.where(np.isnan(x), -1.0, i_lo[seg] + slope[seg] * (x - c_lo[seg]))
+    # astype truncates toward zero, like int() in calculate_aqi
+    return result.astype(np.int64)
+
+
+def pm25_aqi(values) -> np.ndarray:
+    return sub_index("pm25", values)
+
+
+def aqi_batch(pm25=None, pm10=None, o3=None, no2=None, co=None):
+    """
+    Overall AQI and dominant pollutant for N points at once.
+
+    Each argument is an array of N concentrations or None (not measured).
+    Returns (aqi, dominant): aqi is the maximum sub-index per point, and
+    dominant is an index into POLLUTANTS naming the pollutant that produced it.
+    Points with no measurement at all get aqi -1.
+    """
+    given = {"pm25": pm25, "pm10": pm10, "o3": o3, "no2": no2, "co": co}
+    aqi = dominant = None
+    for code, name in enumerate(POLLUTANTS):
+        if given[name] is None:
+            continue
+        values = sub_index(name, given[name])
+        if aqi is None:
+            aqi = values
+            dominant = np.full(values.shape, code, dtype=np.uint8)
+            continue
+        # Running max keeps this a few contiguous passes per pollutant
+        higher = values > aqi
+        np.maximum(aqi, values, out=aqi)
+        dominant[higher] = code
+    if aqi is None:
+        raise ValueError("aqi_batch needs at least one pollutant array")
+    return aqi, dominant
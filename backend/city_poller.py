@@ -0,0 +1,236 @@
+"""
+Background refresh of city air quality from AirVisual into the database.
+
+The poller owns all upstream traffic for the configured cities: every
+POLL_CITIES entry is refreshed once per CITY_POLL_INTERVAL_SECONDS. The
+first refreshes are spread evenly over the interval and each later one
+gets +/- CITY_POLL_JITTER, so the calls never line up into bursts against
+the API quota. At most CITY_POLL_CONCURRENCY requests run at once. The
+results of a round go to the database in two writes: a bulk upsert into
+`cities` (latest value per city) and an insert_many into
+`air_quality_history`. Request handlers then only read those collections;
+a city that is not polled (or whose data is too old) gets mock data.
+
+stats() reports how late refreshes start compared with their schedule
+(lag) and how old each city's data is.
+"""
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from pymongo import UpdateOne
+
+import upstream
+
+logger = logging.getLogger(__name__)
+
+CITY_POLL_INTERVAL_SECONDS = float(os.getenv("CITY_POLL_INTERVAL_SECONDS", "3600"))
+# Fraction of the interval added or removed at random from each schedule
+CITY_POLL_JITTER = float(os.getenv("CITY_POLL_JITTER", "0.1"))
+CITY_POLL_CONCURRENCY = int(os.getenv("CITY_POLL_CONCURRENCY", "2"))
+# Retry delay after a failed refresh (upstream error or quota)
+CITY_POLL_RETRY_SECONDS = float(os.getenv("CITY_POLL_RETRY_SECONDS", "300"))
+# "city,state,country" entries separated by ";"
+POLL_CITIES = os.getenv("POLL_CITIES", "Almaty,Almaty,Kazakhstan")
+# Request handlers use a stored city only if it is younger than this
+CITY_DATA_MAX_AGE_SECONDS = float(os.getenv("CITY_DATA_MAX_AGE_SECONDS", str(2 * CITY_POLL_INTERVAL_SECONDS)))
+# A lat/lon request is answered from the nearest stored city within this radius
+CITY_MATCH_RADIUS_KM = float(os.getenv("CITY_MATCH_RADIUS_KM", "50"))
+
+CITY_FIELDS = {"_id": 0, "city": 1, "state": 1, "country": 1, "location": 1, "current": 1, "lat": 1, "lon": 1}
+
+
+def parse_city_list(value: str) -> List[dict]:
+    cities = []
+    for item in value.split(";"):
+        parts = [p.strip() for p in item.split(",")]
+        if len(parts) == 3 and all(parts):
+            cities.append({"city": parts[0], "state": parts[1], "country": parts[2]})
+        elif item.strip():
+            logger.warning("Ignoring POLL_CITIES entry %r (expected city,state,country)", item.strip())
+    return cities
+
+
+def city_key(city: str, state: str, country: str) -> str:
+    """Case-insensitive identity of a city, stored as cities.key."""
+    return "|".join(part.strip().lower() for part in (city, state, country))
+
+
+def _distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dlat, dlon = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dlon / 2) ** 2
+    return 2 * 6371.0 * math.asin(min(1.0, math.sqrt(a)))
+
+
+async def find_local_city(
+    db,
+    city: Optional[str] = None,
+    state: Optional[str] = None,
+    country: Optional[str] = None,
+    lat: Optional[float] = None,
+    lon: Optional[float] = None,
+) -> Optional[dict]:
+    """Latest stored air quality for a city (by name or nearest to lat/lon), or None if missing or too old."""
+    fresh = {"updated_at": {"$gte": datetime.utcnow() - timedelta(seconds=CITY_DATA_MAX_AGE_SECONDS)}}
+    if lat is not None and lon is not None:
+        # Only the polled cities are stored, so scanning them is cheap
+        best, best_km = None, CITY_MATCH_RADIUS_KM
+        async for doc in db.cities.find(fresh, CITY_FIELDS):
+            if doc.get("lat") is None or doc.get("lon") is None:
+                continue
+            km = _distance_km(lat, lon, doc["lat"], doc["lon"])
+            if km <= best_km:
+                best, best_km = doc, km
+        return best
+    if city and state and country:
+        return await db.cities.find_one({"key": city_key(city, state, country), **fresh}, CITY_FIELDS)
+    return None
+
+
+class _CityState:
+    __slots__ = ("city", "due", "last_attempt", "last_success", "last_error", "failures", "last_lag")
+
+    def __init__(self, city: dict, due: float):
+        self.city = city
+        self.due = due
+        self.last_attempt: Optional[float] = None
+        self.last_success: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.failures = 0
+        self.last_lag = 0.0
+
+
+class CityPoller:
+    def __init__(
+        self,
+        db,
+        client: upstream.AirVisualClient,
+        cities: List[dict],
+        interval: float = CITY_POLL_INTERVAL_SECONDS,
+        jitter: float = CITY_POLL_JITTER,
+        concurrency: int = CITY_POLL_CONCURRENCY,
+        retry: float = CITY_POLL_RETRY_SECONDS,
+    ):
+        self.db = db
+        self.client = client
+        self.interval = interval
+        self.jitter = jitter
+        self.retry = retry
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        now = time.monotonic()
+        # Stagger the first round evenly over one interval
+        step = interval / max(1, len(cities))
+        self._states = [_CityState(city, now + i * step) for i, city in enumerate(cities)]
+        self.rounds = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.max_lag = 0.0
+
+    def _next_due(self, base: float) -> float:
+        return base + self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def _refresh(self, state: _CityState):
+        async with self._slots:
+            started = time.monotonic()
+            state.last_lag = max(0.0, started - state.due)
+            self.max_lag = max(self.max_lag, state.last_lag)
+            state.last_attempt = started
+            c = state.city
+            try:
+                data = await self.client.city(c["city"], c["state"], c["country"])
+            except upstream.UpstreamError as e:
+                state.failures += 1
+                state.last_error = str(e)
+                state.due = started + min(self.retry, self.interval)
+                self.failed += 1
+                logger.warning("City refresh failed for %s: %s", c["city"], e)
+                return None
+            state.failures = 0
+            state.last_error = None
+            state.last_success = time.monotonic()
+            state.due = self._next_due(started)
+            self.refreshed += 1
+            return c, data
+
+    async def run_once(self) -> int:
+        """Refresh every city that is due, then store the results in bulk. Returns the number stored."""
+        now = time.monotonic()
+        due = [s for s in self._states if s.due <= now]
+        if not due:
+            return 0
+        self.rounds += 1
+        results = [r for r in await asyncio.gather(*(self._refresh(s) for s in due)) if r]
+        if results:
+            await self._store(results)
+        return len(results)
+
+    async def _store(self, results):
+        fetched_at = datetime.utcnow()
+        ops = []
+        history = []
+        for c, data in results:
+            coords = (data.get("location") or {}).get("coordinates") or [None, None]
+            doc = {
+                "city": c["city"],
+                "state": c["state"],
+                "country": c["country"],
+                "lat": coords[1],
+                "lon": coords[0],
+                "location": data.get("location"),
+                "current": data.get("current"),
+                "updated_at": fetched_at,
+                "source": "airvisual",
+            }
+            ops.append(UpdateOne({"key": city_key(c["city"], c["state"], c["country"])}, {"$set": doc}, upsert=True))
+            history.append({
+                "city": c["city"],
+                "state": c["state"],
+                "country": c["country"],
+                "location": data.get("location"),
+                "current": data.get("current"),
+                "timestamp": fetched_at,
+                "source": "airvisual",
+            })
+        await self.db.cities.bulk_write(ops, ordered=False)
+        await self.db.air_quality_history.insert_many(history, ordered=False)
+
+    async def run(self):
+        logger.info("City poller started for %d cities every %.0fs", len(self._states), self.interval)
+        while True:
+            try:
+                stored = await self.run_once()
+                if stored:
+                    logger.info("Refreshed air quality for %d cities", stored)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("City poller round failed")
+            next_due = min((s.due for s in self._states), default=time.monotonic() + self.interval)
+            await asyncio.sleep(min(max(1.0, next_due - time.monotonic()), self.interval))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        cities = []
+        for s in self._states:
+            cities.append({
+                **s.city,
+                "data_age_seconds": None if s.last_success is None else round(now - s.last_success, 1),
+                "next_refresh_in_seconds": round(max(0.0, s.due - now), 1),
+                "last_lag_seconds": round(s.last_lag, 3),
+                "consecutive_failures": s.failures,
+                "last_error": s.last_error,
+            })
+        return {
+            "interval_seconds": self.interval,
+            "rounds": self.rounds,
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "max_lag_seconds": round(self.max_lag, 3),
+            "cities": cities,
+        }
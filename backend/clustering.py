@@ -0,0 +1,236 @@
+"""
+Server-side clustering of map points.
+
+Points are bucketed into a hierarchical Web Mercator grid: a cell at zoom z
+splits into four cells at zoom z + 1, and each cell is roughly
+CLUSTER_CELL_PX screen pixels wide at its own zoom. Every zoom level keeps
+running aggregates (count, coordinate sums, AQI sum and max) per occupied
+cell, so answering a map request is a walk over the occupied cells of one
+level instead of a pass over every point.
+
+Updates are incremental: upsert() and remove() touch one cell per zoom
+level. Only the AQI maximum can need a recount, when the point holding it
+leaves or drops; the finest cell recounts from its members and coarser
+cells from their (at most four) child cells.
+"""
+import math
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Zoom levels with precomputed cells; above MAX_CLUSTER_ZOOM points are
+# returned one by one.
+MAX_CLUSTER_ZOOM = int(os.getenv("MAX_CLUSTER_ZOOM", "16"))
+# Approximate cluster cell width in screen pixels (256 px map tiles)
+CLUSTER_CELL_PX = int(os.getenv("CLUSTER_CELL_PX", "64"))
+
+# Cells per tile side is 256 / CLUSTER_CELL_PX, rounded to a power of two
+_TILE_SHIFT = max(0, round(math.log2(256 / max(1, CLUSTER_CELL_PX))))
+_MAX_MERCATOR_LAT = 85.05112878
+
+
+def mercator_cell(lon: float, lat: float, zoom: int) -> Tuple[int, int]:
+    """Grid cell of a lon/lat point at the given zoom."""
+    lat = max(-_MAX_MERCATOR_LAT, min(_MAX_MERCATOR_LAT, lat))
+    n = 1 << (zoom + _TILE_SHIFT)
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(n - 1, max(0, int(x * n))), min(n - 1, max(0, int(y * n)))
+
+
+def in_bbox(lon: float, lat: float, bbox) -> bool:
+    """bbox is (min_lon, min_lat, max_lon, max_lat); min_lon > max_lon crosses the antimeridian."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if not min_lat <= lat <= max_lat:
+        return False
+    if min_lon <= max_lon:
+        return min_lon <= lon <= max_lon
+    return lon >= min_lon or lon <= max_lon
+
+
+class _Cell:
+    __slots__ = ("count", "sum_lon", "sum_lat", "aqi_sum", "aqi_max")
+
+    def __init__(self):
+        self.count = 0
+        self.sum_lon = 0.0
+        self.sum_lat = 0.0
+        self.aqi_sum = 0
+        self.aqi_max = None
+
+    def to_dict(self) -> dict:
+        return {
+            "lat": self.sum_lat / self.count,
+            "lng": self.sum_lon / self.count,
+            "count": self.count,
+            "aqi_max": self.aqi_max,
+            "aqi_mean": round(self.aqi_sum / self.count, 1),
+        }
+
+
+class ClusterIndex:
+    """Hierarchical grid of points keyed by id (e.g. str(sensor _id))."""
+
+    def __init__(self, max_zoom: int = MAX_CLUSTER_ZOOM):
+        self.max_zoom = max_zoom
+        # id -> (lon, lat, aqi, finest cell)
+        self._points: Dict[str, Tuple[float, float, int, Tuple[int, int]]] = {}
+        self._levels: List[Dict[Tuple[int, int], _Cell]] = [{} for _ in range(max_zoom + 1)]
+        # Finest cell -> ids inside it, for recounting the AQI maximum
+        self._members: Dict[Tuple[int, int], set] = {}
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, point_id: str) -> bool:
+        return point_id in self._points
+
+    def clear(self):
+        self._points.clear()
+        self._members.clear()
+        for level in self._levels:
+            level.clear()
+
+    def rebuild(self, points: Iterable[Tuple[str, float, float, int]]):
+        """Replace the whole index with (id, lon, lat, aqi) tuples."""
+        self.clear()
+        for point_id, lon, lat, aqi in points:
+            self.upsert(point_id, lon, lat, aqi)
+
+    def upsert(self, point_id: str, lon: float, lat: float, aqi: int):
+        old = self._points.get(point_id)
+        if old is not None:
+            if (old[0], old[1], old[2]) == (lon, lat, aqi):
+                return
+            self.remove(point_id)
+        finest = mercator_cell(lon, lat, self.max_zoom)
+        self._points[point_id] = (lon, lat, aqi, finest)
+        self._members.setdefault(finest, set()).add(point_id)
+        fx, fy = finest
+        for zoom in range(self.max_zoom, -1, -1):
+            shift = self.max_zoom - zoom
+            key = (fx >> shift, fy >> shift)
+            cell = self._levels[zoom].get(key)
+            if cell is None:
+                cell = self._levels[zoom][key] = _Cell()
+            cell.count += 1
+            cell.sum_lon += lon
+            cell.sum_lat += lat
+            cell.aqi_sum += aqi
+            if cell.aqi_max is None or aqi > cell.aqi_max:
+                cell.aqi_max = aqi
+
+    def remove(self, point_id: str):
+        old = self._points.pop(point_id, None)
+        if old is None:
+            return
+        lon, lat, aqi, finest = old
+        members = self._members[finest]
+        members.discard(point_id)
+        if not members:
+            del self._members[finest]
+        fx, fy = finest
+        # Finest level first, so coarser cells recount from up-to-date children
+        for zoom in range(self.max_zoom, -1, -1):
+            shift = self.max_zoom - zoom
+            key = (fx >> shift, fy >> shift)
+            level = self._levels[zoom]
+            cell = level[key]
+            cell.count -= 1
+            if cell.count == 0:
+                del level[key]
+                continue
+            cell.sum_lon -= lon
+            cell.sum_lat -= lat
+            cell.aqi_sum -= aqi
+            if aqi >= cell.aqi_max:
+                cell.aqi_max = self._recount_max(zoom, key)
+
+    def _recount_max(self, zoom: int, key: Tuple[int, int]) -> int:
+        if zoom == self.max_zoom:
+            return max(self._points[pid][2] for pid in self._members[key])
+        children = self._levels[zoom + 1]
+        cx, cy = key
+        return max(
+            child.aqi_max
+            for child in (children.get((2 * cx + dx, 2 * cy + dy)) for dx in (0, 1) for dy in (0, 1))
+            if child is not None
+        )
+
+    def query(self, zoom: int, bbox=None, ids: Optional[Iterable[str]] = None) -> List[dict]:
+        """
+        Clusters visible at ``zoom``. Each is a dict with lat, lng, count,
+        aqi_max and aqi_mean; single points also carry their "id".
+
+        ``bbox`` (min_lon, min_lat, max_lon, max_lat) keeps clusters whose
+        centroid is inside it. ``ids`` restricts the result to those points:
+        the precomputed cells are used when it covers the whole index,
+        otherwise the allowed points are grouped on the fly.
+        """
+        zoom = max(0, int(zoom))
+        if ids is not None:
+            ids = set(ids)
+            if not self._points.keys() <= ids:
+                return self._query_subset(zoom, bbox, ids)
+        if zoom > self.max_zoom:
+            return self._single_points(self._points, bbox)
+
+        clusters = []
+        for key, cell in self._levels[zoom].items():
+            if bbox and not in_bbox(cell.sum_lon / cell.count, cell.sum_lat / cell.count, bbox):
+                continue
+            item = cell.to_dict()
+            if cell.count == 1:
+                item["id"] = self._single_member(zoom, key)
+            clusters.append(item)
+        return clusters
+
+    def _single_member(self, zoom: int, key: Tuple[int, int]) -> str:
+        # Walk down the hierarchy to the finest cell holding the only point
+        while zoom < self.max_zoom:
+            cx, cy = key
+            zoom += 1
+            key = next(
+                k for k in ((2 * cx + dx, 2 * cy + dy) for dx in (0, 1) for dy in (0, 1))
+                if k in self._levels[zoom]
+            )
+        return next(iter(self._members[key]))
+
+    def _single_points(self, point_ids: Iterable[str], bbox) -> List[dict]:
+        out = []
+        for pid in point_ids:
+            lon, lat, aqi, _ = self._points[pid]
+            if bbox and not in_bbox(lon, lat, bbox):
+                continue
+            out.append({"lat": lat, "lng": lon, "count": 1, "aqi_max": aqi, "aqi_mean": float(aqi), "id": pid})
+        return out
+
+    def _query_subset(self, zoom: int, bbox, ids: set) -> List[dict]:
+        present = [pid for pid in ids if pid in self._points]
+        if zoom > self.max_zoom:
+            return self._single_points(present, bbox)
+        shift = self.max_zoom - zoom
+        cells: Dict[Tuple[int, int], _Cell] = {}
+        first_id: Dict[Tuple[int, int], str] = {}
+        for pid in present:
+            lon, lat, aqi, (fx, fy) = self._points[pid]
+            key = (fx >> shift, fy >> shift)
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = _Cell()
+                first_id[key] = pid
+            cell.count += 1
+            cell.sum_lon += lon
+            cell.sum_lat += lat
+            cell.aqi_sum += aqi
+            if cell.aqi_max is None or aqi > cell.aqi_max:
+                cell.aqi_max = aqi
+        clusters = []
+        for key, cell in cells.items():
+            if bbox and not in_bbox(cell.sum_lon / cell.count, cell.sum_lat / cell.count, bbox):
+                continue
+            item = cell.to_dict()
+            if cell.count == 1:
+                item["id"] = first_id[key]
+            clusters.append(item)
+        return clusters
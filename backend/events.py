@@ -0,0 +1,123 @@
+"""
+In-process pub/sub for sensor updates, fanned out to /ws/sensors and
+/sensors/stream connections.
+
+Each connection owns a Subscription with a bounded queue. publish()
+serializes an event once and hands the same string to every subscriber
+allowed to see that sensor. It never blocks the ingesting request: a
+subscriber whose queue is full is a slow consumer, so it is dropped and
+its connection ends. The client reconnects and catches up from
+/sensors/map.
+"""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Events buffered per connection before it counts as a slow consumer
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "256"))
+# Idle interval after which SSE/WebSocket connections get a keepalive
+EVENT_KEEPALIVE_SECONDS = float(os.getenv("EVENT_KEEPALIVE_SECONDS", "15"))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class Subscription:
+    def __init__(self, bus: "SensorEventBus", email: str, sensor_ids: Optional[Set[str]], queue_size: int):
+        self.bus = bus
+        self.email = email
+        # None means every sensor (admins)
+        self.sensor_ids = sensor_ids
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Next serialized event. Returns None when the subscription was dropped,
+        and raises asyncio.TimeoutError when nothing arrives within ``timeout``.
+        """
+        # A dropped subscription always has a full queue, so this never waits forever
+        if self.dropped:
+            return None
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class SensorEventBus:
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._by_sensor: Dict[str, Set[Subscription]] = {}
+        self._all: Set[Subscription] = set()
+        self._by_email: Dict[str, Set[Subscription]] = {}
+        self.published = 0
+        self.dropped = 0
+
+    @property
+    def connections(self) -> int:
+        return sum(len(subs) for subs in self._by_email.values())
+
+    def subscribe(self, email: str, sensor_ids: Optional[Iterable[str]]) -> Subscription:
+        """sensor_ids=None subscribes to every sensor."""
+        sub = Subscription(self, email, None if sensor_ids is None else set(sensor_ids), self.queue_size)
+        self._by_email.setdefault(email, set()).add(sub)
+        if sub.sensor_ids is None:
+            self._all.add(sub)
+        else:
+            for sensor_id in sub.sensor_ids:
+                self._by_sensor.setdefault(sensor_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        subs = self._by_email.get(sub.email)
+        if subs is None or sub not in subs:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._by_email[sub.email]
+        self._all.discard(sub)
+        for sensor_id in sub.sensor_ids or ():
+            watchers = self._by_sensor.get(sensor_id)
+            if watchers is not None:
+                watchers.discard(sub)
+                if not watchers:
+                    del self._by_sensor[sensor_id]
+
+    def grant(self, email: str, sensor_ids: Iterable[str]):
+        """Extend the open subscriptions of a user who just got new sensors."""
+        sensor_ids = list(sensor_ids)
+        for sub in self._by_email.get(email, ()):
+            if sub.sensor_ids is None:
+                continue
+            for sensor_id in sensor_ids:
+                if sensor_id not in sub.sensor_ids:
+                    sub.sensor_ids.add(sensor_id)
+                    self._by_sensor.setdefault(sensor_id, set()).add(sub)
+
+    def publish(self, sensor_id: str, event: dict) -> int:
+        """Queue an event for every subscriber of sensor_id. Returns the number of receivers."""
+        targets = self._by_sensor.get(sensor_id, set()) | self._all
+        if not targets:
+            return 0
+        message = json.dumps(event, ensure_ascii=False, separators=(",", ":"), default=_json_default)
+        delivered = 0
+        for sub in targets:
+            try:
+                sub.queue.put_nowait(message)
+                delivered += 1
+            except asyncio.QueueFull:
+                sub.dropped = True
+                self.unsubscribe(sub)
+                self.dropped += 1
+                logger.warning("Dropped slow event subscriber %s (queue full)", sub.email)
+        self.published += 1
+        return delivered
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Index registry for every collection the API queries on a hot path.
+
+INDEXES is the single list of indexes; ensure_indexes() applies it on
+startup. Creating an index that already exists with the same keys and
+options is a no-op in MongoDB, so it is safe to run on every start. The
+in-memory store gets the same list as hash indexes on the leading key.
+
+hot_queries() mirrors the filters and sorts the request handlers and
+background loops actually send. explain_hot_queries() runs explain() on
+each of them and flags any winning plan that contains a COLLSCAN, except
+for the reads that want the whole collection (the catalog reload). The
+result is served by GET /admin/indexes, and the module doubles as a CLI
+for deploy checks:
+
+    python indexes.py            # explain the hot queries, exit 1 on COLLSCAN
+    python indexes.py --apply    # create the indexes first
+
+TTL indexes stay in timeseries.py: their expiry comes from the retention
+settings and is changed with collMod, not by re-creating the index.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from typing import List
+
+from pymongo.errors import OperationFailure
+
+import timeseries
+
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options)
+INDEXES = (
+    # Login, registration and grants look users up by email
+    ("users", [("email", 1)], {"unique": True}),
+    # Ingest upserts sensors by device_id; admin-created sensors have none
+    ("sensors", [("device_id", 1)], {"unique": True, "partialFilterExpression": {"device_id": {"$type": "string"}}}),
+    # Demo sensor seeding and lookups by name
+    ("sensors", [("name", 1)], {}),
+    # Per-device range scans (metaField + timeField of the time-series collection)
+    (timeseries.RAW_COLLECTION, [("device_id", 1), ("timestamp", 1)], {}),
+    # Rollup windows read every device's readings in a time range (the
+    # rollups themselves are covered by their timestamp TTL index)
+    (timeseries.RAW_COLLECTION, [("timestamp", 1)], {}),
+    *((name, [("device_id", 1), ("timestamp", 1)], {"unique": True}) for name, *_ in timeseries.ROLLUPS),
+    # One document per polled city, upserted by key
+    ("cities", [("key", 1)], {"unique": True, "sparse": True}),
+    # /air-quality/history: one city, newest first
+    ("air_quality_history", [("city", 1), ("state", 1), ("country", 1), ("timestamp", -1)], {}),
+)
+
+def hot_queries() -> List[tuple]:
+    """
+    (name, collection, filter, sort, full_scan) for the queries the handlers
+    and background loops send. full_scan marks reads that want every
+    document (or a handful of them); their COLLSCAN is expected.
+    """
+    now = datetime.utcnow()
+    day_ago = now - timedelta(days=1)
+    window = {"timestamp": {"$gte": day_ago, "$lt": now}}
+    series = {"device_id": "index-check", **window}
+    fresh = {"updated_at": {"$gte": day_ago}}
+    return [
+        # get_current_user, /token, /register
+        ("user by email", "users", {"email": "index-check@example.com"}, None, False),
+        # store_readings: resolve sensor ids after the upserts
+        ("sensors by device_id", "sensors", {"device_id": {"$in": ["index-check"]}}, None, False),
+        # load_seeded_sensor_ids / ensure_demo_sensors_exist
+        ("sensors by name", "sensors", {"name": {"$in": ["index-check"]}}, None, False),
+        # SensorCatalog.load(): startup and every CATALOG_REFRESH_SECONDS
+        ("sensor catalog reload", "sensors", {}, None, True),
+        # timeseries.iter_series: /sensors/{id}/readings
+        *((f"{name} series", name, series, None, False)
+          for name in (timeseries.RAW_COLLECTION, *(r[0] for r in timeseries.ROLLUPS))),
+        # timeseries.rollup: every rollup source, every retention cycle
+        *((f"{source} rollup window", source, window, None, False) for _, source, *_ in timeseries.ROLLUPS),
+        # city_poller.find_local_city by name
+        ("city by key", "cities", {"key": "almaty|almaty|kazakhstan", **fresh}, None, False),
+        # city_poller.find_local_city by lat/lon: only the polled cities are stored
+        ("fresh cities", "cities", fresh, None, True),
+        # /air-quality/history
+        ("city history", "air_quality_history",
+         {"city": "Almaty", "state": "Almaty", "country": "Kazakhstan"}, [("timestamp", -1)], False),
+    ]
+
+
+def _keys_label(keys) -> str:
+    return ", ".join(f"{field}: {kind}" for field, kind in keys)
+
+
+async def ensure_indexes(db) -> List[dict]:
+    """
+    Create every index in INDEXES (idempotent). A failure (duplicates under
+    a new unique index, an index with the same keys but other options) is
+    logged and reported, and the remaining indexes are still created.
+    """
+    memory = timeseries.is_memory_db(db)
+    report = []
+    for collection, keys, options in INDEXES:
+        if memory and "partialFilterExpression" in options:
+            # The memory store has no partial indexes; sparse skips the same docs here
+            options = {"unique": options.get("unique", False), "sparse": True}
+        entry = {"collection": collection, "keys": _keys_label(keys), "options": options}
+        try:
+            entry["name"] = await db[collection].create_index(keys, **options)
+            entry["ok"] = True
+        except OperationFailure as e:
+            if e.code != 85:  # IndexOptionsConflict: same keys exist (e.g. as a TTL index)
+                entry["ok"] = False
+                entry["error"] = str(e)
+                logger.error("Could not create index %s on %s: %s", entry["keys"], collection, e)
+            else:
+                entry["ok"] = True
+                entry["note"] = "an index on these keys exists with other options"
+        except ValueError as e:
+            entry["ok"] = False
+            entry["error"] = str(e)
+            logger.error("Could not create index %s on %s: %s", entry["keys"], collection, e)
+        report.append(entry)
+    return report
+
+
+def plan_stages(explain: dict) -> List[str]:
+    """Stage names of the winning plan(s) in an explain() result, outermost first."""
+    stages = []
+
+    def walk(node, in_plan: bool):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "rejectedPlans":
+                    continue
+                if key == "stage" and in_plan and isinstance(value, str):
+                    stages.append(value)
+                walk(value, in_plan or key == "winningPlan")
+        elif isinstance(node, list):
+            for item in node:
+                walk(item, in_plan)
+
+    walk(explain, False)
+    return stages
+
+
+async def explain_hot_queries(db) -> List[dict]:
+    """
+    explain() every hot query; `ok` is False when its plan scans the whole
+    collection and the query is not a deliberate full read.
+    """
+    if timeseries.is_memory_db(db):
+        return []
+    raw = getattr(db, "wrapped", db)  # skip metrics.InstrumentedDb for explain
+    results = []
+    for name, collection, query, sort, full_scan in hot_queries():
+        cursor = raw[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        entry = {"query": name, "collection": collection, "full_scan": full_scan}
+        try:
+            stages = plan_stages(await cursor.explain())
+            entry["stages"] = stages
+            entry["ok"] = full_scan or "COLLSCAN" not in stages
+        except OperationFailure as e:
+            entry["ok"] = False
+            entry["error"] = str(e)
+        results.append(entry)
+    return results
+
+
+async def _run_cli(args) -> int:
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(args.mongo_url, serverSelectionTimeoutMS=5000)
+    db = client[args.database]
+    try:
+        failed = 0
+        if args.apply:
+            # The raw readings collection must exist as time-series before it gets indexes
+            await timeseries.ensure_timeseries_storage(db)
+            for entry in await ensure_indexes(db):
+                status = "ok" if entry["ok"] else f"FAILED: {entry['error']}"
+                print(f"index {entry['collection']} ({entry['keys']}): {status}")
+                failed += not entry["ok"]
+        for entry in await explain_hot_queries(db):
+            detail = " > ".join(entry.get("stages", [])) or entry.get("error", "")
+            if entry["full_scan"]:
+                detail += " (full read, scan expected)"
+            print(f"{'ok ' if entry['ok'] else 'BAD'} {entry['query']:<32} {detail}")
+            failed += not entry["ok"]
+        return 1 if failed else 0
+    finally:
+        client.close()
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Apply the index registry and check hot query plans for COLLSCAN")
+    parser.add_argument("--apply", action="store_true", help="create the indexes before checking")
+    parser.add_argument("--mongo-url", default=os.getenv("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--database", default=os.getenv("DATABASE_NAME", "breez"))
+    sys.exit(asyncio.run(_run_cli(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Write-behind queue for POST /data.
+
+The handler only validates a reading and puts it on a bounded asyncio
+queue, so its latency no longer follows database latency. One committer
+task takes readings off the queue in groups: it starts a group with the
+first waiting reading and closes it after INGEST_GROUP_SIZE readings or
+INGEST_GROUP_WAIT_SECONDS, whichever comes first. Each group is stored
+per user with the normal store function (one insert_many and one
+bulk_write per user, not per reading).
+
+When the queue is full, submit() raises IngestQueueFull and the handler
+answers 429 with Retry-After instead of queueing without limit. Readings
+that are acknowledged but not committed yet are lost if the process dies;
+callers that need durability send ?sync=1. On shutdown the committer
+stores whatever is still queued before it exits.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, List
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Readings waiting for the committer; 0 disables write-behind (every /data is synchronous)
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_GROUP_SIZE = int(os.getenv("INGEST_GROUP_SIZE", "500"))
+INGEST_GROUP_WAIT_SECONDS = float(os.getenv("INGEST_GROUP_WAIT_SECONDS", "0.05"))
+# Retry-After sent with 429 when the queue is full
+INGEST_RETRY_AFTER_SECONDS = int(os.getenv("INGEST_RETRY_AFTER_SECONDS", "1"))
+
+commit_seconds = metrics.registry.histogram(
+    "ingest_commit_duration_seconds", "Time to store one group of queued readings")
+queue_wait_seconds = metrics.registry.histogram(
+    "ingest_queue_wait_seconds", "Time a reading waited in the ingest queue before its commit started")
+committed_readings = metrics.registry.counter(
+    "ingest_committed_readings_total", "Queued readings stored by the committer")
+failed_readings = metrics.registry.counter(
+    "ingest_failed_readings_total", "Queued readings the committer could not store")
+rejected_readings = metrics.registry.counter(
+    "ingest_rejected_total", "Readings answered with 429 because the ingest queue was full")
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestQueue:
+    def __init__(
+        self,
+        store: Callable[..., Awaitable[dict]],
+        maxsize: int = INGEST_QUEUE_SIZE,
+        group_size: int = INGEST_GROUP_SIZE,
+        group_wait: float = INGEST_GROUP_WAIT_SECONDS,
+    ):
+        # store(readings, user, received_at) -> {"failed": {index: error}, ...}
+        self._store = store
+        self.maxsize = maxsize
+        self.group_size = max(1, group_size)
+        self.group_wait = group_wait
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(0, maxsize))
+        self._group = []
+        self._committing = None
+        self.running = False
+
+    @property
+    def enabled(self) -> bool:
+        """True when readings can be queued (write-behind on and the committer running)."""
+        return self.maxsize > 0 and self.running
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, reading, user: dict):
+        try:
+            self._queue.put_nowait((reading, user, datetime.utcnow(), time.perf_counter()))
+        except asyncio.QueueFull:
+            rejected_readings.inc()
+            raise IngestQueueFull()
+
+    async def _next_group(self):
+        self._group = [await self._queue.get()]
+        deadline = time.monotonic() + self.group_wait
+        while len(self._group) < self.group_size:
+            if not self._queue.empty():
+                self._group.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                self._group.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def run(self):
+        self.running = True
+        try:
+            while True:
+                await self._next_group()
+                group, self._group = self._group, []
+                # Shielded: cancelling the committer must not cut a commit in half
+                self._committing = asyncio.ensure_future(self._commit(group))
+                await asyncio.shield(self._committing)
+        except asyncio.CancelledError:
+            self.running = False
+            if self._committing is not None and not self._committing.done():
+                await self._committing
+            # Store what was acknowledged but not committed yet
+            remaining = self._group
+            while not self._queue.empty():
+                remaining.append(self._queue.get_nowait())
+            if remaining:
+                logger.info("Committing %d queued readings before shutdown", len(remaining))
+                for start in range(0, len(remaining), self.group_size):
+                    await self._commit(remaining[start:start + self.group_size])
+            raise
+        finally:
+            self.running = False
+
+    async def _commit(self, group: list):
+        started = time.perf_counter()
+        by_user = {}
+        for reading, user, received_at, enqueued in group:
+            queue_wait_seconds.observe(started - enqueued)
+            entry = by_user.setdefault(user.get("email"), [user, [], []])
+            entry[0] = user  # latest principal carries the newest permissions
+            entry[1].append(reading)
+            entry[2].append(received_at)
+        await asyncio.gather(*(
+            self._commit_user(user, readings, received_at) for user, readings, received_at in by_user.values()
+        ))
+        commit_seconds.observe(time.perf_counter() - started)
+
+    async def _commit_user(self, user: dict, readings: List, received_at: List[datetime]):
+        try:
+            result = await self._store(readings, user, received_at)
+            failed = len(result["failed"])
+        except Exception:
+            logger.exception("Committing %d queued readings for %s failed", len(readings), user.get("email"))
+            failed = len(readings)
+        committed_readings.inc(amount=len(readings) - failed)
+        if failed:
+            failed_readings.inc(amount=failed)
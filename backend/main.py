@@ -1,21 +1,45 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, ValidationError
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 import bcrypt
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Optional, List
 import httpx
 import os
+import hashlib
 import json
+import logging
 import re
 import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from memory_store import MemoryCollection
+import aqi
+import city_poller
+import clustering
+import events
+import indexes
+import ingest_queue
+import log_config
+import metrics
+import sensor_catalog
+import timeseries
+import upstream
+import wire_format
+
 load_dotenv()
+log_config.setup_logging()
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Breez API", version="1.0.0")
 
@@ -48,18 +72,26 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.RequestMetricsMiddleware)
 
 # MongoDB or in-memory fallback when MongoDB is unavailable
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "breez")
 client = AsyncIOMotorClient(MONGO_URL, serverSelectionTimeoutMS=5000)
-db = client[DATABASE_NAME]  # May be replaced with MemoryDb at startup
+db = metrics.InstrumentedDb(client[DATABASE_NAME])  # May be replaced with MemoryDb at startup
 
 # Security
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Resolved users are cached per token so authenticated requests skip the users lookup
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "30"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "1024"))
 # Using bcrypt directly instead of passlib to avoid compatibility issues
+# bcrypt cost factor for new hashes (existing hashes keep the cost they were made with)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Threads hashing/verifying passwords at once; 0 runs bcrypt on the event loop
+BCRYPT_MAX_WORKERS = int(os.getenv("BCRYPT_MAX_WORKERS", str(min(4, os.cpu_count() or 1))))
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Admin mock user
@@ -76,6 +108,8 @@ TEST_USER_PASSWORD = os.getenv("TEST_USER_PASSWORD", "test123")
 
 IQAIR_API_KEY = os.getenv("IQAIR_API_KEY", "")
 IQAIR_BASE_URL = "http://api.airvisual.com/v2"
+# Shared AirVisual client (keep-alive, cache, request coalescing, quota); idle without IQAIR_API_KEY
+airvisual = upstream.AirVisualClient(IQAIR_BASE_URL, IQAIR_API_KEY)
 
 # Air Quality Sensor API
 SENSOR_API_URL = os.getenv("SENSOR_API_URL", "http://89.218.178.215:3003/")
@@ -167,9 +201,51 @@ def get_password_hash(password):
     # bcrypt has a 72 byte limit, truncate if necessary
     if len(password) > 72:
         password = password[:72]
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     return bcrypt.hashpw(password, salt).decode('utf-8')
 
+
+# bcrypt releases the GIL, so a small thread pool keeps the 100-300 ms of
+# hashing per call off the event loop. The semaphore bounds how many calls
+# are handed to the pool; extra logins wait on the loop instead of queueing
+# unbounded work behind the executor.
+password_executor = (
+    ThreadPoolExecutor(max_workers=BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
+    if BCRYPT_MAX_WORKERS > 0 else None
+)
+password_slots = asyncio.Semaphore(max(1, BCRYPT_MAX_WORKERS))
+bcrypt_seconds = metrics.registry.histogram(
+    "bcrypt_duration_seconds", "Time spent hashing/verifying one password", ("operation",))
+bcrypt_wait_seconds = metrics.registry.histogram(
+    "bcrypt_wait_seconds", "Time a password job waited for a bcrypt worker", ("operation",))
+
+
+def timed_call(func, *args):
+    start = time.perf_counter()
+    return func(*args), time.perf_counter() - start
+
+
+async def run_password_job(func, *args):
+    queued = time.perf_counter()
+    if password_executor is None:
+        result, elapsed = timed_call(func, *args)
+    else:
+        async with password_slots:
+            result, elapsed = await asyncio.get_running_loop().run_in_executor(
+                password_executor, timed_call, func, *args
+            )
+    bcrypt_seconds.observe(elapsed, func.__name__)
+    bcrypt_wait_seconds.observe(max(0.0, time.perf_counter() - queued - elapsed), func.__name__)
+    return result
+
+
+async def hash_password(password) -> str:
+    return await run_password_job(get_password_hash, password)
+
+
+async def check_password(plain_password, hashed_password) -> bool:
+    return await run_password_job(verify_password, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -181,95 +257,31 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 
 # In-memory fallback when MongoDB is unavailable
-class MemoryCollection:
-    """In-memory collection mimicking Motor's async interface."""
-    def __init__(self, name: str, initial_data: list = None):
-        self.name = name
-        self._data = {}
-        self._counter = 1
-        for doc in (initial_data or []):
-            doc = dict(doc)
-            k = str(doc.get("_id", self._counter))
-            self._data[k] = doc
-            self._data[k]["_id"] = k
-            self._counter += 1
-        self._counter = max(self._counter, len(self._data) + 1)
-
-    async def find_one(self, query: dict):
-        if "_id" in query:
-            key = str(query["_id"])
-            return self._data.get(key)
-        # Generic field match: iterate and check all query keys
-        for doc in self._data.values():
-            if all(doc.get(k) == v for k, v in query.items()):
-                return doc
-        return None
-
-    async def insert_one(self, doc: dict):
-        key = str(ObjectId())
-        doc = dict(doc)
-        doc["_id"] = key
-        self._data[key] = doc
-        class R:
-            inserted_id = key
-        return R()
-
-    async def update_one(self, query: dict, update: dict):
-        doc = await self.find_one(query)
-        if not doc:
-            class R:
-                matched_count = 0
-                modified_count = 0
-            return R()
-        key = str(doc["_id"])
-        if "$set" in update:
-            for k, v in update["$set"].items():
-                self._data[key][k] = v
-        if "$addToSet" in update:
-            for k, v in update["$addToSet"].items():
-                arr = self._data[key].setdefault(k, [])
-                if isinstance(v, dict) and "$each" in v:
-                    for x in v["$each"]:
-                        if x not in arr:
-                            arr.append(x)
-                elif v not in arr:
-                    arr.append(v)
-        class R:
-            matched_count = 1
-            modified_count = 1
-        return R()
-
-    def find(self, query: dict = None):
-        class Cursor:
-            def __init__(self, items):
-                self._items = list(items)
-            def limit(self, n):
-                self._items = self._items[:n] if n > 0 else self._items
-                return self
-            async def to_list(self, length):
-                return self._items[:length] if length else self._items
-        return Cursor(self._data.values())
-
-
 class MemoryDb:
     """In-memory DB used when MongoDB is unavailable."""
-    def __init__(self):
+    def __init__(self, test_user_password_hash: str):
         # Use ObjectId-compatible ID so safe_get_user_id works
         oid = str(ObjectId())
         self.users = MemoryCollection("users", [{
             "_id": oid,
             "email": TEST_USER_EMAIL,
             "name": "Test User",
-            "hashed_password": get_password_hash(TEST_USER_PASSWORD),
+            "hashed_password": test_user_password_hash,
             "role": "user",
             "sensor_permissions": [],
         }])
-        self.sensors = MemoryCollection("sensors", [])
-        self.sensor_readings = MemoryCollection("sensor_readings", [])
-        self.air_quality_history = MemoryCollection("air_quality_history", [])
-        self.cities = MemoryCollection("cities", [])
+        # Indexes come from indexes.INDEXES, applied in on_startup
+        self.sensors = MemoryCollection("sensors")
+        self.sensor_readings = MemoryCollection("sensor_readings")
+        self.sensor_readings_1m = MemoryCollection("sensor_readings_1m")
+        self.sensor_readings_1h = MemoryCollection("sensor_readings_1h")
+        self.air_quality_history = MemoryCollection("air_quality_history")
+        self.cities = MemoryCollection("cities")
         self.purchases = MemoryCollection("purchases", [])
 
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return getattr(self, name)
+
 
 def sensor_to_response(sensor: dict) -> dict:
     sid = sensor.get("_id")
@@ -450,33 +462,44 @@ DEMO_SENSORS = [
 ]
 
 
-async def get_seeded_sensor_ids():
-    """Get IDs of all seeded demo sensors by their names."""
-    sensor_ids = []
-    for sensor_def in DEMO_SENSORS:
-        sensor = await db.sensors.find_one({"name": sensor_def["name"]})
-        if sensor:
-            sensor_ids.append(str(sensor["_id"]))
-    return sensor_ids
+DEMO_SENSOR_NAMES = [sensor_def["name"] for sensor_def in DEMO_SENSORS]
+# IDs of the demo sensors in DEMO_SENSORS order, granted to every user.
+# Resolved at startup and kept current from catalog reloads, so register
+# and login never look them up.
+seeded_sensor_ids: List[str] = []
+
+
+def seeded_ids_by_name(sensors) -> List[str]:
+    """Demo sensor ids in DEMO_SENSORS order; the first sensor with a name wins."""
+    by_name = {}
+    for sensor in sensors:
+        by_name.setdefault(sensor.get("name"), str(sensor["_id"]))
+    return [by_name[name] for name in DEMO_SENSOR_NAMES if name in by_name]
+
+
+async def load_seeded_sensor_ids() -> List[str]:
+    global seeded_sensor_ids
+    sensors = await db.sensors.find({"name": {"$in": DEMO_SENSOR_NAMES}}, {"_id": 1, "name": 1}).to_list(None)
+    seeded_sensor_ids = seeded_ids_by_name(sensors)
+    return seeded_sensor_ids
 
 
 async def ensure_demo_sensors_exist():
     """Ensure all demo sensors exist and return their IDs."""
-    for sensor_doc in DEMO_SENSORS:
-        existing = await db.sensors.find_one({"name": sensor_doc["name"]})
-        if existing:
-            print(f"  ⊝ Sensor exists: {sensor_doc['name']}")
-        else:
-            doc = {**sensor_doc, "created_at": datetime.utcnow()}
-            await db.sensors.insert_one(doc)
-            print(f"  ✓ Added sensor {sensor_doc['name']}")
-
-    return await get_seeded_sensor_ids()
+    existing = await db.sensors.find({"name": {"$in": DEMO_SENSOR_NAMES}}, {"name": 1}).to_list(None)
+    existing_names = {s.get("name") for s in existing}
+    now = datetime.utcnow()
+    missing = [{**sensor_doc, "created_at": now} for sensor_doc in DEMO_SENSORS if sensor_doc["name"] not in existing_names]
+    if missing:
+        await db.sensors.insert_many(missing)
+        for doc in missing:
+            logger.info("Added sensor %s", doc["name"])
+    return await load_seeded_sensor_ids()
 
 
 async def ensure_user_has_seeded_sensors(user: dict):
     """Ensure a specific user has access to all seeded sensors."""
-    sensor_ids = await get_seeded_sensor_ids()
+    sensor_ids = seeded_sensor_ids
     if not sensor_ids:
         return []
 
@@ -488,7 +511,8 @@ async def ensure_user_has_seeded_sensors(user: dict):
             {"_id": user["_id"]},
             {"$addToSet": {"sensor_permissions": {"$each": missing_ids}}}
         )
-        print(f"✓ Backfilled {len(missing_ids)} sensors for user {user.get('email')}")
+        principal_cache.invalidate(user.get("email"))
+        logger.info("Backfilled %d sensors for user %s", len(missing_ids), user.get("email"))
 
     return sensor_ids
 
@@ -498,20 +522,13 @@ async def grant_sensors_to_all_users(sensor_ids):
     if not sensor_ids:
         return
 
-    users = await db.users.find({}).to_list(5000)
-    updated_users = 0
-    for user in users:
-        current_permissions = set(user.get("sensor_permissions", []) or [])
-        missing_ids = [sid for sid in sensor_ids if sid not in current_permissions]
-        if not missing_ids:
-            continue
-        await db.users.update_one(
-            {"_id": user["_id"]},
-            {"$addToSet": {"sensor_permissions": {"$each": missing_ids}}}
-        )
-        updated_users += 1
-
-    print(f"✓ Granted {len(sensor_ids)} sensors to {updated_users} existing users")
+    result = await db.users.update_many(
+        {}, {"$addToSet": {"sensor_permissions": {"$each": list(sensor_ids)}}}
+    )
+    updated_users = result.modified_count
+    if updated_users:
+        principal_cache.clear()
+    logger.info("Granted %d sensors to %d existing users", len(sensor_ids), updated_users)
 
 
 async def seed_test_user_and_sensors():
@@ -522,23 +539,94 @@ async def seed_test_user_and_sensors():
             user_doc = {
                 "email": TEST_USER_EMAIL,
                 "name": "Test User",
-                "hashed_password": get_password_hash(TEST_USER_PASSWORD),
+                "hashed_password": await hash_password(TEST_USER_PASSWORD),
                 "created_at": datetime.utcnow(),
                 "role": "user",
                 "sensor_permissions": [],
             }
             await db.users.insert_one(user_doc)
-            print(f"✓ Created demo user {TEST_USER_EMAIL}")
+            logger.info("Created demo user %s", TEST_USER_EMAIL)
         else:
-            print(f"✓ Demo user exists: {TEST_USER_EMAIL}")
+            logger.info("Demo user exists: %s", TEST_USER_EMAIL)
 
         sensor_ids = await ensure_demo_sensors_exist()
-        print(f"✓ Total seeded sensors: {len(sensor_ids)}")
+        logger.info("Total seeded sensors: %d", len(sensor_ids))
         await grant_sensors_to_all_users(sensor_ids)
-    except Exception as e:
-        print(f"Demo seed failed: {e}")
+    except Exception:
+        logger.exception("Demo seed failed")
+
+class PrincipalCache:
+    """
+    Bounded TTL/LRU cache of user documents keyed by (token subject, token exp).
+    Entries never outlive the token itself. Writers that change a user document
+    call invalidate(email); the cache is per process, so other workers see the
+    change once their entry's TTL runs out.
+    """
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._entries = OrderedDict()  # (email, exp) -> (expires_at, user)
+        self._keys_by_email = {}
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, email: str, exp) -> Optional[dict]:
+        key = (email, exp)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if time.monotonic() >= expires_at:
+            self._discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return dict(user)
+
+    def put(self, email: str, exp, user: dict, version: int):
+        # A lookup that raced with an invalidation must not re-insert stale data
+        if version != self._version or self._max_entries <= 0:
+            return
+        ttl = self._ttl
+        if exp is not None:
+            ttl = min(ttl, exp - time.time())
+        if ttl <= 0:
+            return
+        key = (email, exp)
+        self._entries[key] = (time.monotonic() + ttl, dict(user))
+        self._entries.move_to_end(key)
+        self._keys_by_email.setdefault(email, set()).add(key)
+        while len(self._entries) > self._max_entries:
+            self._discard(next(iter(self._entries)))
+
+    def invalidate(self, email: str):
+        self._version += 1
+        for key in self._keys_by_email.pop(email, ()):
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._version += 1
+        self._entries.clear()
+        self._keys_by_email.clear()
+
+    def _discard(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_email.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_email[key[0]]
+
+
+principal_cache = PrincipalCache(AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS)
+auth_seconds = metrics.registry.histogram(
+    "auth_duration_seconds", "get_current_user latency by where the user came from", ("source",))
+
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    start = time.perf_counter()
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -548,6 +636,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         role: str = payload.get("role", "user")
+        exp = payload.get("exp")
         if email is None:
             raise credentials_exception
     except JWTError:
@@ -563,12 +652,20 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             "sensor_permissions": []
         }
     
+    user = principal_cache.get(email, exp)
+    if user is not None:
+        auth_seconds.observe(time.perf_counter() - start, "cache")
+        return user
+
+    cache_version = principal_cache.version
     user = await db.users.find_one({"email": email})
     if user is None:
         raise credentials_exception
     # гарантируем роль и права
     user["role"] = user.get("role", role or "user")
     user["sensor_permissions"] = user.get("sensor_permissions", [])
+    principal_cache.put(email, exp, user, cache_version)
+    auth_seconds.observe(time.perf_counter() - start, "db")
     return user
 
 
@@ -594,7 +691,7 @@ def safe_get_user_id(current_user: dict):
         return (False, ObjectId(user_id))
     else:
         # Некорректный user_id
-        print(f"⚠️ Invalid user_id in safe_get_user_id: {user_id}, type: {type(user_id)}")
+        logger.warning("Invalid user_id in safe_get_user_id: %r (%s)", user_id, type(user_id).__name__)
         return (False, None)
 
 
@@ -604,17 +701,66 @@ async def require_admin(current_user: dict = Depends(get_current_user)):
     return current_user
 
 
+# Result of indexes.ensure_indexes() at startup, served by /admin/indexes
+index_report: List[dict] = []
+
+
+async def ensure_indexes():
+    """Apply the index registry and warn about hot queries that still scan whole collections."""
+    global index_report
+    try:
+        index_report = await indexes.ensure_indexes(db)
+        for plan in await indexes.explain_hot_queries(db):
+            if not plan["ok"]:
+                logger.warning("Hot query %r has no usable index: %s", plan["query"],
+                               plan.get("error") or " > ".join(plan["stages"]))
+    except Exception as e:
+        logger.warning("Index setup failed: %s", e)
+
+
+# Long-running tasks started in on_startup and cancelled on shutdown
+background_tasks: List[asyncio.Task] = []
+# Refreshes POLL_CITIES from AirVisual into db.cities (only with IQAIR_API_KEY)
+city_refresher: Optional[city_poller.CityPoller] = None
+
+
 @app.on_event("startup")
 async def on_startup():
-    global db
+    global db, city_refresher
     try:
         await asyncio.wait_for(client.admin.command("ping"), timeout=3.0)
-        db = client[DATABASE_NAME]
-        print("✓ Connected to MongoDB")
+        db = metrics.InstrumentedDb(client[DATABASE_NAME])
+        logger.info("Connected to MongoDB")
     except Exception as e:
-        print(f"⚠️ MongoDB unavailable ({e}), using in-memory store")
-        db = MemoryDb()
+        logger.warning("MongoDB unavailable (%s), using in-memory store", e)
+        db = metrics.InstrumentedDb(MemoryDb(await hash_password(TEST_USER_PASSWORD)))
+    try:
+        # Before the indexes: creating an index would make sensor_readings a regular collection
+        await timeseries.ensure_timeseries_storage(db)
+    except Exception as e:
+        logger.warning("Time-series storage setup failed: %s", e)
+    await ensure_indexes()
     await seed_test_user_and_sensors()
+    await load_sensor_catalog()
+    background_tasks.append(asyncio.create_task(catalog.refresh_loop(db, on_reload=on_catalog_reload)))
+    background_tasks.append(asyncio.create_task(timeseries.retention_loop(db)))
+    background_tasks.append(asyncio.create_task(metrics.loop_lag_monitor()))
+    background_tasks.append(asyncio.create_task(ingest_writer.run()))
+    if airvisual.enabled:
+        await airvisual.start()
+        cities = city_poller.parse_city_list(city_poller.POLL_CITIES)
+        if cities:
+            city_refresher = city_poller.CityPoller(db, airvisual, cities)
+            background_tasks.append(asyncio.create_task(city_refresher.run()))
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await airvisual.close()
 
 # Routes
 @app.get("/")
@@ -630,13 +776,10 @@ async def register(user: UserCreate):
             raise HTTPException(status_code=400, detail="Email already registered")
         
         # Create user
-        print(f"🔐 Hashing password for user: {user.email}")
-        hashed_password = get_password_hash(user.password)
-        print(f"✓ Password hashed successfully")
+        hashed_password = await hash_password(user.password)
 
-        # Ensure seeded demo sensors exist, then auto-grant to the new user
-        await ensure_demo_sensors_exist()
-        sensor_ids = await get_seeded_sensor_ids()
+        # Auto-grant the seeded demo sensors to the new user
+        sensor_ids = list(seeded_sensor_ids)
 
         user_dict = {
             "email": user.email,
@@ -646,9 +789,8 @@ async def register(user: UserCreate):
             "role": "user",
             "sensor_permissions": sensor_ids,
         }
-        print(f"💾 Inserting user into database...")
         result = await db.users.insert_one(user_dict)
-        print(f"✓ User created with ID: {result.inserted_id} with {len(sensor_ids)} sensors")
+        logger.info("User created with ID %s with %d sensors", result.inserted_id, len(sensor_ids))
         user_dict["id"] = str(result.inserted_id)
         return UserResponse(
             id=user_dict["id"],
@@ -660,9 +802,7 @@ async def register(user: UserCreate):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Registration error: {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Registration error")
         raise HTTPException(
             status_code=500, 
             detail=f"Registration failed: {str(e)}"
@@ -671,7 +811,7 @@ async def register(user: UserCreate):
 @app.post("/token", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     user = await db.users.find_one({"email": form_data.username})
-    if not user or not verify_password(form_data.password, user["hashed_password"]):
+    if not user or not await check_password(form_data.password, user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -749,7 +889,7 @@ async def get_air_quality(
                     pm25 = 25.7  # Default fallback
                 aqius = calculate_aqi(pm25)
             except (ValueError, TypeError) as e:
-                print(f"Error processing sensor data: {e}")
+                logger.warning("Error processing sensor data: %s", e)
                 sensor_data = None
             
             if sensor_data:
@@ -794,6 +934,14 @@ async def get_air_quality(
                     }
                 }
         
+        # AirVisual, если задан IQAIR_API_KEY: только данные, которые city_poller
+        # уже сохранил в db.cities. Запросы к AirVisual делает только он
+        # (POLL_CITIES), обработчик запроса к нему не обращается
+        if airvisual.enabled:
+            local = await city_poller.find_local_city(db, city, state, country, lat, lon)
+            if local:
+                return local
+
         # Fallback на mock данные
         return {
             "city": city or "Almaty",
@@ -823,9 +971,7 @@ async def get_air_quality(
             }
         }
     except Exception as e:
-        print(f"Error in get_air_quality: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in get_air_quality")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 @app.get("/air-quality/history")
@@ -840,284 +986,397 @@ async def get_air_quality_history(
         "city": city,
         "state": state,
         "country": country
-    }).sort("timestamp", -1).limit(30).to_list(30)
+    }, {"_id": 0}).sort("timestamp", -1).limit(30).to_list(30)
     
     return {"history": history}
 
-@app.get("/air-quality/all")
-async def get_all_air_quality_data(current_user: dict = Depends(get_current_user)):
-    """Получить данные со всех доступных сенсоров"""
-    try:
-        # API и WebSocket полностью отключены - используем только тестовые данные
-        sensor_data = []
-        print("⚠️ API и WebSocket отключены, используем только тестовые данные")
-        
-        # Обрабатываем данные со всех сенсоров (только тестовые)
-        all_data = []
-        print(f"DEBUG: Processing {len(sensor_data)} sensors")
-        if sensor_data and len(sensor_data) > 0:
-            for idx, sensor in enumerate(sensor_data):
-                print(f"DEBUG: Processing sensor {idx + 1}/{len(sensor_data)}: {sensor.get('device_id', 'unknown')}")
-                try:
-                    pm25 = float(sensor.get("pm25", 0) or 0)
-                    if pm25 <= 0:
-                        pm25 = 25.7
-                    aqius = calculate_aqi(pm25)
-                    
-                    # Получаем координаты из данных API
-                    device_id = sensor.get("device_id", "unknown")
-                    site = sensor.get("site", "unknown")
-                    
-                    # Пробуем получить координаты из разных полей API
-                    lat = None
-                    lon = None
-                    
-                    # Проверяем различные варианты названий полей для координат
-                    if "lat" in sensor:
-                        lat = float(sensor.get("lat", 0) or 0)
-                    elif "latitude" in sensor:
-                        lat = float(sensor.get("latitude", 0) or 0)
-                    elif "y" in sensor:
-                        lat = float(sensor.get("y", 0) or 0)
-                    
-                    if "lon" in sensor:
-                        lon = float(sensor.get("lon", 0) or 0)
-                    elif "lng" in sensor:
-                        lon = float(sensor.get("lng", 0) or 0)
-                    elif "longitude" in sensor:
-                        lon = float(sensor.get("longitude", 0) or 0)
-                    elif "x" in sensor:
-                        lon = float(sensor.get("x", 0) or 0)
-                    
-                    # Проверяем вложенные объекты location
-                    if "location" in sensor:
-                        loc = sensor["location"]
-                        if isinstance(loc, dict):
-                            if "lat" in loc:
-                                lat = float(loc.get("lat", 0) or 0)
-                            elif "latitude" in loc:
-                                lat = float(loc.get("latitude", 0) or 0)
-                            
-                            if "lon" in loc:
-                                lon = float(loc.get("lon", 0) or 0)
-                            elif "lng" in loc:
-                                lon = float(loc.get("lng", 0) or 0)
-                            elif "longitude" in loc:
-                                lon = float(loc.get("longitude", 0) or 0)
-                            
-                            # Проверяем GeoJSON формат coordinates: [lon, lat]
-                            if "coordinates" in loc:
-                                coords = loc["coordinates"]
-                                if isinstance(coords, list) and len(coords) >= 2:
-                                    lon = float(coords[0] or 0)
-                                    lat = float(coords[1] or 0)
-                        elif isinstance(loc, list) and len(loc) >= 2:
-                            # Если location - это массив [lon, lat]
-                            lon = float(loc[0] or 0)
-                            lat = float(loc[1] or 0)
-                    
-                    # Если координаты не найдены, используем координаты Алматы с уникальным смещением
-                    if lat is None or lat == 0 or lon is None or lon == 0:
-                        # Используем координаты Алматы с небольшим случайным смещением для визуализации
-                        base_lat = 43.2220
-                        base_lon = 76.8512
-                        # Создаем уникальное смещение на основе device_id
-                        import hashlib
-                        hash_obj = hashlib.md5(str(device_id).encode())
-                        hash_int = int(hash_obj.hexdigest()[:8], 16)
-                        # Смещение до 0.05 градуса (примерно 5.5 км)
-                        lat_offset = (hash_int % 1000) / 20000 - 0.025
-                        lon_offset = ((hash_int // 1000) % 1000) / 20000 - 0.025
-                        lat = base_lat + lat_offset
-                        lon = base_lon + lon_offset
-                        print(f"Warning: No coordinates found for device {device_id}, using offset: {lat:.4f}, {lon:.4f}")
-                    
-                    all_data.append({
-                        "city": "Almaty",
-                        "state": "Almaty",
-                        "country": "Kazakhstan",
-                        "location": {
-                            "type": "Point",
-                            "coordinates": [lon, lat]
-                        },
-                        "current": {
-                            "pollution": {
-                                "ts": datetime.utcnow().isoformat(),
-                                "aqius": aqius,
-                                "mainus": "pm25",
-                                "aqicn": aqius,
-                                "maincn": "pm25",
-                                "pm1": float(sensor.get("pm1", 0) or 0),
-                                "pm25": float(sensor.get("pm25", 0) or 0),
-                                "pm10": float(sensor.get("pm10", 0) or 0),
-                                "co2": float(sensor.get("co2", 0) or 0),
-                                "voc": float(sensor.get("voc", 0) or 0),
-                                "ch2o": float(sensor.get("ch2o", 0) or 0),
-                                "co": float(sensor.get("co", 0) or 0),
-                                "o3": float(sensor.get("o3", 0) or 0),
-                                "no2": float(sensor.get("no2", 0) or 0),
-                            },
-                            "weather": {
-                                "ts": datetime.utcnow().isoformat(),
-                                "tp": float(sensor.get("temp", 0) or 0),
-                                "pr": 1013,
-                                "hu": float(sensor.get("hum", 0) or 0),
-                                "ws": 0,
-                                "wd": 0,
-                                "ic": "01d"
-                            }
-                        },
-                        "sensor_data": {
-                            "device_id": sensor.get("device_id", ""),
-                            "site": sensor.get("site", ""),
-                            "danger_level": sensor.get("danger_level", "safe")
-                        }
-                    })
-                except Exception as e:
-                    print(f"Error processing sensor {sensor.get('device_id', 'unknown')}: {e}")
-                    continue
-        
-        # Генерируем тестовые данные для городов по всему миру
-        print("Adding global test points with different danger levels...")
-        
-        # Мировые города с разными уровнями загрязнения
-        global_cities = [
-                   # Азия
-                   {"city": "Almaty", "country": "Kazakhstan", "lat": 43.2220, "lon": 76.8512, "pm25": 65.0, "pm10": 85.0, "aqi": 65, "danger": "moderate"},
-                   {"city": "Beijing", "country": "China", "lat": 39.9042, "lon": 116.4074, "pm25": 180.0, "pm10": 220.0, "aqi": 180, "danger": "unhealthy"},
-                   {"city": "Delhi", "country": "India", "lat": 28.6139, "lon": 77.2090, "pm25": 250.0, "pm10": 300.0, "aqi": 250, "danger": "very_unhealthy"},
-                   {"city": "Tokyo", "country": "Japan", "lat": 35.6762, "lon": 139.6503, "pm25": 45.0, "pm10": 60.0, "aqi": 45, "danger": "safe"},
-                   {"city": "Seoul", "country": "South Korea", "lat": 37.5665, "lon": 126.9780, "pm25": 85.0, "pm10": 110.0, "aqi": 85, "danger": "moderate"},
-                   {"city": "Bangkok", "country": "Thailand", "lat": 13.7563, "lon": 100.5018, "pm25": 120.0, "pm10": 150.0, "aqi": 120, "danger": "unhealthy_sensitive"},
-                   {"city": "Jakarta", "country": "Indonesia", "lat": -6.2088, "lon": 106.8456, "pm25": 140.0, "pm10": 180.0, "aqi": 140, "danger": "unhealthy_sensitive"},
-                   {"city": "Mumbai", "country": "India", "lat": 19.0760, "lon": 72.8777, "pm25": 220.0, "pm10": 280.0, "aqi": 220, "danger": "very_unhealthy"},
-                   {"city": "Shanghai", "country": "China", "lat": 31.2304, "lon": 121.4737, "pm25": 160.0, "pm10": 200.0, "aqi": 160, "danger": "unhealthy"},
-                   {"city": "Dubai", "country": "UAE", "lat": 25.2048, "lon": 55.2708, "pm25": 95.0, "pm10": 125.0, "aqi": 95, "danger": "moderate"},
-                   
-                   # Европа
-                   {"city": "London", "country": "UK", "lat": 51.5074, "lon": -0.1278, "pm25": 35.0, "pm10": 50.0, "aqi": 35, "danger": "safe"},
-                   {"city": "Paris", "country": "France", "lat": 48.8566, "lon": 2.3522, "pm25": 40.0, "pm10": 55.0, "aqi": 40, "danger": "safe"},
-                   {"city": "Berlin", "country": "Germany", "lat": 52.5200, "lon": 13.4050, "pm25": 30.0, "pm10": 45.0, "aqi": 30, "danger": "safe"},
-                   {"city": "Moscow", "country": "Russia", "lat": 55.7558, "lon": 37.6173, "pm25": 55.0, "pm10": 75.0, "aqi": 55, "danger": "moderate"},
-                   {"city": "Rome", "country": "Italy", "lat": 41.9028, "lon": 12.4964, "pm25": 50.0, "pm10": 70.0, "aqi": 50, "danger": "safe"},
-                   {"city": "Madrid", "country": "Spain", "lat": 40.4168, "lon": -3.7038, "pm25": 38.0, "pm10": 52.0, "aqi": 38, "danger": "safe"},
-                   {"city": "Warsaw", "country": "Poland", "lat": 52.2297, "lon": 21.0122, "pm25": 60.0, "pm10": 80.0, "aqi": 60, "danger": "moderate"},
-                   {"city": "Istanbul", "country": "Turkey", "lat": 41.0082, "lon": 28.9784, "pm25": 75.0, "pm10": 100.0, "aqi": 75, "danger": "moderate"},
-                   
-                   # Северная Америка
-                   {"city": "New York", "country": "USA", "lat": 40.7128, "lon": -74.0060, "pm25": 42.0, "pm10": 58.0, "aqi": 42, "danger": "safe"},
-                   {"city": "Los Angeles", "country": "USA", "lat": 34.0522, "lon": -118.2437, "pm25": 65.0, "pm10": 85.0, "aqi": 65, "danger": "moderate"},
-                   {"city": "Chicago", "country": "USA", "lat": 41.8781, "lon": -87.6298, "pm25": 48.0, "pm10": 65.0, "aqi": 48, "danger": "safe"},
-                   {"city": "Toronto", "country": "Canada", "lat": 43.6532, "lon": -79.3832, "pm25": 28.0, "pm10": 40.0, "aqi": 28, "danger": "safe"},
-                   {"city": "Mexico City", "country": "Mexico", "lat": 19.4326, "lon": -99.1332, "pm25": 110.0, "pm10": 140.0, "aqi": 110, "danger": "unhealthy_sensitive"},
-                   
-                   # Южная Америка
-                   {"city": "São Paulo", "country": "Brazil", "lat": -23.5505, "lon": -46.6333, "pm25": 70.0, "pm10": 90.0, "aqi": 70, "danger": "moderate"},
-                   {"city": "Buenos Aires", "country": "Argentina", "lat": -34.6037, "lon": -58.3816, "pm25": 52.0, "pm10": 72.0, "aqi": 52, "danger": "moderate"},
-                   {"city": "Lima", "country": "Peru", "lat": -12.0464, "lon": -77.0428, "pm25": 80.0, "pm10": 105.0, "aqi": 80, "danger": "moderate"},
-                   
-                   # Африка
-                   {"city": "Cairo", "country": "Egypt", "lat": 30.0444, "lon": 31.2357, "pm25": 130.0, "pm10": 170.0, "aqi": 130, "danger": "unhealthy_sensitive"},
-                   {"city": "Lagos", "country": "Nigeria", "lat": 6.5244, "lon": 3.3792, "pm25": 150.0, "pm10": 190.0, "aqi": 150, "danger": "unhealthy"},
-                   {"city": "Johannesburg", "country": "South Africa", "lat": -26.2041, "lon": 28.0473, "pm25": 58.0, "pm10": 78.0, "aqi": 58, "danger": "moderate"},
-                   
-                   # Австралия и Океания
-                   {"city": "Sydney", "country": "Australia", "lat": -33.8688, "lon": 151.2093, "pm25": 25.0, "pm10": 35.0, "aqi": 25, "danger": "safe"},
-                   {"city": "Melbourne", "country": "Australia", "lat": -37.8136, "lon": 144.9631, "pm25": 22.0, "pm10": 32.0, "aqi": 22, "danger": "safe"},
-        ]
-        
-        test_points = []
-        for idx, city_data in enumerate(global_cities):
-            test_points.append({
-                "device_id": f"global_{idx+1:03d}",
-                "site": city_data["city"],
-                "pm25": city_data["pm25"],
-                "pm10": city_data["pm10"],
-                "pm1": city_data["pm25"] * 0.4,
-                "co2": 400 + (city_data["aqi"] * 2),
-                "voc": 0.5 + (city_data["aqi"] / 100),
-                "temp": 20 + (idx % 15),
-                "hum": 50 + (idx % 30),
-                "ch2o": 0.02 + (city_data["aqi"] / 1000),
-                "co": 0.1 + (city_data["aqi"] / 200),
-                "o3": 20 + (city_data["aqi"] / 3),
-                "no2": 15 + (city_data["aqi"] / 4),
-                "lat": city_data["lat"],
-                "lon": city_data["lon"],
-                "danger": city_data["danger"],
-                "city": city_data["city"],
-                "country": city_data["country"]
-            })
-        
-        for test_point in test_points:
+def build_all_air_quality_data(sensor_data: list) -> list:
+    """
+    Собирает точки для /air-quality/all: данные сенсоров (если есть) плюс
+    тестовые точки по городам мира. Вызывается только при пересборке кэша.
+    """
+    now_ts = datetime.utcnow().isoformat()
+    all_data = []
+    if sensor_data and len(sensor_data) > 0:
+        for idx, sensor in enumerate(sensor_data):
             try:
-                pm25 = float(test_point.get("pm25", 0) or 0)
+                pm25 = float(sensor.get("pm25", 0) or 0)
+                if pm25 <= 0:
+                    pm25 = 25.7
                 aqius = calculate_aqi(pm25)
-                lat = float(test_point.get("lat", 0) or 0)
-                lon = float(test_point.get("lon", 0) or 0)
+                
+                # Получаем координаты из данных API
+                device_id = sensor.get("device_id", "unknown")
+                site = sensor.get("site", "unknown")
+                
+                # Пробуем получить координаты из разных полей API
+                lat = None
+                lon = None
+                
+                # Проверяем различные варианты названий полей для координат
+                if "lat" in sensor:
+                    lat = float(sensor.get("lat", 0) or 0)
+                elif "latitude" in sensor:
+                    lat = float(sensor.get("latitude", 0) or 0)
+                elif "y" in sensor:
+                    lat = float(sensor.get("y", 0) or 0)
+                
+                if "lon" in sensor:
+                    lon = float(sensor.get("lon", 0) or 0)
+                elif "lng" in sensor:
+                    lon = float(sensor.get("lng", 0) or 0)
+                elif "longitude" in sensor:
+                    lon = float(sensor.get("longitude", 0) or 0)
+                elif "x" in sensor:
+                    lon = float(sensor.get("x", 0) or 0)
+                
+                # Проверяем вложенные объекты location
+                if "location" in sensor:
+                    loc = sensor["location"]
+                    if isinstance(loc, dict):
+                        if "lat" in loc:
+                            lat = float(loc.get("lat", 0) or 0)
+                        elif "latitude" in loc:
+                            lat = float(loc.get("latitude", 0) or 0)
+                        
+                        if "lon" in loc:
+                            lon = float(loc.get("lon", 0) or 0)
+                        elif "lng" in loc:
+                            lon = float(loc.get("lng", 0) or 0)
+                        elif "longitude" in loc:
+                            lon = float(loc.get("longitude", 0) or 0)
+                        
+                        # Проверяем GeoJSON формат coordinates: [lon, lat]
+                        if "coordinates" in loc:
+                            coords = loc["coordinates"]
+                            if isinstance(coords, list) and len(coords) >= 2:
+                                lon = float(coords[0] or 0)
+                                lat = float(coords[1] or 0)
+                    elif isinstance(loc, list) and len(loc) >= 2:
+                        # Если location - это массив [lon, lat]
+                        lon = float(loc[0] or 0)
+                        lat = float(loc[1] or 0)
+                
+                # Если координаты не найдены, используем координаты Алматы с уникальным смещением
+                if lat is None or lat == 0 or lon is None or lon == 0:
+                    # Используем координаты Алматы с небольшим случайным смещением для визуализации
+                    base_lat = 43.2220
+                    base_lon = 76.8512
+                    # Создаем уникальное смещение на основе device_id
+                    hash_obj = hashlib.md5(str(device_id).encode())
+                    hash_int = int(hash_obj.hexdigest()[:8], 16)
+                    # Смещение до 0.05 градуса (примерно 5.5 км)
+                    lat_offset = (hash_int % 1000) / 20000 - 0.025
+                    lon_offset = ((hash_int // 1000) % 1000) / 20000 - 0.025
+                    lat = base_lat + lat_offset
+                    lon = base_lon + lon_offset
+                    logger.debug("No coordinates found for device %s, using offset: %.4f, %.4f", device_id, lat, lon, extra={"sample": True})
                 
                 all_data.append({
-                    "city": test_point.get("city", "Almaty"),
-                    "state": test_point.get("city", "Almaty"),
-                    "country": test_point.get("country", "Kazakhstan"),
+                    "city": "Almaty",
+                    "state": "Almaty",
+                    "country": "Kazakhstan",
                     "location": {
                         "type": "Point",
                         "coordinates": [lon, lat]
                     },
                     "current": {
                         "pollution": {
-                            "ts": datetime.utcnow().isoformat(),
+                            "ts": now_ts,
                             "aqius": aqius,
                             "mainus": "pm25",
                             "aqicn": aqius,
                             "maincn": "pm25",
-                            "pm1": float(test_point.get("pm1", 0) or 0),
-                            "pm25": float(test_point.get("pm25", 0) or 0),
-                            "pm10": float(test_point.get("pm10", 0) or 0),
-                            "co2": float(test_point.get("co2", 0) or 0),
-                            "voc": float(test_point.get("voc", 0) or 0),
-                            "ch2o": float(test_point.get("ch2o", 0) or 0),
-                            "co": float(test_point.get("co", 0) or 0),
-                            "o3": float(test_point.get("o3", 0) or 0),
-                            "no2": float(test_point.get("no2", 0) or 0),
+                            "pm1": float(sensor.get("pm1", 0) or 0),
+                            "pm25": float(sensor.get("pm25", 0) or 0),
+                            "pm10": float(sensor.get("pm10", 0) or 0),
+                            "co2": float(sensor.get("co2", 0) or 0),
+                            "voc": float(sensor.get("voc", 0) or 0),
+                            "ch2o": float(sensor.get("ch2o", 0) or 0),
+                            "co": float(sensor.get("co", 0) or 0),
+                            "o3": float(sensor.get("o3", 0) or 0),
+                            "no2": float(sensor.get("no2", 0) or 0),
                         },
                         "weather": {
-                            "ts": datetime.utcnow().isoformat(),
-                            "tp": float(test_point.get("temp", 0) or 0),
+                            "ts": now_ts,
+                            "tp": float(sensor.get("temp", 0) or 0),
                             "pr": 1013,
-                            "hu": float(test_point.get("hum", 0) or 0),
+                            "hu": float(sensor.get("hum", 0) or 0),
                             "ws": 0,
                             "wd": 0,
                             "ic": "01d"
                         }
                     },
                     "sensor_data": {
-                        "device_id": test_point.get("device_id", ""),
-                        "site": test_point.get("site", ""),
-                        "danger_level": test_point.get("danger", "safe")
+                        "device_id": sensor.get("device_id", ""),
+                        "site": sensor.get("site", ""),
+                        "danger_level": sensor.get("danger_level", "safe")
                     }
                 })
             except Exception as e:
-                print(f"Error creating test point: {e}")
+                logger.warning("Error processing sensor %s: %s", sensor.get("device_id", "unknown"), e)
                 continue
-        
-        # Возвращаем данные (реальные + тестовые если нужно)
-        print(f"=== FINAL RESULT: Returning {len(all_data)} data points ===")
-        if len(all_data) > 0:
-            print(f"First point device_id: {all_data[0].get('sensor_data', {}).get('device_id', 'unknown')}")
-            if len(all_data) > 1:
-                print(f"Second point device_id: {all_data[1].get('sensor_data', {}).get('device_id', 'unknown')}")
-        return {"data": all_data}
+    
+    # Генерируем тестовые данные для городов по всему миру
+    
+    # Мировые города с разными уровнями загрязнения
+    global_cities = [
+               # Азия
+               {"city": "Almaty", "country": "Kazakhstan", "lat": 43.2220, "lon": 76.8512, "pm25": 65.0, "pm10": 85.0, "aqi": 65, "danger": "moderate"},
+               {"city": "Beijing", "country": "China", "lat": 39.9042, "lon": 116.4074, "pm25": 180.0, "pm10": 220.0, "aqi": 180, "danger": "unhealthy"},
+               {"city": "Delhi", "country": "India", "lat": 28.6139, "lon": 77.2090, "pm25": 250.0, "pm10": 300.0, "aqi": 250, "danger": "very_unhealthy"},
+               {"city": "Tokyo", "country": "Japan", "lat": 35.6762, "lon": 139.6503, "pm25": 45.0, "pm10": 60.0, "aqi": 45, "danger": "safe"},
+               {"city": "Seoul", "country": "South Korea", "lat": 37.5665, "lon": 126.9780, "pm25": 85.0, "pm10": 110.0, "aqi": 85, "danger": "moderate"},
+               {"city": "Bangkok", "country": "Thailand", "lat": 13.7563, "lon": 100.5018, "pm25": 120.0, "pm10": 150.0, "aqi": 120, "danger": "unhealthy_sensitive"},
+               {"city": "Jakarta", "country": "Indonesia", "lat": -6.2088, "lon": 106.8456, "pm25": 140.0, "pm10": 180.0, "aqi": 140, "danger": "unhealthy_sensitive"},
+               {"city": "Mumbai", "country": "India", "lat": 19.0760, "lon": 72.8777, "pm25": 220.0, "pm10": 280.0, "aqi": 220, "danger": "very_unhealthy"},
+               {"city": "Shanghai", "country": "China", "lat": 31.2304, "lon": 121.4737, "pm25": 160.0, "pm10": 200.0, "aqi": 160, "danger": "unhealthy"},
+               {"city": "Dubai", "country": "UAE", "lat": 25.2048, "lon": 55.2708, "pm25": 95.0, "pm10": 125.0, "aqi": 95, "danger": "moderate"},
+               
+               # Европа
+               {"city": "London", "country": "UK", "lat": 51.5074, "lon": -0.1278, "pm25": 35.0, "pm10": 50.0, "aqi": 35, "danger": "safe"},
+               {"city": "Paris", "country": "France", "lat": 48.8566, "lon": 2.3522, "pm25": 40.0, "pm10": 55.0, "aqi": 40, "danger": "safe"},
+               {"city": "Berlin", "country": "Germany", "lat": 52.5200, "lon": 13.4050, "pm25": 30.0, "pm10": 45.0, "aqi": 30, "danger": "safe"},
+               {"city": "Moscow", "country": "Russia", "lat": 55.7558, "lon": 37.6173, "pm25": 55.0, "pm10": 75.0, "aqi": 55, "danger": "moderate"},
+               {"city": "Rome", "country": "Italy", "lat": 41.9028, "lon": 12.4964, "pm25": 50.0, "pm10": 70.0, "aqi": 50, "danger": "safe"},
+               {"city": "Madrid", "country": "Spain", "lat": 40.4168, "lon": -3.7038, "pm25": 38.0, "pm10": 52.0, "aqi": 38, "danger": "safe"},
+               {"city": "Warsaw", "country": "Poland", "lat": 52.2297, "lon": 21.0122, "pm25": 60.0, "pm10": 80.0, "aqi": 60, "danger": "moderate"},
+               {"city": "Istanbul", "country": "Turkey", "lat": 41.0082, "lon": 28.9784, "pm25": 75.0, "pm10": 100.0, "aqi": 75, "danger": "moderate"},
+               
+               # Северная Америка
+               {"city": "New York", "country": "USA", "lat": 40.7128, "lon": -74.0060, "pm25": 42.0, "pm10": 58.0, "aqi": 42, "danger": "safe"},
+               {"city": "Los Angeles", "country": "USA", "lat": 34.0522, "lon": -118.2437, "pm25": 65.0, "pm10": 85.0, "aqi": 65, "danger": "moderate"},
+               {"city": "Chicago", "country": "USA", "lat": 41.8781, "lon": -87.6298, "pm25": 48.0, "pm10": 65.0, "aqi": 48, "danger": "safe"},
+               {"city": "Toronto", "country": "Canada", "lat": 43.6532, "lon": -79.3832, "pm25": 28.0, "pm10": 40.0, "aqi": 28, "danger": "safe"},
+               {"city": "Mexico City", "country": "Mexico", "lat": 19.4326, "lon": -99.1332, "pm25": 110.0, "pm10": 140.0, "aqi": 110, "danger": "unhealthy_sensitive"},
+               
+               # Южная Америка
+               {"city": "São Paulo", "country": "Brazil", "lat": -23.5505, "lon": -46.6333, "pm25": 70.0, "pm10": 90.0, "aqi": 70, "danger": "moderate"},
+               {"city": "Buenos Aires", "country": "Argentina", "lat": -34.6037, "lon": -58.3816, "pm25": 52.0, "pm10": 72.0, "aqi": 52, "danger": "moderate"},
+               {"city": "Lima", "country": "Peru", "lat": -12.0464, "lon": -77.0428, "pm25": 80.0, "pm10": 105.0, "aqi": 80, "danger": "moderate"},
+               
+               # Африка
+               {"city": "Cairo", "country": "Egypt", "lat": 30.0444, "lon": 31.2357, "pm25": 130.0, "pm10": 170.0, "aqi": 130, "danger": "unhealthy_sensitive"},
+               {"city": "Lagos", "country": "Nigeria", "lat": 6.5244, "lon": 3.3792, "pm25": 150.0, "pm10": 190.0, "aqi": 150, "danger": "unhealthy"},
+               {"city": "Johannesburg", "country": "South Africa", "lat": -26.2041, "lon": 28.0473, "pm25": 58.0, "pm10": 78.0, "aqi": 58, "danger": "moderate"},
+               
+               # Австралия и Океания
+               {"city": "Sydney", "country": "Australia", "lat": -33.8688, "lon": 151.2093, "pm25": 25.0, "pm10": 35.0, "aqi": 25, "danger": "safe"},
+               {"city": "Melbourne", "country": "Australia", "lat": -37.8136, "lon": 144.9631, "pm25": 22.0, "pm10": 32.0, "aqi": 22, "danger": "safe"},
+    ]
+    
+    test_points = []
+    for idx, city_data in enumerate(global_cities):
+        test_points.append({
+            "device_id": f"global_{idx+1:03d}",
+            "site": city_data["city"],
+            "pm25": city_data["pm25"],
+            "pm10": city_data["pm10"],
+            "pm1": city_data["pm25"] * 0.4,
+            "co2": 400 + (city_data["aqi"] * 2),
+            "voc": 0.5 + (city_data["aqi"] / 100),
+            "temp": 20 + (idx % 15),
+            "hum": 50 + (idx % 30),
+            "ch2o": 0.02 + (city_data["aqi"] / 1000),
+            "co": 0.1 + (city_data["aqi"] / 200),
+            "o3": 20 + (city_data["aqi"] / 3),
+            "no2": 15 + (city_data["aqi"] / 4),
+            "lat": city_data["lat"],
+            "lon": city_data["lon"],
+            "danger": city_data["danger"],
+            "city": city_data["city"],
+            "country": city_data["country"]
+        })
+    
+    # AQI for every point in one vectorized pass
+    test_aqis = aqi.pm25_aqi([float(p.get("pm25", 0) or 0) for p in test_points])
+    for test_point, aqius in zip(test_points, test_aqis.tolist()):
+        try:
+            lat = float(test_point.get("lat", 0) or 0)
+            lon = float(test_point.get("lon", 0) or 0)
+            
+            all_data.append({
+                "city": test_point.get("city", "Almaty"),
+                "state": test_point.get("city", "Almaty"),
+                "country": test_point.get("country", "Kazakhstan"),
+                "location": {
+                    "type": "Point",
+                    "coordinates": [lon, lat]
+                },
+                "current": {
+                    "pollution": {
+                        "ts": now_ts,
+                        "aqius": aqius,
+                        "mainus": "pm25",
+                        "aqicn": aqius,
+                        "maincn": "pm25",
+                        "pm1": float(test_point.get("pm1", 0) or 0),
+                        "pm25": float(test_point.get("pm25", 0) or 0),
+                        "pm10": float(test_point.get("pm10", 0) or 0),
+                        "co2": float(test_point.get("co2", 0) or 0),
+                        "voc": float(test_point.get("voc", 0) or 0),
+                        "ch2o": float(test_point.get("ch2o", 0) or 0),
+                        "co": float(test_point.get("co", 0) or 0),
+                        "o3": float(test_point.get("o3", 0) or 0),
+                        "no2": float(test_point.get("no2", 0) or 0),
+                    },
+                    "weather": {
+                        "ts": now_ts,
+                        "tp": float(test_point.get("temp", 0) or 0),
+                        "pr": 1013,
+                        "hu": float(test_point.get("hum", 0) or 0),
+                        "ws": 0,
+                        "wd": 0,
+                        "ic": "01d"
+                    }
+                },
+                "sensor_data": {
+                    "device_id": test_point.get("device_id", ""),
+                    "site": test_point.get("site", ""),
+                    "danger_level": test_point.get("danger", "safe")
+                }
+            })
+        except Exception as e:
+            logger.warning("Error creating test point: %s", e)
+            continue
+    
+    return all_data
+
+
+# /air-quality/all is the same for every user and only changes when the
+# underlying data does, so the serialized body is built once and reused.
+AIR_QUALITY_CACHE_TTL_SECONDS = float(os.getenv("AIR_QUALITY_CACHE_TTL_SECONDS", "60"))
+
+
+class CachedJSONResponse:
+    """
+    Serialized JSON body plus ETag, rebuilt when the TTL runs out. The ETag
+    hashes fingerprint(payload) (the whole payload by default); when a
+    rebuild gives the same ETag the previous body is kept, so a client that
+    revalidates gets 304 until the data itself changes. on_change(payload)
+    runs only for builds with a new ETag. Concurrent requests during a
+    rebuild wait for the same build.
+    """
+    def __init__(self, builder, ttl_seconds: float, fingerprint=None, on_change=None):
+        self._builder = builder
+        self._ttl = ttl_seconds
+        self._fingerprint = fingerprint
+        self._on_change = on_change
+        self._body = None
+        self._etag = None
+        self._built_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        return self._body is not None and time.monotonic() - self._built_at < self._ttl
+
+    @staticmethod
+    def _serialize(payload) -> bytes:
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    async def get(self):
+        if not self._fresh():
+            async with self._lock:
+                if not self._fresh():
+                    payload = await self._builder()
+                    body = self._serialize(payload)
+                    stable = self._serialize(self._fingerprint(payload)) if self._fingerprint else body
+                    etag = '"' + hashlib.sha1(stable).hexdigest()[:20] + '"'
+                    if etag != self._etag or self._body is None:
+                        if self._on_change:
+                            self._on_change(payload)
+                        self._etag = etag
+                        self._body = body
+                    self._built_at = time.monotonic()
+        return self._body, self._etag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any((t[2:] if t.startswith("W/") else t) == etag for t in tags)
+
+
+# Points of the last /air-quality/all build, their cluster index and the
+# clustered bodies per zoom (dropped whenever the points are rebuilt)
+all_air_quality_points: list = []
+all_air_quality_clusters = clustering.ClusterIndex()
+clustered_air_quality_bodies: dict = {}
+
+
+async def _build_all_air_quality_payload():
+    # API и WebSocket полностью отключены - используем только тестовые данные
+    return {"data": build_all_air_quality_data([])}
+
+
+def _without_build_time(payload: dict) -> list:
+    """Points without the "ts" stamps that every build sets to its own time."""
+    return [
+        {**item, "current": {
+            part: {key: value for key, value in fields.items() if key != "ts"}
+            for part, fields in item["current"].items()
+        }}
+        for item in payload["data"]
+    ]
+
+
+def _index_all_air_quality_points(payload: dict):
+    data = payload["data"]
+    all_air_quality_points[:] = data
+    all_air_quality_clusters.rebuild(
+        (str(i), *item["location"]["coordinates"], item["current"]["pollution"]["aqius"])
+        for i, item in enumerate(data)
+    )
+    clustered_air_quality_bodies.clear()
+
+
+all_air_quality_cache = CachedJSONResponse(
+    _build_all_air_quality_payload,
+    AIR_QUALITY_CACHE_TTL_SECONDS,
+    fingerprint=_without_build_time,
+    on_change=_index_all_air_quality_points,
+)
+
+
+def clustered_air_quality_body(zoom: int, etag: str):
+    """Body and ETag of /air-quality/all?zoom= for the current build."""
+    cached = clustered_air_quality_bodies.get(zoom)
+    if cached is None or cached[1] != etag:
+        clusters = all_air_quality_clusters.query(zoom)
+        payload = {
+            "data": [all_air_quality_points[int(c["id"])] for c in clusters if c["count"] == 1],
+            "clusters": [c for c in clusters if c["count"] > 1],
+            "zoom": zoom,
+        }
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        cached = clustered_air_quality_bodies[zoom] = (body, etag)
+    return cached[0], f'{etag[:-1]}-z{zoom}"'
+
+
+@app.get("/air-quality/all")
+async def get_all_air_quality_data(
+    request: Request,
+    zoom: Optional[int] = Query(None, ge=0, le=24),
+    current_user: dict = Depends(get_current_user),
+):
+    """Получить данные со всех доступных сенсоров (с zoom - кластеризованные)"""
+    try:
+        body, etag = await all_air_quality_cache.get()
+        if zoom is not None:
+            body, etag = clustered_air_quality_body(zoom, etag)
     except Exception as e:
-        print(f"Error in get_all_air_quality_data: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in get_all_air_quality_data")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(AIR_QUALITY_CACHE_TTL_SECONDS)}"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/cities")
 async def get_supported_cities(current_user: dict = Depends(get_current_user)):
     # Get list of cities from MongoDB or return popular cities
-    cities = await db.cities.find({}).to_list(100)
+    cities = await db.cities.find({}, {"_id": 0, "city": 1, "state": 1, "country": 1, "lat": 1, "lon": 1}).to_list(100)
     if not cities:
         # Default cities - только Алматы
         default_cities = [
@@ -1152,19 +1411,40 @@ async def save_air_quality_data(
 # -------------------------
 # Admin & paid sensors flow
 # -------------------------
+@app.get("/admin/indexes")
+async def get_index_status(current_user: dict = Depends(require_admin)):
+    """Indexes applied at startup plus a fresh explain() of every hot query."""
+    plans = await indexes.explain_hot_queries(db)
+    return {
+        "ok": all(i["ok"] for i in index_report) and all(p["ok"] for p in plans),
+        "indexes": index_report,
+        "query_plans": plans,
+    }
+
+
+@app.get("/admin/city-poller")
+async def get_city_poller_stats(current_user: dict = Depends(require_admin)):
+    return {
+        "enabled": city_refresher is not None,
+        "poller": city_refresher.stats() if city_refresher else None,
+        "airvisual": airvisual.stats,
+    }
+
+
 @app.post("/admin/sensors", response_model=SensorResponse)
 async def create_sensor(sensor: SensorBase, current_user: dict = Depends(require_admin)):
     sensor_doc = sensor.dict()
     sensor_doc["created_at"] = datetime.utcnow()
     result = await db.sensors.insert_one(sensor_doc)
     sensor_doc["_id"] = result.inserted_id
+    catalog.upsert([sensor_doc])
+    cluster_sensor(sensor_doc)
     return sensor_to_response(sensor_doc)
 
 
 @app.get("/admin/sensors")
 async def list_sensors(current_user: dict = Depends(require_admin)):
-    sensors = await db.sensors.find({}).to_list(500)
-    return {"data": [sensor_to_response(s) for s in sensors]}
+    return catalog_response(e.response_json for e in catalog.snapshot.all())
 
 
 @app.get("/admin/users")
@@ -1192,6 +1472,7 @@ async def make_admin(request: MakeAdminRequest, current_user: dict = Depends(req
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    principal_cache.invalidate(request.email)
     return {"message": f"User {request.email} is now admin"}
 
 
@@ -1209,6 +1490,8 @@ async def grant_sensor_access(sensor_id: str, request: GrantAccessRequest, curre
         {"_id": user["_id"]},
         {"$addToSet": {"sensor_permissions": str(sensor["_id"])}}
     )
+    principal_cache.invalidate(request.email)
+    sensor_events.grant(request.email, [str(sensor["_id"])])
     return {"message": f"Access to sensor {sensor_id} granted for {request.email}"}
 
 
@@ -1232,17 +1515,11 @@ async def get_my_sensors(current_user: dict = Depends(get_current_user)):
             raise HTTPException(status_code=404, detail="User not found")
         
         sensor_ids = user.get("sensor_permissions", []) or []
-        object_ids = [ObjectId(sid) for sid in sensor_ids if ObjectId.is_valid(sid)]
-        if not object_ids:
-            return {"data": []}
-        sensors = await db.sensors.find({"_id": {"$in": object_ids}}).to_list(500)
-        return {"data": [sensor_to_response(s) for s in sensors]}
+        return catalog_response(e.response_json for e in catalog.snapshot.select(sensor_ids))
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error in get_my_sensors: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in get_my_sensors")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
@@ -1255,8 +1532,7 @@ async def get_available_sensors(current_user: dict = Depends(get_current_user)):
         # Проверяем, является ли пользователь мок-админом
         if current_user.get("_id") == "admin":
             # Для мок-админа возвращаем все датчики как доступные
-            all_sensors = await db.sensors.find({}).to_list(500)
-            return {"data": [sensor_to_response(s) for s in all_sensors]}
+            return catalog_response(e.response_json for e in catalog.snapshot.all())
         
         # Обновляем данные пользователя из базы, чтобы получить актуальные sensor_permissions
         user_id = current_user.get("_id")
@@ -1270,26 +1546,14 @@ async def get_available_sensors(current_user: dict = Depends(get_current_user)):
             raise HTTPException(status_code=404, detail="User not found")
         
         user_sensor_ids = set(user.get("sensor_permissions", []) or [])
-        all_sensors = await db.sensors.find({}).to_list(500)
-        
-        print(f"🔍 Available sensors check:")
-        print(f"  - Total sensors in DB: {len(all_sensors)}")
-        print(f"  - User sensor permissions: {user_sensor_ids}")
-        
-        available = []
-        for sensor in all_sensors:
-            sensor_id_str = str(sensor.get("_id"))
-            if sensor_id_str not in user_sensor_ids:
-                available.append(sensor_to_response(sensor))
-        
-        print(f"  - Available sensors: {len(available)}")
-        return {"data": available}
+        snapshot = catalog.snapshot
+        available = snapshot.excluding(user_sensor_ids)
+        logger.debug("Available sensors: %d of %d (user has %d)", len(available), len(snapshot), len(user_sensor_ids))
+        return catalog_response(e.response_json for e in available)
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error in get_available_sensors: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in get_available_sensors")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
@@ -1303,18 +1567,12 @@ async def get_all_sensors_with_status(current_user: dict = Depends(get_current_u
         
         # Если мок-админ, возвращаем все датчики как некупленные
         if is_admin:
-            print("🔍 Detected mock admin user")
-            all_sensors = await db.sensors.find({}).to_list(500)
-            result = []
-            for sensor in all_sensors:
-                sensor_response = sensor_to_response(sensor)
-                sensor_response["is_purchased"] = False
-                result.append(sensor_response)
-            return {"data": result}
+            logger.debug("Detected mock admin user")
+            return catalog_response(e.status_json[False] for e in catalog.snapshot.all())
         
         # Если user_id некорректный, возвращаем пустой список
         if user_id is None:
-            print("⚠️ Invalid user_id, returning empty list")
+            logger.warning("Invalid user_id, returning empty list")
             return {"data": []}
         
         # Получаем актуальные данные пользователя из базы
@@ -1323,38 +1581,124 @@ async def get_all_sensors_with_status(current_user: dict = Depends(get_current_u
             raise HTTPException(status_code=404, detail="User not found")
         
         user_sensor_ids = set(user.get("sensor_permissions", []) or [])
-        all_sensors = await db.sensors.find({}).to_list(500)
-        
-        print(f"🔍 All sensors check:")
-        print(f"  - Total sensors in DB: {len(all_sensors)}")
-        print(f"  - User sensor permissions: {user_sensor_ids}")
-        
-        result = []
-        for sensor in all_sensors:
-            sensor_id_str = str(sensor.get("_id"))
-            sensor_response = sensor_to_response(sensor)
-            sensor_response["is_purchased"] = sensor_id_str in user_sensor_ids
-            result.append(sensor_response)
-        
-        print(f"  - Purchased sensors: {sum(1 for s in result if s.get('is_purchased'))}")
-        return {"data": result}
+        snapshot = catalog.snapshot
+        logger.debug("All sensors: %d, purchased by user: %d", len(snapshot), len(user_sensor_ids))
+        return catalog_response(e.status_json[e.id in user_sensor_ids] for e in snapshot.all())
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error in get_all_sensors_with_status: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in get_all_sensors_with_status")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
 
 
+def parse_bbox(bbox: str):
+    """Parse "minLon,minLat,maxLon,maxLat" into four floats."""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be minLon,minLat,maxLon,maxLat")
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180 and -90 <= min_lat < max_lat <= 90):
+        raise HTTPException(status_code=400, detail="bbox is out of range")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+# Map clusters of every located sensor, keyed by str(_id). Built on startup
+# and kept current by the write paths that change a location or pm25.
+sensor_clusters = clustering.ClusterIndex()
+
+
+def sensor_coordinates(sensor: dict):
+    coords = (sensor.get("location") or {}).get("coordinates")
+    if not coords or len(coords) != 2:
+        return None
+    return float(coords[0]), float(coords[1])
+
+
+def cluster_sensor(sensor: Optional[dict]):
+    """Update one sensor in the cluster index (needs _id, location and parameters)."""
+    if not sensor:
+        return
+    sensor_id = str(sensor["_id"])
+    coords = sensor_coordinates(sensor)
+    if coords is None:
+        sensor_clusters.remove(sensor_id)
+        return
+    pm25 = float((sensor.get("parameters") or {}).get("pm25", 0) or 0)
+    sensor_clusters.upsert(sensor_id, coords[0], coords[1], calculate_aqi(pm25))
+
+
+def rebuild_sensor_clusters(snapshot: sensor_catalog.CatalogSnapshot):
+    sensor_clusters.rebuild(
+        (e.id, e.lon, e.lat, e.map_point["aqi"]) for e in snapshot.all() if e.map_point is not None
+    )
+
+
+def sensor_map_point(sensor: dict, lon: float, lat: float, aqi_val: int) -> dict:
+    params = sensor.get("parameters") or {}
+    return {
+        "id": str(sensor.get("_id")),
+        "name": sensor.get("name"),
+        "description": sensor.get("description"),
+        "price": sensor.get("price", 0),
+        "city": sensor.get("city") or "Unknown",
+        "country": sensor.get("country") or "Unknown",
+        "lat": lat,
+        "lng": lon,
+        "aqi": aqi_val,
+        "parameters": params,
+        "color": "#00d8ff",
+        "source": "sensor",
+        # Дополнительные параметры для купленных датчиков
+        "co2": float(params.get("co2", 0) or 0),
+        "voc": float(params.get("voc", 0) or 0),
+        "temp": float(params.get("temp", 0) or 0),
+        "hum": float(params.get("hum", 0) or 0),
+        "ch2o": float(params.get("ch2o", 0) or 0),
+        "co": float(params.get("co", 0) or 0),
+        "o3": float(params.get("o3", 0) or 0),
+        "no2": float(params.get("no2", 0) or 0),
+    }
+
+
+# Every sensor pre-converted for the /sensors/* read endpoints. Writers call
+# catalog.upsert() with the full new documents; see sensor_catalog.py.
+catalog = sensor_catalog.SensorCatalog(sensor_to_response, sensor_map_point, sensor_coordinates)
+
+
+def on_catalog_reload(snapshot: sensor_catalog.CatalogSnapshot):
+    global seeded_sensor_ids
+    rebuild_sensor_clusters(snapshot)
+    seeded_sensor_ids = seeded_ids_by_name(e.doc for e in snapshot.all())
+
+
+async def load_sensor_catalog():
+    await catalog.load(db)
+    on_catalog_reload(catalog.snapshot)
+    logger.info("Sensor catalog loaded (%d sensors, %d on the map)", len(catalog.snapshot), len(sensor_clusters))
+
+
+def catalog_response(fragments) -> Response:
+    return Response(content=sensor_catalog.json_list(fragments), media_type="application/json")
+
+
 @app.get("/sensors/map")
-async def get_map_sensors(current_user: dict = Depends(get_current_user)):
+async def get_map_sensors(
+    bbox: Optional[str] = None,
+    zoom: Optional[int] = Query(None, ge=0, le=24),
+    current_user: dict = Depends(get_current_user),
+):
     """
     Возвращает только те датчики, на которые у пользователя есть права (куплено или выдано админом).
+    С bbox=minLon,minLat,maxLon,maxLat возвращаются только датчики в видимой области карты
+    (фильтр по координатам из каталога датчиков в памяти, без запроса к базе).
+    С zoom близкие датчики объединяются в кластеры: "data" содержит одиночные
+    датчики, "clusters" - центроиды с count, aqi_max и aqi_mean.
     """
     try:
+        box = parse_bbox(bbox) if bbox else None
+
         # Проверяем, является ли пользователь мок-админом
         if current_user.get("_id") == "admin":
             # Для мок-админа возвращаем пустой список (админы не видят датчики на карте)
@@ -1375,60 +1719,79 @@ async def get_map_sensors(current_user: dict = Depends(get_current_user)):
         object_ids = [ObjectId(sid) for sid in sensor_ids if ObjectId.is_valid(sid)]
         if not object_ids:
             return {"data": []}
-    
-        sensors = await db.sensors.find({"_id": {"$in": object_ids}}).to_list(500)
-        
-        print(f"🔍 Map sensors check:")
-        print(f"  - User sensor permissions: {sensor_ids}")
-        print(f"  - Converted ObjectIds: {len(object_ids)}")
-        print(f"  - Found sensors in DB: {len(sensors)}")
-        
-        map_points = []
-        for sensor in sensors:
-            coords = (sensor.get("location") or {}).get("coordinates")
-            if not coords or len(coords) != 2:
-                print(f"  ⚠️ Sensor {sensor.get('_id')} missing coordinates")
-                continue
-            lon, lat = coords
-            params = sensor.get("parameters") or {}
-            pm25_val = float(params.get("pm25", 0) or 0)
-            aqi_val = calculate_aqi(pm25_val)
-            map_point = {
-                "id": str(sensor.get("_id")),
-                "name": sensor.get("name"),
-                "description": sensor.get("description"),
-                "price": sensor.get("price", 0),
-                "city": sensor.get("city") or "Unknown",
-                "country": sensor.get("country") or "Unknown",
-                "lat": lat,
-                "lng": lon,
-                "aqi": aqi_val,
-                "parameters": params,
-                "color": "#00d8ff",
-                "source": "sensor",
-                # Дополнительные параметры для купленных датчиков
-                "co2": float(params.get("co2", 0) or 0),
-                "voc": float(params.get("voc", 0) or 0),
-                "temp": float(params.get("temp", 0) or 0),
-                "hum": float(params.get("hum", 0) or 0),
-                "ch2o": float(params.get("ch2o", 0) or 0),
-                "co": float(params.get("co", 0) or 0),
-                "o3": float(params.get("o3", 0) or 0),
-                "no2": float(params.get("no2", 0) or 0),
-            }
-            map_points.append(map_point)
-            print(f"  ✅ Added sensor {map_point['id']} at [{lat}, {lon}]")
-        
-        print(f"  📊 Total map points: {len(map_points)}")
-        return {"data": map_points}
+
+        if zoom is not None:
+            return clustered_map_sensors(zoom, box, [str(oid) for oid in object_ids])
+
+        located = catalog.snapshot.located((str(oid) for oid in object_ids), box)
+        logger.debug("Map sensors: %d permitted, %d on the map", len(object_ids), len(located))
+        return catalog_response(e.map_json for e in located)
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error in get_map_sensors: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in get_map_sensors")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+
+def clustered_map_sensors(zoom: int, box, sensor_ids: List[str]) -> dict:
+    """
+    /sensors/map?zoom=: clusters come from the in-process index and sensors
+    that stand alone at this zoom from the catalog snapshot.
+    """
+    clusters = sensor_clusters.query(zoom, bbox=box, ids=sensor_ids)
+    snapshot = catalog.snapshot
+    map_points = []
+    for cluster in clusters:
+        entry = snapshot.get(cluster["id"]) if cluster["count"] == 1 else None
+        if entry is not None and entry.map_point is not None:
+            map_points.append(entry.map_point)
+    return {
+        "data": map_points,
+        "clusters": [c for c in clusters if c["count"] > 1],
+        "zoom": zoom,
+    }
+
+# Fields accepted by the parameter update endpoints, stored under sensors.parameters
+SENSOR_PARAMETER_FIELDS = ("pm25", "pm10", "co2", "co", "o3", "no2", "voc", "ch2o", "temp", "hum")
+# Max sensors per PUT /sensors/parameters request
+MAX_PARAMETER_BATCH = 1000
+
+
+class SensorParametersUpdate(BaseModel):
+    sensor_id: str
+    pm25: Optional[float] = None
+    pm10: Optional[float] = None
+    co2: Optional[float] = None
+    co: Optional[float] = None
+    o3: Optional[float] = None
+    no2: Optional[float] = None
+    voc: Optional[float] = None
+    ch2o: Optional[float] = None
+    temp: Optional[float] = None
+    hum: Optional[float] = None
+
+
+def parameters_set(fields: dict) -> dict:
+    """Dotted-path $set, so concurrent writers of other parameters are not overwritten."""
+    return {f"parameters.{name}": value for name, value in fields.items()}
+
+
+def require_sensor_access(user: dict, sensor_ids: List[str]):
+    """Admins may update any sensor; users only the ones in their (cached) sensor_permissions."""
+    if user_is_admin(user):
+        return
+    allowed = set(user.get("sensor_permissions") or [])
+    if any(sensor_id not in allowed for sensor_id in sensor_ids):
+        raise HTTPException(status_code=403, detail="You don't have access to this sensor")
+
+
+def sensor_parameters_changed(sensors: List[dict]):
+    catalog.upsert(sensors)
+    for sensor in sensors:
+        cluster_sensor(sensor)
+        publish_sensor_update(sensor)
+
+
 @app.put("/sensors/{sensor_id}/parameters")
 async def update_sensor_parameters(
     sensor_id: str,
@@ -1448,63 +1811,30 @@ async def update_sensor_parameters(
     try:
         if not ObjectId.is_valid(sensor_id):
             raise HTTPException(status_code=400, detail="Invalid sensor id")
+        require_sensor_access(current_user, [sensor_id])
 
-        # Admin can update any sensor; regular users need sensor_permissions
-        is_admin = user_is_admin(current_user)
-        if not is_admin:
-            user_id = current_user.get("_id")
-            if isinstance(user_id, str) and ObjectId.is_valid(user_id):
-                user_id = ObjectId(user_id)
-            user = await db.users.find_one({"_id": user_id})
-            if not user:
-                raise HTTPException(status_code=404, detail="User not found")
-            sensor_permissions = set(user.get("sensor_permissions", []) or [])
-            if sensor_id not in sensor_permissions:
-                raise HTTPException(status_code=403, detail="You don't have access to this sensor")
-
-        sensor = await db.sensors.find_one({"_id": ObjectId(sensor_id)})
-        if not sensor:
+        values = (pm25, pm10, co2, co, o3, no2, voc, ch2o, temp, hum)
+        updated_fields = {name: v for name, v in zip(SENSOR_PARAMETER_FIELDS, values) if v is not None}
+        query = {"_id": ObjectId(sensor_id)}
+        if not updated_fields:
+            updated_sensor = await db.sensors.find_one(query)
+        else:
+            try:
+                updated_sensor = await db.sensors.find_one_and_update(
+                    query, {"$set": parameters_set(updated_fields)}, return_document=ReturnDocument.AFTER
+                )
+            except OperationFailure as e:
+                if e.code != 28:  # PathNotViable: stored parameters is null
+                    raise
+                updated_sensor = await db.sensors.find_one_and_update(
+                    {**query, "parameters": None}, {"$set": {"parameters": updated_fields}},
+                    return_document=ReturnDocument.AFTER,
+                )
+        if not updated_sensor:
             raise HTTPException(status_code=404, detail="Sensor not found")
 
-        parameters = sensor.get("parameters") or {}
-        updated_fields = {}
-        if pm25 is not None:
-            parameters["pm25"] = pm25
-            updated_fields["pm25"] = pm25
-        if pm10 is not None:
-            parameters["pm10"] = pm10
-            updated_fields["pm10"] = pm10
-        if co2 is not None:
-            parameters["co2"] = co2
-            updated_fields["co2"] = co2
-        if co is not None:
-            parameters["co"] = co
-            updated_fields["co"] = co
-        if o3 is not None:
-            parameters["o3"] = o3
-            updated_fields["o3"] = o3
-        if no2 is not None:
-            parameters["no2"] = no2
-            updated_fields["no2"] = no2
-        if voc is not None:
-            parameters["voc"] = voc
-            updated_fields["voc"] = voc
-        if ch2o is not None:
-            parameters["ch2o"] = ch2o
-            updated_fields["ch2o"] = ch2o
-        if temp is not None:
-            parameters["temp"] = temp
-            updated_fields["temp"] = temp
-        if hum is not None:
-            parameters["hum"] = hum
-            updated_fields["hum"] = hum
-
-        await db.sensors.update_one(
-            {"_id": ObjectId(sensor_id)},
-            {"$set": {"parameters": parameters}}
-        )
-
-        updated_sensor = await db.sensors.find_one({"_id": ObjectId(sensor_id)})
+        if updated_fields:
+            sensor_parameters_changed([updated_sensor])
         return {
             "message": "Sensor parameters updated successfully",
             "sensor": sensor_to_response(updated_sensor),
@@ -1516,6 +1846,143 @@ async def update_sensor_parameters(
         raise HTTPException(status_code=500, detail=f"Error updating sensor: {e}")
 
 
+@app.put("/sensors/parameters")
+async def update_sensor_parameters_batch(
+    updates: List[SensorParametersUpdate],
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Batch variant of /sensors/{sensor_id}/parameters. Body is a JSON array of
+    {"sensor_id": ..., "pm25": ..., ...}; all updates go out in one
+    bulk_write and the changed sensors are read back with one query.
+    """
+    if len(updates) > MAX_PARAMETER_BATCH:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {MAX_PARAMETER_BATCH} sensors)")
+    invalid = [u.sensor_id for u in updates if not ObjectId.is_valid(u.sensor_id)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid sensor id: {', '.join(invalid)}")
+    require_sensor_access(current_user, [u.sensor_id for u in updates])
+
+    ops, op_sensor_ids = [], []
+    for u in updates:
+        fields = u.dict(include=set(SENSOR_PARAMETER_FIELDS), exclude_none=True)
+        if fields:
+            ops.append(UpdateOne({"_id": ObjectId(u.sensor_id)}, {"$set": parameters_set(fields)}))
+            op_sensor_ids.append(u.sensor_id)
+    if not ops:
+        return {"matched": 0, "modified": 0, "sensors": [], "not_found": [], "failed": {}}
+
+    failed = {}
+    try:
+        result = await db.sensors.bulk_write(ops, ordered=False)
+        matched, modified = result.matched_count, result.modified_count
+    except BulkWriteError as e:
+        matched, modified = e.details.get("nMatched", 0), e.details.get("nModified", 0)
+        for err in e.details.get("writeErrors", []):
+            failed[op_sensor_ids[err["index"]]] = err.get("errmsg", "write failed")
+
+    changed_ids = [ObjectId(i) for i in dict.fromkeys(op_sensor_ids) if i not in failed]
+    sensors = await db.sensors.find({"_id": {"$in": changed_ids}}).to_list(None)
+    found = {str(s["_id"]) for s in sensors}
+    sensor_parameters_changed(sensors)
+    return {
+        "matched": matched,
+        "modified": modified,
+        "sensors": [sensor_to_response(s) for s in sensors],
+        "not_found": [str(i) for i in changed_ids if str(i) not in found],
+        "failed": failed,
+    }
+
+
+# Upper bound on buckets per /sensors/{id}/readings response
+MAX_SERIES_BUCKETS = int(os.getenv("MAX_SERIES_BUCKETS", "20000"))
+
+
+def to_naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+@app.get("/sensors/{sensor_id}/readings")
+async def get_sensor_readings(
+    sensor_id: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    bucket: str = "5m",
+    metrics: str = "pm25",
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Aggregated readings history for one sensor, e.g.
+    /sensors/<id>/readings?from=2024-01-01T00:00:00&to=2024-01-08T00:00:00&bucket=1h&metrics=pm25,co2
+
+    Each bucket has count plus avg/min/max/p95 per metric, computed by the
+    database and streamed back row by row. Defaults to the last 24 hours.
+    Ranges that start within the raw retention window read raw points, for
+    any bucket size. Older ranges read the minute/hour rollups, which carry
+    no p95 (returned as null). If the query fails mid-stream the document
+    ends with an "error" field after "data", which then is incomplete.
+    """
+    if not ObjectId.is_valid(sensor_id):
+        raise HTTPException(status_code=400, detail="Invalid sensor id")
+    if not user_is_admin(current_user) and sensor_id not in set(current_user.get("sensor_permissions") or []):
+        raise HTTPException(status_code=403, detail="You don't have access to this sensor")
+
+    try:
+        bucket_seconds = timeseries.parse_bucket(bucket)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    metric_names = [m.strip() for m in metrics.split(",") if m.strip()]
+    unknown = [m for m in metric_names if m not in timeseries.READING_METRICS]
+    if not metric_names or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown metrics {unknown}; choose from {', '.join(timeseries.READING_METRICS)}",
+        )
+
+    end = to_naive_utc(end) if end else datetime.utcnow()
+    start = to_naive_utc(start) if start else end - timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    if (end - start).total_seconds() / bucket_seconds > MAX_SERIES_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"Too many buckets (max {MAX_SERIES_BUCKETS}); use a larger bucket")
+
+    sensor = await db.sensors.find_one({"_id": ObjectId(sensor_id)})
+    if not sensor:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    device_id = sensor.get("device_id")
+    source, _ = timeseries.pick_source(start, bucket_seconds)
+
+    async def stream():
+        header = {
+            "sensor_id": sensor_id,
+            "device_id": device_id,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "bucket": bucket,
+            "source": source,
+            "metrics": metric_names,
+        }
+        yield json.dumps(header)[:-1].encode() + b', "data": ['
+        if device_id:
+            first = True
+            try:
+                async for row in timeseries.iter_series(db, device_id, start, end, bucket_seconds, metric_names):
+                    row["t"] = row["t"].isoformat()
+                    yield (b"" if first else b",") + json.dumps(row).encode()
+                    first = False
+            except Exception:
+                # Headers are already sent: close the document with an error
+                # field so the client can tell the data is truncated
+                logger.exception("Error streaming readings for sensor %s", sensor_id)
+                yield b'], "error": "Readings query failed; data is incomplete"}'
+                return
+        yield b"]}"
+
+    return StreamingResponse(stream(), media_type="application/json")
+
+
 # -------------------------
 # Device token (long-lived JWT for IoT devices)
 # -------------------------
@@ -1546,78 +2013,377 @@ async def create_device_token(
 # -------------------------
 # Raspberry Pi data ingestion
 # -------------------------
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "5000"))
+# Upper bound on a /data/batch body (after gzip decompression, if gzipped)
+MAX_BATCH_BYTES = MAX_BATCH_SIZE * 1024
+ingested_readings = metrics.registry.counter(
+    "ingested_readings_total", "Readings stored, per device", ("device_id",))
+
+
+def reading_params(data: SensorData) -> dict:
+    return {
+        "pm25": data.pm25, "pm10": data.pm10, "pm1": data.pm1,
+        "co2": data.co2, "voc": data.voc, "temp": data.temp,
+        "hum": data.hum, "ch2o": data.ch2o, "co": data.co,
+        "o3": data.o3, "no2": data.no2,
+    }
+
+
+async def store_readings(
+    readings: List[SensorData], current_user: dict, received_at: Optional[List[datetime]] = None
+) -> dict:
+    """
+    Persist readings with a fixed number of round trips, whatever the count:
+    one insert_many into sensor_readings, one bulk_write of sensor upserts
+    (one per device_id, last reading wins), one find to resolve sensor ids
+    and, for devices the user does not own yet, one $addToSet on the user.
+    ``received_at`` gives each reading's timestamp (readings committed from
+    the ingest queue); by default all of them get the current time.
+
+    Returns {"sensor_ids": {device_id: sensor_id}, "failed": {index: error}}
+    where indexes refer to positions in ``readings``.
+    """
+    is_admin, user_oid = safe_get_user_id(current_user)
+    user_id_str = str(current_user["_id"])
+    now = datetime.utcnow()
+    failed = {}
+
+    # 1. Persist the raw readings in sensor_readings (time-series)
+    reading_docs = []
+    for idx, data in enumerate(readings):
+        doc = data.dict()
+        doc["user_id"] = user_id_str
+        doc["timestamp"] = received_at[idx] if received_at else now
+        reading_docs.append(doc)
+    try:
+        await db.sensor_readings.insert_many(reading_docs, ordered=False)
+    except BulkWriteError as e:
+        for err in e.details.get("writeErrors", []):
+            failed[err["index"]] = err.get("errmsg", "write failed")
+
+    # 2. Upsert one sensor document per device so the readings show on the map.
+    latest = {}
+    for idx, data in enumerate(readings):
+        if idx not in failed:
+            latest[data.device_id] = data
+            ingested_readings.inc(data.device_id)
+    if not latest:
+        return {"sensor_ids": {}, "failed": failed}
+
+    ops = [
+        UpdateOne(
+            {"device_id": device_id},
+            {
+                "$set": {"parameters": reading_params(data), "updated_at": now},
+                "$setOnInsert": {
+                    "name": data.site or device_id,
+                    "description": f"Auto-created from device {device_id}",
+                    "city": "Almaty",
+                    "country": "Kazakhstan",
+                    "location": {"type": "Point", "coordinates": [76.8512, 43.2220]},
+                    "price": 0,
+                    "created_at": now,
+                },
+            },
+            upsert=True,
+        )
+        for device_id, data in latest.items()
+    ]
+    result = await db.sensors.bulk_write(ops, ordered=False)
+    if result.upserted_count:
+        logger.info("Auto-created %d sensor(s) from device payloads", result.upserted_count)
+
+    sensors = await db.sensors.find({"device_id": {"$in": list(latest)}}).to_list(None)
+    sensor_ids = {s["device_id"]: str(s["_id"]) for s in sensors}
+
+    # 3. Grant the user permission to see these sensors on the map. The
+    #    principal already carries its permissions, so devices posting to
+    #    sensors they own skip this write (and keep their cache entry).
+    known = set(current_user.get("sensor_permissions") or [])
+    missing_ids = [sid for sid in sensor_ids.values() if sid not in known]
+    if not is_admin and user_oid is not None and missing_ids:
+        await db.users.update_one(
+            {"_id": user_oid},
+            {"$addToSet": {"sensor_permissions": {"$each": missing_ids}}},
+        )
+        principal_cache.invalidate(current_user.get("email"))
+        sensor_events.grant(current_user.get("email"), missing_ids)
+
+    # 4. Refresh the catalog and map clusters, push the new values to live subscribers
+    catalog.upsert(sensors)
+    for s in sensors:
+        cluster_sensor(s)
+        publish_sensor_update(s)
+
+    return {"sensor_ids": sensor_ids, "failed": failed}
+
+
+def parse_batch_body(body: bytes, content_type: str) -> list:
+    """
+    Split a /data/batch body into raw records. Accepts a JSON array, NDJSON
+    (one object per line) or the binary format of wire_format.py. NDJSON
+    lines that fail to parse are returned as ValueError instances so they
+    get a per-record error instead of failing the whole batch.
+    """
+    if wire_format.CONTENT_TYPE in content_type:
+        try:
+            return wire_format.decode(body)
+        except wire_format.WireFormatError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid binary batch: {e}")
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        records = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError as e:
+                records.append(ValueError(f"Invalid JSON: {e}"))
+        return records
+    try:
+        payload = json.loads(body or b"[]")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {e}")
+    if not isinstance(payload, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of readings")
+    return payload
+
+
+# Write-behind for /data: readings are acknowledged once queued, committed in groups
+ingest_writer = ingest_queue.IngestQueue(store_readings)
+
+
 @app.post("/data")
 async def ingest_sensor_data(
     data: SensorData,
+    sync: bool = False,
     current_user: dict = Depends(get_current_user),
 ):
     """
     Receives sensor readings from a Raspberry Pi (or any device).
     Requires a Bearer JWT token so each reading is linked to a user.
+    The reading is queued and stored in the background; ?sync=1 stores it
+    before responding. A full queue answers 429 with Retry-After.
     """
-    try:
-        is_admin, user_oid = safe_get_user_id(current_user)
-        user_id_str = str(current_user["_id"])
-
-        # 1. Persist the raw reading in sensor_readings (time-series)
-        reading_doc = data.dict()
-        reading_doc["user_id"] = user_id_str
-        reading_doc["timestamp"] = datetime.utcnow()
-        await db.sensor_readings.insert_one(reading_doc)
-
-        # 2. Upsert a sensor document so the reading shows on the map.
-        #    Match by device_id; create if it doesn't exist yet.
-        existing_sensor = await db.sensors.find_one({"device_id": data.device_id})
-
-        params = {
-            "pm25": data.pm25, "pm10": data.pm10, "pm1": data.pm1,
-            "co2": data.co2, "voc": data.voc, "temp": data.temp,
-            "hum": data.hum, "ch2o": data.ch2o, "co": data.co,
-            "o3": data.o3, "no2": data.no2,
-        }
-
-        if existing_sensor:
-            sensor_id_str = str(existing_sensor["_id"])
-            await db.sensors.update_one(
-                {"_id": existing_sensor["_id"]},
-                {"$set": {"parameters": params, "updated_at": datetime.utcnow()}},
-            )
-        else:
-            # Auto-create a sensor from the device payload
-            new_sensor = {
-                "device_id": data.device_id,
-                "name": data.site or data.device_id,
-                "description": f"Auto-created from device {data.device_id}",
-                "city": "Almaty",
-                "country": "Kazakhstan",
-                "location": {"type": "Point", "coordinates": [76.8512, 43.2220]},
-                "parameters": params,
-                "price": 0,
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow(),
-            }
-            result = await db.sensors.insert_one(new_sensor)
-            sensor_id_str = str(result.inserted_id)
-            print(f"✓ Auto-created sensor '{data.device_id}' -> {sensor_id_str}")
-
-        # 3. Grant the user permission to see this sensor on the map
-        if not is_admin and user_oid is not None:
-            await db.users.update_one(
-                {"_id": user_oid},
-                {"$addToSet": {"sensor_permissions": sensor_id_str}},
+    if not sync and ingest_writer.enabled:
+        try:
+            ingest_writer.submit(data, current_user)
+        except ingest_queue.IngestQueueFull:
+            raise HTTPException(
+                status_code=429,
+                detail="Ingestion queue is full, retry later",
+                headers={"Retry-After": str(ingest_queue.INGEST_RETRY_AFTER_SECONDS)},
             )
+        return {"status": "ok", "device_id": data.device_id, "user": current_user["email"], "queued": True}
+    try:
+        result = await store_readings([data], current_user)
+        if result["failed"]:
+            raise HTTPException(status_code=500, detail=f"Ingestion error: {result['failed'][0]}")
 
-        print(f"✓ Ingested reading from device={data.device_id} for user={current_user['email']}")
+        logger.debug("Ingested reading from device=%s for user=%s", data.device_id, current_user["email"])
         return {"status": "ok", "device_id": data.device_id, "user": current_user["email"]}
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error in ingest_sensor_data: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in ingest_sensor_data")
         raise HTTPException(status_code=500, detail=f"Ingestion error: {str(e)}")
 
 
+@app.post("/data/batch")
+async def ingest_sensor_data_batch(
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Bulk variant of /data for replaying buffered readings after an outage.
+    Body is a JSON array of SensorData objects, NDJSON when sent with
+    Content-Type: application/x-ndjson, or the compact binary format with
+    Content-Type: application/vnd.breez.readings; any of them may be gzipped
+    (Content-Encoding: gzip). Returns a status for every record; invalid
+    records are reported without rejecting the rest of the batch.
+    """
+    encoding = request.headers.get("content-encoding")
+    try:
+        wire_format.check_content_length(request.headers.get("content-length"), encoding, MAX_BATCH_BYTES)
+        body = wire_format.decompress(await request.body(), encoding, MAX_BATCH_BYTES)
+    except wire_format.BodyTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except wire_format.WireFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    raw_records = parse_batch_body(body, request.headers.get("content-type", ""))
+    if len(raw_records) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {MAX_BATCH_SIZE} readings)")
+
+    statuses = [None] * len(raw_records)
+    valid = []  # (position in batch, SensorData)
+    for idx, raw in enumerate(raw_records):
+        if isinstance(raw, ValueError):
+            statuses[idx] = {"index": idx, "status": "error", "error": str(raw)}
+            continue
+        try:
+            valid.append((idx, SensorData.model_validate(raw)))
+        except ValidationError as e:
+            statuses[idx] = {"index": idx, "status": "error", "error": e.errors(include_url=False, include_input=False)}
+
+    try:
+        result = await store_readings([data for _, data in valid], current_user) if valid else {"sensor_ids": {}, "failed": {}}
+    except Exception as e:
+        logger.exception("Error in ingest_sensor_data_batch")
+        raise HTTPException(status_code=500, detail=f"Ingestion error: {str(e)}")
+
+    for pos, (idx, data) in enumerate(valid):
+        if pos in result["failed"]:
+            statuses[idx] = {"index": idx, "status": "error", "device_id": data.device_id, "error": result["failed"][pos]}
+        else:
+            statuses[idx] = {
+                "index": idx,
+                "status": "ok",
+                "device_id": data.device_id,
+                "sensor_id": result["sensor_ids"].get(data.device_id),
+            }
+
+    accepted = sum(1 for st in statuses if st["status"] == "ok")
+    logger.info("Ingested batch of %d/%d readings for user=%s", accepted, len(statuses), current_user["email"])
+    return {
+        "status": "ok" if accepted == len(statuses) else "partial",
+        "accepted": accepted,
+        "rejected": len(statuses) - accepted,
+        "results": statuses,
+        "user": current_user["email"],
+    }
+
+
+# -------------------------
+# Real-time sensor updates
+# -------------------------
+sensor_events = events.SensorEventBus()
+
+
+def publish_sensor_update(sensor: dict):
+    """Push a changed sensor to the /ws/sensors and /sensors/stream subscribers allowed to see it."""
+    sensor_id = str(sensor["_id"])
+    params = sensor.get("parameters") or {}
+    coords = sensor_coordinates(sensor)
+    sensor_events.publish(sensor_id, {
+        "type": "sensor_update",
+        "sensor_id": sensor_id,
+        "device_id": sensor.get("device_id"),
+        "lat": coords[1] if coords else None,
+        "lng": coords[0] if coords else None,
+        "aqi": calculate_aqi(float(params.get("pm25", 0) or 0)),
+        "parameters": params,
+        "updated_at": sensor.get("updated_at") or datetime.utcnow(),
+    })
+
+
+def subscribe_user(user: dict) -> events.Subscription:
+    # Admins see every sensor; users only the ones in sensor_permissions
+    sensor_ids = None if user_is_admin(user) else (user.get("sensor_permissions") or [])
+    return sensor_events.subscribe(user["email"], sensor_ids)
+
+
+@app.websocket("/ws/sensors")
+async def sensors_websocket(websocket: WebSocket, token: str = Query(...)):
+    """
+    Push channel for sensor updates: ws://host/ws/sensors?token=<JWT>.
+    Sends one JSON message per changed sensor (see publish_sensor_update)
+    and {"type": "keepalive"} when idle. The server closes the socket with
+    code 1013 if the client cannot keep up.
+    """
+    try:
+        user = await get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    sub = subscribe_user(user)
+
+    async def drain_client():
+        # Client messages are ignored; this only notices the disconnect
+        while True:
+            await websocket.receive_text()
+
+    receiver = asyncio.create_task(drain_client())
+    try:
+        while not receiver.done():
+            getter = asyncio.ensure_future(sub.get(events.EVENT_KEEPALIVE_SECONDS))
+            await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                break
+            try:
+                message = getter.result()
+            except asyncio.TimeoutError:
+                message = '{"type":"keepalive"}'
+            if message is None:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                break
+            await websocket.send_text(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        sub.close()
+
+
+@app.get("/sensors/stream")
+async def sensors_event_stream(request: Request, token: Optional[str] = None):
+    """
+    Server-Sent Events fallback for /ws/sensors. EventSource cannot set
+    headers, so the JWT may be passed as ?token= instead of Authorization.
+    """
+    if token is None:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    user = await get_current_user(token)
+    sub = subscribe_user(user)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await sub.get(events.EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    break
+                yield f"event: sensor_update\ndata: {message}\n\n"
+        finally:
+            sub.close()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# -------------------------
+# Metrics
+# -------------------------
+# Scrapers send it as a Bearer token; empty leaves /metrics open (internal network only)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+metrics.registry.gauge("sensor_event_connections", "Open /ws/sensors and /sensors/stream connections",
+                       fn=lambda: sensor_events.connections)
+metrics.registry.gauge("sensor_events_dropped_subscribers", "Subscribers dropped as slow consumers",
+                       fn=lambda: sensor_events.dropped)
+metrics.registry.gauge("ingest_queue_depth", "Readings acknowledged by /data and waiting to be stored",
+                       fn=lambda: ingest_writer.depth)
+metrics.registry.gauge("log_records_dropped", "Log records dropped because the log queue was full",
+                       fn=lambda: log_config.dropped_records)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(content=metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8002)
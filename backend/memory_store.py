@@ -0,0 +1,510 @@
+"""
+In-memory stand-in for Motor collections, used when MongoDB is unavailable.
+
+The whole service runs on this module when Mongo is down, so it behaves like a
+small query engine rather than a list: declared fields get hash indexes
+(equality and $in lookups are O(1) in the collection size), filters support
+the comparison operators used by the API, and cursors apply sort/skip/limit
+lazily when they are consumed.
+"""
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from bson import ObjectId
+from pymongo import InsertOne, ReturnDocument, UpdateMany
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+
+def get_path(doc: dict, path: str, default=None):
+    """Resolve a dotted path ("parameters.pm25") inside a document."""
+    if "." not in path:
+        return doc.get(path, default)
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return default
+        value = value[part]
+    return value
+
+
+def set_path(doc: dict, path: str, value):
+    """Set a dotted path, copying nested dicts on the way so the previous
+    version of the document is never modified in place."""
+    parts = path.split(".")
+    for part in parts[:-1]:
+        nested = doc.get(part)
+        nested = dict(nested) if isinstance(nested, dict) else {}
+        doc[part] = nested
+        doc = nested
+    doc[parts[-1]] = value
+
+
+def unset_path(doc: dict, path: str):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        nested = doc.get(part)
+        if not isinstance(nested, dict):
+            return
+        nested = doc[part] = dict(nested)
+        doc = nested
+    doc.pop(parts[-1], None)
+
+
+def _sort_key(value):
+    # Mongo's cross-type order: null < numbers < strings < objects < arrays
+    # < ObjectId < bool < dates
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (6, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, dict):
+        return (3, str(sorted(value.items())))
+    if isinstance(value, list):
+        return (4, [_sort_key(v) for v in value])
+    if isinstance(value, ObjectId):
+        return (5, str(value))
+    if isinstance(value, datetime):
+        return (7, value)
+    return (8, str(value))
+
+
+def _index_keys(value):
+    """Hashable index keys for a field value; arrays index every element."""
+    if isinstance(value, list):
+        return [k for v in value for k in _index_keys(v)]
+    if isinstance(value, dict):
+        return []
+    if isinstance(value, ObjectId):
+        return [str(value)]
+    return [value]
+
+
+def _compare(value, op, operand) -> bool:
+    try:
+        if op == "$gt":
+            return value is not None and value > operand
+        if op == "$gte":
+            return value is not None and value >= operand
+        if op == "$lt":
+            return value is not None and value < operand
+        if op == "$lte":
+            return value is not None and value <= operand
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported operator {op}")
+
+
+def _value_matches(value, cond) -> bool:
+    """Match one field value against a literal or an operator document."""
+    if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+        for op, operand in cond.items():
+            if op == "$eq":
+                if not _value_matches(value, operand):
+                    return False
+            elif op == "$ne":
+                if _value_matches(value, operand):
+                    return False
+            elif op == "$in":
+                if not any(_value_matches(value, x) for x in operand):
+                    return False
+            elif op == "$nin":
+                if any(_value_matches(value, x) for x in operand):
+                    return False
+            elif op == "$exists":
+                if (value is not _MISSING) != bool(operand):
+                    return False
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                candidates = value if isinstance(value, list) else [value]
+                if not any(_compare(v, op, operand) for v in candidates):
+                    return False
+            else:
+                raise ValueError(f"Unsupported query operator {op}")
+        return True
+    if value is _MISSING:
+        return cond is None
+    if isinstance(value, list) and not isinstance(cond, list):
+        return any(v == cond for v in value)
+    return value == cond
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for key, cond in (query or {}).items():
+        if key == "$and":
+            if not all(matches(doc, q) for q in cond):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches(doc, q) for q in cond):
+                return False
+            continue
+        value = get_path(doc, key, _MISSING)
+        if key == "_id":
+            value = str(value)
+            cond = _normalize_id_cond(cond)
+        if not _value_matches(value, cond):
+            return False
+    return True
+
+
+def _normalize_id_cond(cond):
+    if isinstance(cond, dict):
+        return {
+            op: [str(x) for x in operand] if op in ("$in", "$nin") else str(operand)
+            for op, operand in cond.items()
+        }
+    return str(cond)
+
+
+def _project(doc: dict, projection: dict) -> dict:
+    if not projection:
+        return dict(doc)
+    included = [k for k, v in projection.items() if v and k != "_id"]
+    if included:
+        out = {k: doc[k] for k in included if k in doc}
+        if projection.get("_id", 1):
+            out["_id"] = doc.get("_id")
+        return out
+    return {k: v for k, v in doc.items() if k not in projection}
+
+
+class _Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class MemoryCursor:
+    """Lazy cursor: nothing is evaluated until to_list() or async iteration."""
+
+    def __init__(self, collection: "MemoryCollection", query: dict = None, projection: dict = None):
+        self._collection = collection
+        self._query = query or {}
+        self._projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction: int = None):
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction or 1)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def skip(self, n: int):
+        self._skip = max(n, 0)
+        return self
+
+    def limit(self, n: int):
+        self._limit = max(n, 0)
+        return self
+
+    def _iter_docs(self, length: int = None):
+        docs = (d for d in self._collection._candidates(self._query) if matches(d, self._query))
+        stop = self._skip + self._limit if self._limit else None
+        if length:
+            stop = min(stop, self._skip + length) if stop else self._skip + length
+        if self._sort:
+            if stop is not None and len(self._sort) == 1:
+                field, direction = self._sort[0]
+                pick = heapq.nsmallest if direction >= 0 else heapq.nlargest
+                docs = pick(stop, docs, key=lambda d: _sort_key(get_path(d, field)))
+            else:
+                docs = list(docs)
+                for field, direction in reversed(self._sort):
+                    docs.sort(key=lambda d: _sort_key(get_path(d, field)), reverse=direction < 0)
+        for doc in islice(docs, self._skip, stop):
+            yield _project(doc, self._projection)
+
+    async def to_list(self, length):
+        return list(self._iter_docs(length))
+
+    def __aiter__(self):
+        return self._aiter()
+
+    async def _aiter(self):
+        # Materialize first: the collection may change while the consumer awaits
+        for doc in list(self._iter_docs()):
+            yield doc
+
+
+class MemoryCollection:
+    """
+    In-memory collection mimicking Motor's async interface.
+
+    ``indexes`` declares secondary hash indexes as (field, options) pairs,
+    e.g. [("email", {"unique": True})]; more can be added with create_index().
+    Documents are keyed by their string _id; ObjectId queries are matched by
+    their string form.
+    """
+
+    def __init__(self, name: str, initial_data: list = None, indexes=()):
+        self.name = name
+        self._data = {}
+        self._indexes = {}  # field -> {value: set(doc keys)}
+        self._unique = set()
+        self._sparse = set()
+        for field, options in indexes:
+            self._add_index(field, **options)
+        counter = 1
+        for doc in (initial_data or []):
+            doc = dict(doc)
+            doc["_id"] = str(doc.get("_id", counter))
+            self._insert(doc)
+            counter += 1
+
+    # -- indexes -------------------------------------------------------------
+
+    def _add_index(self, field: str, unique: bool = False, sparse: bool = False, **_):
+        if field in self._indexes:
+            return
+        index = {}
+        for key, doc in self._data.items():
+            for value in self._doc_index_keys(doc, field, sparse):
+                if unique and index.get(value):
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {field}_1")
+                index.setdefault(value, set()).add(key)
+        self._indexes[field] = index
+        if unique:
+            self._unique.add(field)
+        if sparse:
+            self._sparse.add(field)
+
+    @staticmethod
+    def _doc_index_keys(doc: dict, field: str, sparse: bool):
+        value = get_path(doc, field, _MISSING)
+        if value is _MISSING:
+            return [] if sparse else [None]
+        return _index_keys(value)
+
+    async def create_index(self, keys, unique: bool = False, sparse: bool = False, **kwargs):
+        """Hash-index the leading key; other key types are accepted and
+        ignored. Uniqueness is only enforced for single-field indexes (the
+        leading key alone is not unique)."""
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        field, kind = keys[0]
+        if kind in (1, -1):
+            self._add_index(field, unique=unique and len(keys) == 1, sparse=sparse)
+        return kwargs.get("name") or "_".join(f"{k}_{d}" for k, d in keys)
+
+    def _check_unique(self, doc: dict, key: str):
+        for field in self._unique:
+            for value in self._doc_index_keys(doc, field, field in self._sparse):
+                if self._indexes[field].get(value, set()) - {key}:
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error collection: {self.name} index: {field}_1 dup key: {value!r}"
+                    )
+
+    def _index_doc(self, doc: dict, key: str):
+        for field, index in self._indexes.items():
+            for value in self._doc_index_keys(doc, field, field in self._sparse):
+                index.setdefault(value, set()).add(key)
+
+    def _unindex_doc(self, doc: dict, key: str):
+        for field, index in self._indexes.items():
+            for value in self._doc_index_keys(doc, field, field in self._sparse):
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+
+    def _candidates(self, query: dict):
+        """Narrow the scan using the _id key or the most selective index."""
+        query = query or {}
+        best = None
+        if "_id" in query:
+            cond = _normalize_id_cond(query["_id"])
+            if not isinstance(cond, dict):
+                doc = self._data.get(cond)
+                return [doc] if doc is not None else []
+            if "$in" in cond:
+                best = {k for k in cond["$in"] if k in self._data}
+        for field, cond in query.items():
+            index = self._indexes.get(field)
+            if index is None:
+                continue
+            if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+                if "$eq" in cond:
+                    values = [cond["$eq"]]
+                elif "$in" in cond:
+                    values = cond["$in"]
+                else:
+                    continue
+            else:
+                values = [cond]
+            if any(isinstance(v, (list, dict)) for v in values):
+                continue
+            keys = set()
+            for value in values:
+                for k in _index_keys(value):
+                    keys |= index.get(k, set())
+            if best is None or len(keys) < len(best):
+                best = keys
+        if best is None:
+            return self._data.values()
+        # ObjectId strings sort by creation time, which keeps results in
+        # insertion order like a full scan would
+        return [self._data[k] for k in sorted(best)]
+
+    # -- writes --------------------------------------------------------------
+
+    def _insert(self, doc: dict):
+        key = doc["_id"]
+        if key in self._data:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_ dup key: {key!r}")
+        self._check_unique(doc, key)
+        self._data[key] = doc
+        self._index_doc(doc, key)
+
+    def _apply_update(self, key: str, update: dict, inserted: bool = False):
+        old = self._data[key]
+        doc = dict(old)
+        for path, value in update.get("$set", {}).items():
+            set_path(doc, path, value)
+        if inserted:
+            for path, value in update.get("$setOnInsert", {}).items():
+                set_path(doc, path, value)
+        for path in update.get("$unset", {}):
+            unset_path(doc, path)
+        for path, amount in update.get("$inc", {}).items():
+            set_path(doc, path, (get_path(doc, path) or 0) + amount)
+        for path, value in update.get("$addToSet", {}).items():
+            arr = list(get_path(doc, path) or [])
+            for x in value["$each"] if isinstance(value, dict) and "$each" in value else [value]:
+                if x not in arr:
+                    arr.append(x)
+            set_path(doc, path, arr)
+        for path, value in update.get("$push", {}).items():
+            arr = list(get_path(doc, path) or [])
+            arr.extend(value["$each"] if isinstance(value, dict) and "$each" in value else [value])
+            set_path(doc, path, arr)
+        self._check_unique(doc, key)
+        self._unindex_doc(old, key)
+        self._data[key] = doc
+        self._index_doc(doc, key)
+        return doc != old
+
+    def _upsert_seed(self, query: dict) -> dict:
+        seed = {}
+        for field, cond in query.items():
+            if field.startswith("$"):
+                continue
+            if isinstance(cond, dict) and "$eq" in cond:
+                cond = cond["$eq"]
+            if not (isinstance(cond, dict) and any(k.startswith("$") for k in cond)):
+                set_path(seed, field, cond)
+        seed["_id"] = str(seed.get("_id", ObjectId()))
+        return seed
+
+    async def insert_one(self, doc: dict):
+        doc = dict(doc)
+        doc["_id"] = str(doc.get("_id") or ObjectId())
+        self._insert(doc)
+        return _Result(inserted_id=doc["_id"], acknowledged=True)
+
+    async def insert_many(self, docs: list, ordered: bool = True):
+        ids = []
+        for doc in docs:
+            ids.append((await self.insert_one(doc)).inserted_id)
+        return _Result(inserted_ids=ids, acknowledged=True)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                modified = self._apply_update(doc["_id"], update)
+                return _Result(matched_count=1, modified_count=int(modified), upserted_id=None)
+        if not upsert:
+            return _Result(matched_count=0, modified_count=0, upserted_id=None)
+        seed = self._upsert_seed(query)
+        self._insert(seed)
+        self._apply_update(seed["_id"], update, inserted=True)
+        return _Result(matched_count=0, modified_count=0, upserted_id=seed["_id"])
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False):
+        keys = [d["_id"] for d in self._candidates(query) if matches(d, query)]
+        if not keys and upsert:
+            return await self.update_one(query, update, upsert=True)
+        modified = sum(int(self._apply_update(k, update)) for k in keys)
+        return _Result(matched_count=len(keys), modified_count=modified, upserted_id=None)
+
+    async def find_one_and_update(
+        self,
+        query: dict,
+        update: dict,
+        projection: dict = None,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+    ):
+        before = await self.find_one(query)
+        if before is None and not upsert:
+            return None
+        result = await self.update_one(query, update, upsert=upsert)
+        if return_document == ReturnDocument.AFTER:
+            key = result.upserted_id or before["_id"]
+            return _project(self._data[key], projection)
+        return _project(before, projection) if before is not None else None
+
+    async def delete_one(self, query: dict):
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                self._unindex_doc(doc, doc["_id"])
+                del self._data[doc["_id"]]
+                return _Result(deleted_count=1)
+        return _Result(deleted_count=0)
+
+    async def delete_many(self, query: dict):
+        docs = [d for d in self._candidates(query) if matches(d, query)]
+        for doc in docs:
+            self._unindex_doc(doc, doc["_id"])
+            del self._data[doc["_id"]]
+        return _Result(deleted_count=len(docs))
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        """Apply pymongo InsertOne/UpdateOne/UpdateMany operations in order."""
+        inserted = matched = modified = 0
+        upserted_ids = {}
+        for idx, op in enumerate(requests):
+            if isinstance(op, InsertOne):
+                await self.insert_one(op._doc)
+                inserted += 1
+                continue
+            if isinstance(op, UpdateMany):
+                r = await self.update_many(op._filter, op._doc, upsert=bool(op._upsert))
+            else:
+                r = await self.update_one(op._filter, op._doc, upsert=bool(op._upsert))
+            matched += r.matched_count
+            modified += r.modified_count
+            if r.upserted_id is not None:
+                upserted_ids[idx] = r.upserted_id
+        return _Result(
+            inserted_count=inserted,
+            matched_count=matched,
+            modified_count=modified,
+            upserted_count=len(upserted_ids),
+            upserted_ids=upserted_ids,
+            acknowledged=True,
+        )
+
+    # -- reads ---------------------------------------------------------------
+
+    async def find_one(self, query: dict = None, projection: dict = None):
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                return _project(doc, projection)
+        return None
+
+    def find(self, query: dict = None, projection: dict = None) -> MemoryCursor:
+        return MemoryCursor(self, query, projection)
+
+    async def count_documents(self, query: dict = None):
+        if not query:
+            return len(self._data)
+        return sum(1 for d in self._candidates(query) if matches(d, query))
@@ -0,0 +1,311 @@
+"""
+In-process metrics in the Prometheus text format, served by GET /metrics.
+
+Kept deliberately small instead of pulling in prometheus_client: all
+updates happen on the event loop, so a metric is a dict from a label
+tuple to plain floats, and a histogram observation is one bisect plus
+two additions.
+
+* RequestMetricsMiddleware times every HTTP request by route template
+  (``/sensors/{sensor_id}``, not the raw path).
+* InstrumentedDb wraps the database (Motor or MemoryDb) and times every
+  collection call and cursor by collection and operation.
+* loop_lag_monitor() measures how late the event loop wakes up.
+"""
+import asyncio
+import math
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# Label sets per metric beyond which new ones are counted under "_other"
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", "1000"))
+LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._series: Dict[Tuple, object] = {}
+
+    def _key(self, labels: Tuple) -> Tuple:
+        if labels in self._series or len(self._series) < METRICS_MAX_SERIES:
+            return labels
+        return ("_other",) * len(self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0.0) + amount
+
+    def render(self):
+        lines = self.header()
+        for labels, value in self._series.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text, labels)
+        self.fn = fn  # read at scrape time when set
+
+    def set(self, value: float, *labels):
+        self._series[self._key(labels)] = value
+
+    def render(self):
+        lines = self.header()
+        if self.fn is not None:
+            lines.append(f"{self.name} {_format_value(self.fn())}")
+        for labels, value in self._series.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # per-bucket counts (not cumulative) + [sum, count]
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = self.header()
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            label_str = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_str} {series[-2]!r}")
+            lines.append(f"{self.name}_count{label_str} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), fn=None) -> Gauge:
+        return self.register(Gauge(name, help_text, labels, fn))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+db_duration = registry.histogram(
+    "db_operation_duration_seconds", "Database call latency", ("collection", "operation"))
+db_errors = registry.counter(
+    "db_operation_errors_total", "Database calls that raised", ("collection", "operation"))
+loop_lag = registry.histogram(
+    "event_loop_lag_seconds", "How late the event loop woke up from a sleep",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+
+# --- HTTP -------------------------------------------------------------------
+
+class RequestMetricsMiddleware:
+    """Pure ASGI middleware (no per-request task or body buffering)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # FastAPI puts the matched route into the scope during routing
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            method = scope.get("method", "")
+            http_duration.observe(time.perf_counter() - start, method, path)
+            http_requests.inc(method, path, str(status_code))
+
+
+# --- Database ---------------------------------------------------------------
+
+_TIMED_METHODS = {
+    "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+    "delete_one", "delete_many", "bulk_write", "count_documents", "estimated_document_count",
+    "find_one_and_update", "find_one_and_delete", "create_index", "distinct",
+}
+_CURSOR_METHODS = {"find", "aggregate"}
+
+
+class InstrumentedCursor:
+    """Times a find()/aggregate() cursor from its first fetch until it is exhausted."""
+
+    def __init__(self, cursor, collection: str, operation: str):
+        self.wrapped = cursor
+        self._labels = (collection, operation)
+
+    def sort(self, *args, **kwargs):
+        self.wrapped = self.wrapped.sort(*args, **kwargs)
+        return self
+
+    def skip(self, n):
+        self.wrapped = self.wrapped.skip(n)
+        return self
+
+    def limit(self, n):
+        self.wrapped = self.wrapped.limit(n)
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    async def to_list(self, length):
+        start = time.perf_counter()
+        try:
+            return await self.wrapped.to_list(length)
+        except Exception:
+            db_errors.inc(*self._labels)
+            raise
+        finally:
+            db_duration.observe(time.perf_counter() - start, *self._labels)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        start = time.perf_counter()
+        try:
+            async for doc in self.wrapped:
+                yield doc
+        except Exception:
+            db_errors.inc(*self._labels)
+            raise
+        finally:
+            db_duration.observe(time.perf_counter() - start, *self._labels)
+
+
+class InstrumentedCollection:
+    def __init__(self, collection, name: str):
+        self.wrapped = collection
+        self.name = name
+
+    def __getattr__(self, attr):
+        target = getattr(self.wrapped, attr)
+        if attr in _CURSOR_METHODS:
+            def cursor_method(*args, **kwargs):
+                return InstrumentedCursor(target(*args, **kwargs), self.name, attr)
+            return cursor_method
+        if attr in _TIMED_METHODS:
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await target(*args, **kwargs)
+                except Exception:
+                    db_errors.inc(self.name, attr)
+                    raise
+                finally:
+                    db_duration.observe(time.perf_counter() - start, self.name, attr)
+            return timed
+        return target
+
+
+class InstrumentedDb:
+    """Wraps a Motor database or MemoryDb; collections come back instrumented."""
+
+    def __init__(self, db):
+        self.wrapped = db
+        self._collections: Dict[str, InstrumentedCollection] = {}
+
+    def _collection(self, name: str):
+        wrapped = self._collections.get(name)
+        if wrapped is None:
+            wrapped = self._collections[name] = InstrumentedCollection(self.wrapped[name], name)
+        return wrapped
+
+    def __getitem__(self, name: str):
+        return self._collection(name)
+
+    def __getattr__(self, name: str):
+        target = getattr(self.wrapped, name)
+        # Database methods (command, list_collections, ...) pass through
+        if hasattr(target, "insert_many"):
+            return self._collection(name)
+        return target
+
+
+# --- Event loop -------------------------------------------------------------
+
+async def loop_lag_monitor(interval: float = LOOP_LAG_INTERVAL_SECONDS):
+    """Sleep `interval` in a loop and record how much later than asked we wake up."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, time.perf_counter() - start - interval))
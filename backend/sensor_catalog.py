@@ -0,0 +1,182 @@
+"""
+Immutable in-process snapshot of the sensors collection for the /sensors/*
+read endpoints.
+
+A CatalogSnapshot holds every sensor once, already converted to its API
+shapes (list response, map point) and pre-encoded as JSON fragments. It is
+never modified: writers build a new snapshot from the current one plus the
+changed documents (copy-on-write) and swap it in, so a request that took a
+snapshot keeps a consistent view while the catalog moves on. Each swap
+bumps `version`.
+
+Per-user endpoints only intersect the user's sensor_permissions with the
+snapshot's ids; no sensors query runs on the read path. The API process
+updates the catalog on its own writes, and refresh_loop() reloads it
+periodically to pick up writes made by other workers or scripts.
+"""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from types import MappingProxyType
+from typing import Callable, Iterable, List, Optional
+
+import aqi
+import clustering
+
+logger = logging.getLogger(__name__)
+
+# Full reload interval (writes from other workers show up within this time)
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "60"))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _encode(value) -> bytes:
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _pm25(sensor: dict) -> float:
+    return float((sensor.get("parameters") or {}).get("pm25", 0) or 0)
+
+
+class CatalogEntry:
+    __slots__ = ("id", "position", "doc", "response", "response_json", "status_json", "lon", "lat", "map_point", "map_json")
+
+    def __init__(self, sensor_id: str, position: int, doc: dict, response: dict, map_point: Optional[dict], coords):
+        self.id = sensor_id
+        self.position = position
+        self.doc = doc
+        self.response = response
+        self.response_json = _encode(response)
+        # /sensors/all variants: {..., "is_purchased": false|true}
+        self.status_json = {
+            flag: self.response_json[:-1] + (b',"is_purchased":true}' if flag else b',"is_purchased":false}')
+            for flag in (False, True)
+        }
+        self.lon, self.lat = coords if coords else (None, None)
+        self.map_point = map_point
+        self.map_json = _encode(map_point) if map_point is not None else None
+
+
+class CatalogSnapshot:
+    def __init__(self, version: int, entries: dict, ordered: Optional[tuple] = None):
+        self.version = version
+        self._entries = MappingProxyType(entries)
+        self._ordered = ordered if ordered is not None else tuple(sorted(entries.values(), key=lambda e: e.position))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, sensor_id: str) -> Optional[CatalogEntry]:
+        return self._entries.get(sensor_id)
+
+    def all(self):
+        return self._ordered
+
+    def select(self, sensor_ids: Iterable[str]) -> List[CatalogEntry]:
+        """Entries for the given ids that exist, in catalog order."""
+        found = [e for e in map(self._entries.get, set(sensor_ids)) if e is not None]
+        found.sort(key=lambda e: e.position)
+        return found
+
+    def excluding(self, sensor_ids: Iterable[str]) -> List[CatalogEntry]:
+        excluded = set(sensor_ids)
+        return [e for e in self._ordered if e.id not in excluded]
+
+    def located(self, sensor_ids: Iterable[str], bbox=None) -> List[CatalogEntry]:
+        """Entries with coordinates, optionally inside bbox (min_lon, min_lat, max_lon, max_lat)."""
+        return [
+            e for e in self.select(sensor_ids)
+            if e.map_point is not None and (bbox is None or clustering.in_bbox(e.lon, e.lat, bbox))
+        ]
+
+
+def json_list(fragments: Iterable[bytes]) -> bytes:
+    """{"data": [...]} from pre-encoded items."""
+    return b'{"data":[' + b",".join(fragments) + b"]}"
+
+
+class SensorCatalog:
+    def __init__(
+        self,
+        to_response: Callable[[dict], dict],
+        to_map_point: Callable[[dict, float, float, int], dict],
+        coordinates: Callable[[dict], Optional[tuple]],
+    ):
+        self._to_response = to_response
+        self._to_map_point = to_map_point
+        self._coordinates = coordinates
+        self._next_position = 0
+        self._upserted = {}  # sensor id -> catalog version of its last upsert
+        self.snapshot = CatalogSnapshot(0, {})
+
+    def _entries(self, sensors: List[dict], positions: dict) -> dict:
+        coords = [self._coordinates(s) for s in sensors]
+        aqi_values = aqi.pm25_aqi([_pm25(s) for s in sensors]).tolist() if sensors else []
+        entries = {}
+        for sensor, xy, aqi_val in zip(sensors, coords, aqi_values):
+            sensor_id = str(sensor["_id"])
+            position = positions.get(sensor_id)
+            if position is None:
+                position = positions[sensor_id] = self._next_position
+                self._next_position += 1
+            map_point = self._to_map_point(sensor, xy[0], xy[1], aqi_val) if xy else None
+            entries[sensor_id] = CatalogEntry(sensor_id, position, sensor, self._to_response(sensor), map_point, xy)
+        return entries
+
+    def replace_all(self, sensors: List[dict], read_version: Optional[int] = None):
+        """
+        Swap in a snapshot built from a full sensors read that started at
+        catalog version `read_version`. Sensors upserted after that keep their
+        current entry, since the read may have missed the write.
+        """
+        current = self.snapshot
+        positions = {e.id: e.position for e in current.all()}
+        entries = self._entries(sensors, positions)
+        if read_version is not None:
+            for sensor_id, version in self._upserted.items():
+                if version > read_version and current.get(sensor_id) is not None:
+                    entries[sensor_id] = current.get(sensor_id)
+        self._upserted.clear()
+        self.snapshot = CatalogSnapshot(current.version + 1, entries)
+
+    def upsert(self, sensors: List[dict]):
+        """Copy-on-write update with full sensor documents."""
+        if not sensors:
+            return
+        current = self.snapshot
+        version = current.version + 1
+        positions = {e.id: e.position for e in current.all()}
+        changed = self._entries(sensors, positions)
+        entries = dict(current._entries)
+        entries.update(changed)
+        # Existing sensors keep their place; new ones go to the end
+        ordered = tuple(changed.get(e.id, e) for e in current.all())
+        ordered += tuple(e for e in changed.values() if current.get(e.id) is None)
+        for sensor_id in changed:
+            self._upserted[sensor_id] = version
+        self.snapshot = CatalogSnapshot(version, entries, ordered)
+
+    async def load(self, db):
+        read_version = self.snapshot.version
+        sensors = await db.sensors.find({}).to_list(None)
+        self.replace_all(sensors, read_version)
+
+    async def refresh_loop(self, db, interval: float = CATALOG_REFRESH_SECONDS, on_reload=None):
+        """Reload every `interval` seconds; on_reload(snapshot) runs after each swap."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load(db)
+                if on_reload is not None:
+                    on_reload(self.snapshot)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Sensor catalog refresh failed")
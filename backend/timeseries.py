@@ -0,0 +1,356 @@
+"""
+Storage layout and retention for sensor readings.
+
+Raw readings live in ``sensor_readings``: a MongoDB time-series collection
+(timeField ``timestamp``, metaField ``device_id``) that expires points after
+READINGS_RAW_RETENTION_DAYS. A background loop rolls them into 1-minute
+aggregates (``sensor_readings_1m``), and those into 1-hour aggregates
+(``sensor_readings_1h``). Each level has its own TTL, so storage and
+range-scan cost stay flat as the fleet grows.
+
+Rollup documents look like:
+    {"device_id": "lab01", "timestamp": <bucket start>, "resolution": "1m",
+     "count": 12, "pm25": {"avg": 14.2, "min": 11, "max": 19}, ...}
+
+Requires MongoDB 5.0+ ($dateTrunc, time-series collections). The in-memory
+store runs the same rollups and expiry in Python.
+"""
+import asyncio
+import logging
+import math
+import os
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from memory_store import MemoryCollection
+
+logger = logging.getLogger(__name__)
+
+READING_METRICS = ("pm1", "pm25", "pm10", "co2", "voc", "temp", "hum", "ch2o", "co", "o3", "no2")
+
+RAW_RETENTION_DAYS = float(os.getenv("READINGS_RAW_RETENTION_DAYS", "7"))
+MINUTE_RETENTION_DAYS = float(os.getenv("READINGS_1M_RETENTION_DAYS", "90"))
+HOUR_RETENTION_DAYS = float(os.getenv("READINGS_1H_RETENTION_DAYS", "730"))
+ROLLUP_INTERVAL_SECONDS = float(os.getenv("READINGS_ROLLUP_INTERVAL_SECONDS", "60"))
+
+RAW_COLLECTION = "sensor_readings"
+
+# (collection, source collection, bucket seconds, label, retention days)
+ROLLUPS = (
+    ("sensor_readings_1m", RAW_COLLECTION, 60, "1m", MINUTE_RETENTION_DAYS),
+    ("sensor_readings_1h", "sensor_readings_1m", 3600, "1h", HOUR_RETENTION_DAYS),
+)
+
+# Rollups recompute this many trailing buckets each run so late points and the
+# still-open bucket are folded in; $merge makes the re-run idempotent.
+ROLLUP_LOOKBACK_BUCKETS = 2
+
+# $dateTrunc bins with binSize are aligned to this instant
+BIN_REFERENCE = datetime(2000, 1, 1)
+
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# $percentile needs MongoDB 7.0; older servers get p95 = null
+_percentile_supported = True
+
+
+def is_memory_db(db) -> bool:
+    collection = db[RAW_COLLECTION]
+    # metrics.InstrumentedCollection keeps the real collection in .wrapped
+    return isinstance(getattr(collection, "wrapped", collection), MemoryCollection)
+
+
+def bucket_start(ts: datetime, bucket_seconds: int) -> datetime:
+    offset = (ts - BIN_REFERENCE).total_seconds()
+    return BIN_REFERENCE + timedelta(seconds=(offset // bucket_seconds) * bucket_seconds)
+
+
+def date_trunc_expr(bucket_seconds: int) -> dict:
+    return {"$dateTrunc": {"date": "$timestamp", "unit": "second", "binSize": bucket_seconds}}
+
+
+async def ensure_timeseries_storage(db):
+    """Create the raw time-series collection and rollup collections (idempotent)."""
+    if is_memory_db(db):
+        return
+    raw_seconds = int(RAW_RETENTION_DAYS * 86400)
+    existing = {c["name"]: c async for c in await db.list_collections()}
+    raw = existing.get(RAW_COLLECTION)
+    if raw is None:
+        await db.create_collection(
+            RAW_COLLECTION,
+            timeseries={"timeField": "timestamp", "metaField": "device_id", "granularity": "seconds"},
+            expireAfterSeconds=raw_seconds,
+        )
+        logger.info("Created time-series collection %s", RAW_COLLECTION)
+    elif raw.get("type") == "timeseries":
+        await db.command("collMod", RAW_COLLECTION, expireAfterSeconds=raw_seconds)
+    else:
+        # A regular collection cannot be converted in place; keep using it
+        # with a TTL index until it is migrated.
+        await db[RAW_COLLECTION].create_index("timestamp", expireAfterSeconds=raw_seconds)
+        logger.warning("%s is a regular collection; rename it and restart to switch to time-series storage", RAW_COLLECTION)
+
+    # The (device_id, timestamp) keys are in indexes.INDEXES
+    for name, _, _, _, retention_days in ROLLUPS:
+        await db[name].create_index("timestamp", expireAfterSeconds=int(retention_days * 86400))
+
+
+def _group_stage(bucket_seconds: int, from_rollups: bool) -> dict:
+    group = {
+        "_id": {"device_id": "$device_id", "timestamp": date_trunc_expr(bucket_seconds)},
+        "count": {"$sum": "$count" if from_rollups else 1},
+    }
+    for m in READING_METRICS:
+        if from_rollups:
+            group[f"{m}_sum"] = {"$sum": {"$multiply": [f"${m}.avg", "$count"]}}
+            group[f"{m}_n"] = {"$sum": {"$cond": [{"$isNumber": f"${m}.avg"}, "$count", 0]}}
+            group[f"{m}_min"] = {"$min": f"${m}.min"}
+            group[f"{m}_max"] = {"$max": f"${m}.max"}
+        else:
+            group[f"{m}_avg"] = {"$avg": f"${m}"}
+            group[f"{m}_min"] = {"$min": f"${m}"}
+            group[f"{m}_max"] = {"$max": f"${m}"}
+    return {"$group": group}
+
+
+def _project_stage(label: str, from_rollups: bool) -> dict:
+    project = {
+        "_id": 0,
+        "device_id": "$_id.device_id",
+        "timestamp": "$_id.timestamp",
+        "resolution": {"$literal": label},
+        "count": 1,
+    }
+    for m in READING_METRICS:
+        avg = (
+            {"$cond": [{"$gt": [f"${m}_n", 0]}, {"$divide": [f"${m}_sum", f"${m}_n"]}, None]}
+            if from_rollups else f"${m}_avg"
+        )
+        project[m] = {"avg": avg, "min": f"${m}_min", "max": f"${m}_max"}
+    return {"$project": project}
+
+
+def summarize_buckets(docs, bucket_seconds: int, label: str, from_rollups: bool = False) -> list:
+    """Python equivalent of the rollup pipeline, used by the in-memory store."""
+    groups = {}
+    for doc in docs:
+        key = (doc.get("device_id"), bucket_start(doc["timestamp"], bucket_seconds))
+        acc = groups.setdefault(key, {"count": 0, "metrics": {}})
+        weight = doc.get("count", 1) if from_rollups else 1
+        acc["count"] += weight
+        for m in READING_METRICS:
+            value = doc.get(m)
+            if from_rollups:
+                if not isinstance(value, dict) or value.get("avg") is None:
+                    continue
+                lo, hi, total = value["min"], value["max"], value["avg"] * weight
+            else:
+                if value is None:
+                    continue
+                lo = hi = value
+                total = value
+            stats = acc["metrics"].get(m)
+            if stats is None:
+                acc["metrics"][m] = [total, weight, lo, hi]
+            else:
+                stats[0] += total
+                stats[1] += weight
+                stats[2] = min(stats[2], lo)
+                stats[3] = max(stats[3], hi)
+    out = []
+    for (device_id, ts), acc in groups.items():
+        doc = {"device_id": device_id, "timestamp": ts, "resolution": label, "count": acc["count"]}
+        for m, (total, n, lo, hi) in acc["metrics"].items():
+            doc[m] = {"avg": total / n, "min": lo, "max": hi}
+        out.append(doc)
+    return out
+
+
+async def rollup(db, target: str, source: str, bucket_seconds: int, label: str, start: datetime, end: datetime):
+    """(Re)compute ``target`` buckets covering [start, end) from ``source``."""
+    from_rollups = source != RAW_COLLECTION
+    match = {"timestamp": {"$gte": start, "$lt": end}}
+    if is_memory_db(db):
+        docs = await db[source].find(match).to_list(None)
+        buckets = summarize_buckets(docs, bucket_seconds, label, from_rollups)
+        if buckets:
+            await db[target].bulk_write([
+                UpdateOne({"device_id": b["device_id"], "timestamp": b["timestamp"]}, {"$set": b}, upsert=True)
+                for b in buckets
+            ])
+        return
+    pipeline = [
+        {"$match": match},
+        _group_stage(bucket_seconds, from_rollups),
+        _project_stage(label, from_rollups),
+        {"$merge": {"into": target, "on": ["device_id", "timestamp"], "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+    await db[source].aggregate(pipeline).to_list(None)
+
+
+async def expire_memory_readings(db, now: datetime):
+    """TTL expiry for the in-memory store (Mongo does this server-side)."""
+    await db[RAW_COLLECTION].delete_many({"timestamp": {"$lt": now - timedelta(days=RAW_RETENTION_DAYS)}})
+    for name, _, _, _, retention_days in ROLLUPS:
+        await db[name].delete_many({"timestamp": {"$lt": now - timedelta(days=retention_days)}})
+
+
+async def run_retention_cycle(db, now: datetime = None, catch_up: bool = False):
+    """
+    Roll the trailing buckets of every level. With ``catch_up`` the whole raw
+    retention window is rolled instead, covering any time the server was down.
+    """
+    now = now or datetime.utcnow()
+    for target, source, bucket_seconds, label, _ in ROLLUPS:
+        if catch_up:
+            start = bucket_start(now - timedelta(days=RAW_RETENTION_DAYS), bucket_seconds)
+        else:
+            start = bucket_start(now, bucket_seconds) - timedelta(seconds=bucket_seconds * ROLLUP_LOOKBACK_BUCKETS)
+        await rollup(db, target, source, bucket_seconds, label, start, now)
+    if is_memory_db(db):
+        await expire_memory_readings(db, now)
+
+
+async def retention_loop(db):
+    """Background task started from on_startup."""
+    catch_up = True
+    while True:
+        try:
+            await run_retention_cycle(db, catch_up=catch_up)
+            catch_up = False
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Readings rollup failed")
+        await asyncio.sleep(ROLLUP_INTERVAL_SECONDS)
+
+
+# -------------------------
+# Range queries
+# -------------------------
+def parse_bucket(spec: str) -> int:
+    """Parse a bucket size such as "30s", "5m", "1h" or "1d" into seconds."""
+    spec = (spec or "").strip().lower()
+    if len(spec) < 2 or spec[-1] not in BUCKET_UNITS or not spec[:-1].isdigit() or int(spec[:-1]) <= 0:
+        raise ValueError(f"Invalid bucket {spec!r}; use e.g. 30s, 5m, 1h, 1d")
+    return int(spec[:-1]) * BUCKET_UNITS[spec[-1]]
+
+
+def pick_source(start: datetime, bucket_seconds: int, now: datetime = None):
+    """
+    Choose the collection that covers ``start``. Raw points are used
+    whenever they are still retained, for any bucket size: $dateTrunc
+    groups them into the requested buckets and only they give a p95.
+    Older ranges read the 1h rollups for buckets of an hour or more (or
+    past the 1m retention) and the 1m rollups otherwise; a bucket finer
+    than the rollup is widened to it. Returns (collection, resolution seconds).
+    """
+    now = now or datetime.utcnow()
+    if start >= now - timedelta(days=RAW_RETENTION_DAYS):
+        return RAW_COLLECTION, 1
+    if bucket_seconds >= 3600 or start < now - timedelta(days=MINUTE_RETENTION_DAYS):
+        return "sensor_readings_1h", 3600
+    return "sensor_readings_1m", 60
+
+
+def series_pipeline(device_id: str, start: datetime, end: datetime, bucket_seconds: int,
+                    metrics, from_rollups: bool, with_p95: bool) -> list:
+    group = {
+        "_id": date_trunc_expr(bucket_seconds),
+        "count": {"$sum": "$count" if from_rollups else 1},
+    }
+    project = {"_id": 0, "t": "$_id", "count": 1}
+    for m in metrics:
+        if from_rollups:
+            group[f"{m}_sum"] = {"$sum": {"$multiply": [f"${m}.avg", "$count"]}}
+            group[f"{m}_n"] = {"$sum": {"$cond": [{"$isNumber": f"${m}.avg"}, "$count", 0]}}
+            group[f"{m}_min"] = {"$min": f"${m}.min"}
+            group[f"{m}_max"] = {"$max": f"${m}.max"}
+            avg = {"$cond": [{"$gt": [f"${m}_n", 0]}, {"$divide": [f"${m}_sum", f"${m}_n"]}, None]}
+        else:
+            group[f"{m}_avg"] = {"$avg": f"${m}"}
+            group[f"{m}_min"] = {"$min": f"${m}"}
+            group[f"{m}_max"] = {"$max": f"${m}"}
+            avg = f"${m}_avg"
+        p95 = None
+        if with_p95 and not from_rollups:
+            group[f"{m}_p95"] = {"$percentile": {"input": f"${m}", "p": [0.95], "method": "approximate"}}
+            p95 = {"$arrayElemAt": [f"${m}_p95", 0]}
+        project[m] = {"avg": avg, "min": f"${m}_min", "max": f"${m}_max", "p95": p95}
+    return [
+        {"$match": {"device_id": device_id, "timestamp": {"$gte": start, "$lt": end}}},
+        {"$group": group},
+        {"$sort": {"_id": 1}},
+        {"$project": project},
+    ]
+
+
+def _p95(values: list):
+    values = sorted(values)
+    return values[max(math.ceil(0.95 * len(values)) - 1, 0)]
+
+
+def summarize_series(docs, bucket_seconds: int, metrics, from_rollups: bool) -> list:
+    """Python equivalent of series_pipeline for the in-memory store."""
+    rows = {}
+    for doc in docs:
+        ts = bucket_start(doc["timestamp"], bucket_seconds)
+        weight = doc.get("count", 1) if from_rollups else 1
+        row = rows.setdefault(ts, {"count": 0, "values": {m: [] for m in metrics}})
+        row["count"] += weight
+        for m in metrics:
+            value = doc.get(m)
+            if from_rollups and isinstance(value, dict) and value.get("avg") is not None:
+                row["values"][m].append((value["avg"], value["min"], value["max"], weight))
+            elif not from_rollups and value is not None:
+                row["values"][m].append((value, value, value, 1))
+    out = []
+    for ts in sorted(rows):
+        row = {"t": ts, "count": rows[ts]["count"]}
+        for m, values in rows[ts]["values"].items():
+            if not values:
+                row[m] = {"avg": None, "min": None, "max": None, "p95": None}
+                continue
+            n = sum(v[3] for v in values)
+            row[m] = {
+                "avg": sum(v[0] * v[3] for v in values) / n,
+                "min": min(v[1] for v in values),
+                "max": max(v[2] for v in values),
+                "p95": None if from_rollups else _p95([v[0] for v in values]),
+            }
+        out.append(row)
+    return out
+
+
+async def iter_series(db, device_id: str, start: datetime, end: datetime, bucket_seconds: int, metrics):
+    """
+    Yield one aggregated row per bucket, oldest first. The aggregation runs in
+    the database; only the bucket rows reach Python.
+    """
+    global _percentile_supported
+    source, resolution = pick_source(start, bucket_seconds)
+    bucket_seconds = max(bucket_seconds, resolution)
+    from_rollups = source != RAW_COLLECTION
+    if is_memory_db(db):
+        docs = await db[source].find(
+            {"device_id": device_id, "timestamp": {"$gte": start, "$lt": end}}
+        ).to_list(None)
+        for row in summarize_series(docs, bucket_seconds, metrics, from_rollups):
+            yield row
+        return
+    with_p95 = _percentile_supported
+    try:
+        pipeline = series_pipeline(device_id, start, end, bucket_seconds, metrics, from_rollups, with_p95)
+        async for row in db[source].aggregate(pipeline):
+            yield row
+    except OperationFailure as e:
+        if not with_p95 or "percentile" not in str(e):
+            raise
+        _percentile_supported = False
+        logger.warning("MongoDB has no $percentile (needs 7.0); readings p95 will be null")
+        pipeline = series_pipeline(device_id, start, end, bucket_seconds, metrics, from_rollups, False)
+        async for row in db[source].aggregate(pipeline):
+            yield row
@@ -0,0 +1,168 @@
+"""
+Client for the IQAir/AirVisual API (http://api.airvisual.com/v2).
+
+Its only caller is the city poller (city_poller.py); request handlers
+read what the poller stored and never call AirVisual themselves. One
+shared httpx.AsyncClient keeps connections alive between calls, and
+concurrent requests for the same city share one in-flight call.
+
+Calls are paced by token buckets sized to the API plan (per minute and per
+day), so running over the quota raises UpstreamRateLimited instead of
+getting the key revoked.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Hashable, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Community plan: 5 calls per minute, 500 per day (0 disables the daily bucket)
+IQAIR_CALLS_PER_MINUTE = float(os.getenv("IQAIR_CALLS_PER_MINUTE", "5"))
+IQAIR_CALLS_PER_DAY = float(os.getenv("IQAIR_CALLS_PER_DAY", "500"))
+# How long a request may wait for a token before giving up
+IQAIR_RATE_WAIT_SECONDS = float(os.getenv("IQAIR_RATE_WAIT_SECONDS", "2"))
+IQAIR_MAX_CONNECTIONS = int(os.getenv("IQAIR_MAX_CONNECTIONS", "10"))
+IQAIR_TIMEOUT_SECONDS = float(os.getenv("IQAIR_TIMEOUT_SECONDS", "10"))
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class UpstreamRateLimited(UpstreamError):
+    pass
+
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class AirVisualClient:
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        calls_per_minute: float = IQAIR_CALLS_PER_MINUTE,
+        calls_per_day: float = IQAIR_CALLS_PER_DAY,
+        rate_wait: float = IQAIR_RATE_WAIT_SECONDS,
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.rate_wait = rate_wait
+        self.buckets = [TokenBucket(calls_per_minute / 60.0, max(1.0, calls_per_minute))]
+        if calls_per_day > 0:
+            self.buckets.append(TokenBucket(calls_per_day / 86400.0, calls_per_day))
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._rate_lock = asyncio.Lock()
+        self.stats = {
+            "coalesced": 0, "upstream_calls": 0, "upstream_errors": 0, "rate_limited": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_key)
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=IQAIR_TIMEOUT_SECONDS,
+                limits=httpx.Limits(
+                    max_connections=IQAIR_MAX_CONNECTIONS,
+                    max_keepalive_connections=IQAIR_MAX_CONNECTIONS,
+                ),
+            )
+
+    async def close(self):
+        for task in list(self._inflight.values()):
+            task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # --- public API -----------------------------------------------------
+
+    async def city(self, city: str, state: str, country: str) -> dict:
+        key = ("city", city.strip().lower(), state.strip().lower(), country.strip().lower())
+        params = {"city": city, "state": state, "country": country}
+        # Shielded: a cancelled caller must not cancel the call others share
+        return await asyncio.shield(self._fetch(key, "/city", params))
+
+    # --- coalescing and rate limiting -----------------------------------
+
+    def _fetch(self, key: Hashable, path: str, params: dict) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            return task
+        task = asyncio.create_task(self._call(path, params))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._fetch_done(key, t))
+        return task
+
+    def _fetch_done(self, key: Hashable, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # retrieved, so a caller that went away leaves no "never retrieved" warning
+
+    async def _acquire_token(self):
+        async with self._rate_lock:
+            wait = max(bucket.wait_time() for bucket in self.buckets)
+            if wait > self.rate_wait:
+                self.stats["rate_limited"] += 1
+                raise UpstreamRateLimited(f"AirVisual quota exhausted, next call in {wait:.0f}s")
+            if wait > 0:
+                await asyncio.sleep(wait)
+            for bucket in self.buckets:
+                bucket.take()
+
+    async def _call(self, path: str, params: dict) -> dict:
+        await self._acquire_token()
+        await self.start()
+        self.stats["upstream_calls"] += 1
+        try:
+            response = await self._client.get(path, params={**params, "key": self.api_key})
+        except httpx.HTTPError as e:
+            self.stats["upstream_errors"] += 1
+            raise UpstreamError(f"AirVisual request failed: {e}") from e
+        if response.status_code == 429:
+            self.stats["rate_limited"] += 1
+            raise UpstreamRateLimited("AirVisual answered 429 Too Many Requests")
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = {}
+        if response.status_code != 200 or payload.get("status") != "success":
+            self.stats["upstream_errors"] += 1
+            # Errors look like {"status": "fail", "data": {"message": "city_not_found"}}
+            data = payload.get("data")
+            message = data.get("message") if isinstance(data, dict) else response.text[:200]
+            raise UpstreamError(f"AirVisual error {response.status_code}: {message}")
+        return payload["data"]
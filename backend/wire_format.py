@@ -0,0 +1,132 @@
+"""
+Compact binary encoding for device uploads to /data/batch.
+
+A JSON reading spends most of its ~200 bytes on key names. The binary form
+sends the SensorData fields as a fixed struct, 44 bytes per reading, with
+device_id and site written once per batch:
+
+    magic     3s   b"BRZ"
+    version   B    WIRE_VERSION
+    device_id u8 length + UTF-8
+    site      u8 length + UTF-8
+    count     u32
+    count x   11 x float32 in READING_FIELDS order
+
+All integers and floats are big-endian. Clients select it with
+``Content-Type: application/vnd.breez.readings``. Any /data/batch body,
+JSON or binary, may also be sent with ``Content-Encoding: gzip``.
+send.py carries its own copy of the encoder, so keep the two in sync.
+"""
+import struct
+import zlib
+from typing import List
+
+CONTENT_TYPE = "application/vnd.breez.readings"
+MAGIC = b"BRZ"
+WIRE_VERSION = 1
+# SensorData numeric fields, in wire order
+READING_FIELDS = ("pm1", "pm25", "pm10", "co2", "voc", "temp", "hum", "ch2o", "co", "o3", "no2")
+
+_HEADER = struct.Struct(">3sB")
+_COUNT = struct.Struct(">I")
+_READING = struct.Struct(">" + "f" * len(READING_FIELDS))
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+class BodyTooLarge(WireFormatError):
+    pass
+
+
+def _pack_str(value: str) -> bytes:
+    raw = value.encode("utf-8")
+    if len(raw) > 255:
+        raise WireFormatError("device_id/site longer than 255 bytes")
+    return bytes([len(raw)]) + raw
+
+
+def encode(readings: List[dict], device_id: str, site: str) -> bytes:
+    """Encode readings of one device. Each reading is a dict with READING_FIELDS."""
+    parts = [_HEADER.pack(MAGIC, WIRE_VERSION), _pack_str(device_id), _pack_str(site), _COUNT.pack(len(readings))]
+    parts.extend(_READING.pack(*(float(r[name]) for name in READING_FIELDS)) for r in readings)
+    return b"".join(parts)
+
+
+def _read_str(view: memoryview, offset: int):
+    if offset >= len(view):
+        raise WireFormatError("truncated header")
+    end = offset + 1 + view[offset]
+    if end > len(view):
+        raise WireFormatError("truncated header")
+    try:
+        return str(view[offset + 1:end], "utf-8"), end
+    except UnicodeDecodeError:
+        raise WireFormatError("device_id/site is not valid UTF-8")
+
+
+def _from_float32(value: float) -> float:
+    # float32 cannot hold 0.01 exactly; the shortest decimal that maps back to
+    # the same float32 is the value the device encoded
+    return float(f"{value:.7g}")
+
+
+def decode(body: bytes) -> List[dict]:
+    """Decode a binary batch into dicts with the SensorData field names."""
+    view = memoryview(body)
+    if len(view) < _HEADER.size:
+        raise WireFormatError("truncated header")
+    magic, version = _HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise WireFormatError("not a readings batch (bad magic)")
+    if version != WIRE_VERSION:
+        raise WireFormatError(f"unsupported wire format version {version}")
+    device_id, offset = _read_str(view, _HEADER.size)
+    site, offset = _read_str(view, offset)
+    if offset + _COUNT.size > len(view):
+        raise WireFormatError("truncated header")
+    (count,) = _COUNT.unpack_from(view, offset)
+    offset += _COUNT.size
+    if len(view) - offset != count * _READING.size:
+        raise WireFormatError(f"expected {count} readings of {_READING.size} bytes")
+    return [
+        {"device_id": device_id, "site": site, **dict(zip(READING_FIELDS, map(_from_float32, values)))}
+        for values in _READING.iter_unpack(view[offset:])
+    ]
+
+
+def _is_identity(content_encoding: str) -> bool:
+    return (content_encoding or "").strip().lower() in ("", "identity")
+
+
+def check_content_length(content_length: str, content_encoding: str, max_bytes: int):
+    """Refuse an uncompressed body by its Content-Length, before it is read."""
+    if not content_length or not _is_identity(content_encoding):
+        return
+    try:
+        length = int(content_length)
+    except ValueError:
+        raise WireFormatError(f"invalid Content-Length {content_length!r}")
+    if length > max_bytes:
+        raise BodyTooLarge(f"body larger than {max_bytes} bytes")
+
+
+def decompress(body: bytes, content_encoding: str, max_bytes: int) -> bytes:
+    """Undo Content-Encoding: gzip; refuses bodies (inflated or not) past max_bytes."""
+    if _is_identity(content_encoding):
+        if len(body) > max_bytes:
+            raise BodyTooLarge(f"body larger than {max_bytes} bytes")
+        return body
+    if content_encoding.strip().lower() != "gzip":
+        raise WireFormatError(f"unsupported Content-Encoding {content_encoding!r}")
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        out = inflater.decompress(body, max_bytes + 1)
+    except zlib.error as e:
+        raise WireFormatError(f"invalid gzip body: {e}")
+    if len(out) > max_bytes:
+        raise BodyTooLarge(f"decompressed body larger than {max_bytes} bytes")
+    if not inflater.eof:
+        raise WireFormatError("truncated gzip body")
+    return out
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Scalar calculate_aqi loop vs the batch AQI module (backend/aqi.py).
+
+Checks that both give identical PM2.5 AQI values, then times N points
+through each. Also times aqi_batch over all five pollutants.
+
+Usage: python benchmarks/bench_aqi.py [--sizes 100,10000,1000000]
+"""
+import argparse
+import array
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import aqi  # noqa: E402
+
+
+def calculate_aqi(pm25: float) -> int:
+    """Copy of main.calculate_aqi, so the benchmark does not need the app's settings."""
+    if pm25 <= 12.0:
+        return int((50 / 12.0) * pm25)
+    elif pm25 <= 35.4:
+        return int(50 + ((100 - 50) / (35.4 - 12.0)) * (pm25 - 12.0))
+    elif pm25 <= 55.4:
+        return int(100 + ((150 - 100) / (55.4 - 35.4)) * (pm25 - 35.4))
+    elif pm25 <= 150.4:
+        return int(150 + ((200 - 150) / (150.4 - 55.4)) * (pm25 - 55.4))
+    elif pm25 <= 250.4:
+        return int(200 + ((300 - 200) / (250.4 - 150.4)) * (pm25 - 150.4))
+    else:
+        return int(300 + ((400 - 300) / (350.4 - 250.4)) * (pm25 - 250.4))
+
+
+def best_of(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="100,10000,1000000")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    print(f"{'points':>9} {'scalar ms':>10} {'batch ms':>9} {'speedup':>8} {'5-pollutant ms':>15}")
+    for n in (int(s) for s in args.sizes.split(",")):
+        pm25 = rng.uniform(0, 400, n)
+        values = array.array("d", pm25)
+        others = {k: rng.uniform(0, hi, n) for k, hi in (("pm10", 500), ("o3", 150), ("no2", 400), ("co", 20))}
+
+        expected = [calculate_aqi(v) for v in values]
+        assert aqi.pm25_aqi(values).tolist() == expected, "batch AQI differs from calculate_aqi"
+
+        scalar = best_of(lambda: [calculate_aqi(v) for v in values])
+        batch = best_of(lambda: aqi.pm25_aqi(values))
+        full = best_of(lambda: aqi.aqi_batch(pm25=pm25, **others))
+        print(f"{n:>9} {scalar * 1e3:>10.3f} {batch * 1e3:>9.3f} {scalar / batch:>7.1f}x {full * 1e3:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Frames/sec of the send.py sensor frame decoder.
+
+Compares one parse_sensor_data() call per frame with decode_frames() over a
+contiguous block of frames (NumPy when installed, struct.iter_unpack over a
+memoryview otherwise), and FrameBuffer resync + decode as used by the
+acquisition thread. Run it on the Raspberry Pi: send.py imports pyserial and
+requests, which the Pi already has.
+
+Usage: python benchmarks/bench_frame_decoder.py [--frames 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import send  # noqa: E402
+
+
+def make_frames(count: int) -> bytes:
+    rng = random.Random(7)
+    out = bytearray()
+    for _ in range(count):
+        frame = bytearray([send.FRAME_START, 0x86]) + bytes(rng.randrange(256) for _ in range(23)) + b"\0"
+        frame[25] = send.calculate_checksum(frame)
+        out += frame
+    return bytes(out)
+
+
+def best_of(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20000)
+    args = parser.parse_args()
+
+    block = make_frames(args.frames)
+    frames = [block[i:i + send.FRAME_LEN] for i in range(0, len(block), send.FRAME_LEN)]
+    assert send.decode_frames(block) == [send.parse_sensor_data(f) for f in frames]
+
+    def resync_and_decode():
+        buf = send.FrameBuffer(capacity_frames=args.frames + 1)
+        buf.feed(b"\x00" + block)  # one stray byte in front
+        return send.decode_frames(buf.pop_frames())
+
+    results = [
+        ("parse_sensor_data per frame", best_of(lambda: [send.parse_sensor_data(f) for f in frames])),
+        (f"decode_frames ({'numpy' if send.np is not None else 'struct'})", best_of(lambda: send.decode_frames(block))),
+        ("FrameBuffer + decode_frames", best_of(resync_and_decode)),
+    ]
+    print(f"{args.frames} frames")
+    for name, seconds in results:
+        print(f"{name:<32} {args.frames / seconds:>12,.0f} frames/s")
+
+
+if __name__ == "__main__":
+    main()
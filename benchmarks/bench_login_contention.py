@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+/data latency while logins are hammering bcrypt.
+
+Runs the API in-process on the in-memory store (MongoDB is pointed at an
+unreachable address) and keeps --logins concurrent POST /token loops busy,
+while a single client posts a reading to /data every 10 ms. The /data
+latency is measured from each request's scheduled send time, so it shows
+how long password hashing stalls the event loop.
+
+"inline" runs bcrypt on the event loop (BCRYPT_MAX_WORKERS=0, the old
+behaviour) and "pool" uses the bcrypt thread pool. By default both run,
+each in a fresh process.
+
+Usage: python benchmarks/bench_login_contention.py [--mode both|pool|inline] [--logins 16] [--duration 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+READING = {
+    "device_id": "bench-device", "site": "bench", "pm1": 5, "pm25": 12, "pm10": 20,
+    "co2": 450, "voc": 1, "temp": 21.5, "hum": 40, "ch2o": 0.01, "co": 0.3, "o3": 0.02, "no2": 0.01,
+}
+# Seconds between /data posts
+DATA_INTERVAL = 0.01
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run(logins: int, duration: float) -> dict:
+    os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:1")
+    sys.path.insert(0, BACKEND)
+    os.chdir(BACKEND)
+    import httpx
+    import main
+
+    await main.on_startup()
+    credentials = {"username": main.TEST_USER_EMAIL, "password": main.TEST_USER_PASSWORD}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        r = await client.post("/token", data=credentials)
+        headers = {"Authorization": f"Bearer {r.json()['access_token']}"}
+        await client.post("/data", json=READING, headers=headers)
+
+        stop = time.perf_counter() + duration
+        login_count = 0
+
+        async def login_loop():
+            nonlocal login_count
+            while time.perf_counter() < stop:
+                r = await client.post("/token", data=credentials)
+                assert r.status_code == 200, r.text
+                login_count += 1
+
+        async def data_loop():
+            # Fixed 10 ms schedule; latency counts from the scheduled send
+            # time, so time spent waiting for a blocked event loop is included.
+            latencies = []
+            scheduled = time.perf_counter()
+            while scheduled < stop:
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+                r = await client.post("/data", json=READING, headers=headers)
+                latencies.append((time.perf_counter() - scheduled) * 1e3)
+                assert r.status_code == 200, r.text
+                scheduled += DATA_INTERVAL
+            return latencies
+
+        results = await asyncio.gather(data_loop(), *(login_loop() for _ in range(logins)))
+    await main.on_shutdown()
+
+    latencies = results[0]
+    return {
+        "bcrypt_workers": main.BCRYPT_MAX_WORKERS,
+        "bcrypt_rounds": main.BCRYPT_ROUNDS,
+        "logins_per_s": login_count / duration,
+        "data_requests": len(latencies),
+        "data_p50_ms": statistics.median(latencies),
+        "data_p95_ms": percentile(latencies, 95),
+        "data_p99_ms": percentile(latencies, 99),
+        "data_max_ms": max(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("both", "pool", "inline"), default="both")
+    parser.add_argument("--logins", type=int, default=16, help="concurrent login loops")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per mode")
+    parser.add_argument("--json", action="store_true", help="print one JSON line (used for --mode both)")
+    args = parser.parse_args()
+
+    if args.mode != "both":
+        if args.mode == "inline":
+            os.environ["BCRYPT_MAX_WORKERS"] = "0"
+        stats = asyncio.run(run(args.logins, args.duration))
+        # Startup logs go to stdout too; the JSON result is always the last line
+        if args.json:
+            print(json.dumps(stats))
+        else:
+            for key, value in stats.items():
+                print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
+        sys.stdout.flush()
+        # Motor keeps retrying the unreachable server in a background thread
+        os._exit(0)
+
+    rows = []
+    for mode in ("inline", "pool"):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode, "--logins", str(args.logins),
+             "--duration", str(args.duration), "--json"],
+            capture_output=True, text=True, check=True,
+        )
+        rows.append((mode, json.loads(out.stdout.strip().splitlines()[-1])))
+
+    print(f"{'mode':>7} {'workers':>8} {'logins/s':>9} {'/data n':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode, st in rows:
+        print(
+            f"{mode:>7} {st['bcrypt_workers']:>8} {st['logins_per_s']:>9.1f} {st['data_requests']:>8} "
+            f"{st['data_p50_ms']:>8.2f} {st['data_p95_ms']:>8.2f} {st['data_p99_ms']:>8.2f} {st['data_max_ms']:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Lookup cost of the in-memory fallback store (backend/memory_store.py).
+
+Times find_one by email and by device_id on indexed collections of growing
+size, next to the same query on an unindexed collection (the old linear scan).
+Indexed lookups should stay flat as the collection grows to 100k documents.
+
+Usage: python benchmarks/bench_memory_collection.py [--sizes 1000,10000,100000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from memory_store import MemoryCollection  # noqa: E402
+
+
+def build(size: int, indexed: bool):
+    users = MemoryCollection(
+        "users",
+        [{"email": f"user{i}@example.com", "name": f"User {i}"} for i in range(size)],
+        indexes=[("email", {"unique": True})] if indexed else (),
+    )
+    sensors = MemoryCollection(
+        "sensors",
+        [{"device_id": f"dev{i:06d}", "name": f"Sensor {i}"} for i in range(size)],
+        indexes=[("device_id", {"unique": True, "sparse": True})] if indexed else (),
+    )
+    return users, sensors
+
+
+async def time_lookups(collection, field: str, values: list) -> float:
+    start = time.perf_counter()
+    for value in values:
+        doc = await collection.find_one({field: value})
+        assert doc is not None
+    return (time.perf_counter() - start) / len(values) * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'docs':>8} {'email idx µs':>13} {'device idx µs':>14} {'email scan µs':>14}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        rng = random.Random(size)
+        emails = [f"user{rng.randrange(size)}@example.com" for _ in range(args.lookups)]
+        devices = [f"dev{rng.randrange(size):06d}" for _ in range(args.lookups)]
+
+        users, sensors = build(size, indexed=True)
+        email_us = await time_lookups(users, "email", emails)
+        device_us = await time_lookups(sensors, "device_id", devices)
+
+        plain_users, _ = build(size, indexed=False)
+        # A scan is slow; a handful of lookups is enough to show the trend
+        scan_us = await time_lookups(plain_users, "email", emails[:20])
+
+        print(f"{size:>8} {email_us:>13.2f} {device_us:>14.2f} {scan_us:>14.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
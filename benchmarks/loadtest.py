@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Load test for the Breez API with a realistic traffic mix.
+
+Starts `uvicorn main:app` in a subprocess. By default it uses the in-memory
+store (MONGO_URL points at an unreachable address); pass --mongo-url for a
+local mongod. Registers --users accounts and runs these loads at the same
+time for --duration seconds:
+
+* --devices simulated send.py devices, each POSTing /data every
+  --device-interval seconds, spread over the users;
+* --pollers map clients, each alternating GET /sensors/map and
+  GET /sensors/all every --poll-interval seconds;
+* a burst of --login-burst concurrent POST /token every --burst-every
+  seconds.
+
+Every request runs on a fixed schedule. Latency is measured from the
+scheduled send time, so a stalled server shows up as latency rather than
+as fewer requests. The result is JSON: per endpoint, the request and
+error counts, throughput and p50/p95/p99/max in ms, plus the git commit
+and the settings. Save it with --out. --compare BASELINE.json prints the
+change against an earlier run and exits with 1 when any endpoint's p95
+or error rate got worse by more than --threshold.
+
+Usage: python benchmarks/loadtest.py [--duration 30] [--devices 50] [--pollers 10]
+       [--out run.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BACKEND = os.path.join(ROOT, "backend")
+UNREACHABLE_MONGO = "mongodb://127.0.0.1:1"
+PASSWORD = "loadtest-password"
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def reading(device_id: str, n: int) -> dict:
+    return {
+        "device_id": device_id, "site": f"site-{device_id}",
+        "pm1": 5 + n % 7, "pm25": 10 + n % 30, "pm10": 20 + n % 40, "co2": 420 + n % 200,
+        "voc": 1, "temp": 21.5, "hum": 40, "ch2o": 0.01, "co": 0.3, "o3": 0.02, "no2": 0.01,
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, endpoint: str, latency_ms: float, ok: bool):
+        self.latencies.setdefault(endpoint, []).append(latency_ms)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, duration: float) -> dict:
+        out = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            out[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "rps": round(len(values) / duration, 2),
+                "p50_ms": round(percentile(values, 50), 2),
+                "p95_ms": round(percentile(values, 95), 2),
+                "p99_ms": round(percentile(values, 99), 2),
+                "max_ms": round(max(values), 2),
+            }
+        return out
+
+
+async def timed(recorder: Recorder, endpoint: str, scheduled: float, request):
+    try:
+        r = await request
+        ok = r.status_code < 400
+    except httpx.HTTPError:
+        ok = False
+    recorder.add(endpoint, (time.perf_counter() - scheduled) * 1e3, ok)
+
+
+async def on_schedule(stop: float, interval: float, offset: float, make_request):
+    """Call make_request(scheduled_time, n) every `interval` seconds, starting `offset` in."""
+    scheduled = time.perf_counter() + offset
+    n = 0
+    while scheduled < stop:
+        await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+        await make_request(scheduled, n)
+        n += 1
+        scheduled += interval
+
+
+async def wait_until_ready(client: httpx.AsyncClient, server: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with code {server.returncode}")
+        try:
+            if (await client.get("/metrics")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.25)
+    raise RuntimeError("server did not start in time")
+
+
+async def run(args, base_url: str, server: subprocess.Popen) -> dict:
+    limits = httpx.Limits(max_connections=args.devices + args.pollers + args.login_burst + 10)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        await wait_until_ready(client, server)
+
+        emails = [f"loadtest-{i}@example.com" for i in range(args.users)]
+        tokens = []
+        for email in emails:
+            r = await client.post("/register", json={"email": email, "password": PASSWORD, "name": email})
+            if r.status_code not in (200, 400):  # 400: already registered (reused mongod)
+                raise RuntimeError(f"register failed: {r.status_code} {r.text}")
+            r = await client.post("/token", data={"username": email, "password": PASSWORD})
+            r.raise_for_status()
+            tokens.append({"Authorization": f"Bearer {r.json()['access_token']}"})
+
+        recorder = Recorder()
+        start = time.perf_counter()
+        stop = start + args.duration
+        tasks = []
+
+        for d in range(args.devices):
+            device_id = f"loadtest-device-{d}"
+            headers = tokens[d % len(tokens)]
+
+            async def post_data(scheduled, n, device_id=device_id, headers=headers):
+                await timed(recorder, "POST /data", scheduled,
+                            client.post("/data", json=reading(device_id, n), headers=headers))
+
+            offset = args.device_interval * d / max(1, args.devices)
+            tasks.append(on_schedule(stop, args.device_interval, offset, post_data))
+
+        for p in range(args.pollers):
+            headers = tokens[p % len(tokens)]
+
+            async def poll(scheduled, n, headers=headers):
+                path = "/sensors/map" if n % 2 == 0 else "/sensors/all"
+                await timed(recorder, f"GET {path}", scheduled, client.get(path, headers=headers))
+
+            offset = args.poll_interval * p / max(1, args.pollers)
+            tasks.append(on_schedule(stop, args.poll_interval, offset, poll))
+
+        if args.login_burst > 0:
+            async def login_burst(scheduled, n):
+                await asyncio.gather(*(
+                    timed(recorder, "POST /token", scheduled, client.post(
+                        "/token", data={"username": emails[i % len(emails)], "password": PASSWORD}))
+                    for i in range(args.login_burst)
+                ))
+
+            tasks.append(on_schedule(stop, args.burst_every, args.burst_every / 2, login_burst))
+
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return {
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "store": "mongodb" if args.mongo_url else "memory",
+        "config": {
+            "duration": args.duration, "users": args.users, "devices": args.devices,
+            "device_interval": args.device_interval, "pollers": args.pollers,
+            "poll_interval": args.poll_interval, "login_burst": args.login_burst,
+            "burst_every": args.burst_every,
+        },
+        "endpoints": recorder.summary(elapsed),
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    """Print the change per endpoint; return True if anything regressed past threshold."""
+    print(f"baseline {baseline.get('commit')} -> current {current.get('commit')}", file=sys.stderr)
+    print(f"{'endpoint':<20} {'p50 ms':>17} {'p95 ms':>17} {'p99 ms':>17} {'errors':>9}", file=sys.stderr)
+    regressed = False
+    for endpoint, new in current["endpoints"].items():
+        old = baseline.get("endpoints", {}).get(endpoint)
+        if old is None:
+            print(f"{endpoint:<20} (new)", file=sys.stderr)
+            continue
+        cells = [f"{old[k]:>7.1f}->{new[k]:<7.1f}" for k in ("p50_ms", "p95_ms", "p99_ms")]
+        old_rate = old["errors"] / max(1, old["requests"])
+        new_rate = new["errors"] / max(1, new["requests"])
+        flags = []
+        if new["p95_ms"] > old["p95_ms"] * (1 + threshold):
+            flags.append("p95")
+        if new_rate > old_rate + threshold * max(old_rate, 0.01):
+            flags.append("errors")
+        regressed = regressed or bool(flags)
+        mark = f"  REGRESSED ({', '.join(flags)})" if flags else ""
+        print(f"{endpoint:<20} {' '.join(cells)} {old['errors']:>4}->{new['errors']:<4}{mark}", file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--users", type=int, default=5, help="accounts the devices and pollers log in as")
+    parser.add_argument("--devices", type=int, default=50, help="simulated devices posting /data")
+    parser.add_argument("--device-interval", type=float, default=1.0, help="seconds between posts per device")
+    parser.add_argument("--pollers", type=int, default=10, help="clients polling /sensors/map and /sensors/all")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="seconds between polls per client")
+    parser.add_argument("--login-burst", type=int, default=20, help="concurrent logins per burst (0 disables)")
+    parser.add_argument("--burst-every", type=float, default=10.0, help="seconds between login bursts")
+    parser.add_argument("--mongo-url", help="use this MongoDB instead of the in-memory store")
+    parser.add_argument("--database", default="breez_loadtest", help="database name with --mongo-url")
+    parser.add_argument("--out", help="also write the JSON result to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON result of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p95/error-rate increase (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    port = free_port()
+    env = {
+        **os.environ,
+        "MONGO_URL": args.mongo_url or UNREACHABLE_MONGO,
+        "DATABASE_NAME": args.database,
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=BACKEND, env=env,
+    )
+    try:
+        result = asyncio.run(run(args, f"http://127.0.0.1:{port}", server))
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            # Motor keeps retrying an unreachable server and can delay shutdown
+            server.kill()
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, result, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,40 @@ import requests
 import json
 import os
 import sys
+import gzip
+import queue
+import random
+import struct
+import threading
+
+try:
+    import numpy as np  # необязательно: ускоряет пакетное декодирование кадров
+except ImportError:
+    np = None
 
 # --- НАСТРОЙКИ ---
 API_URL = "http://89.218.178.215:8005/data"
-BUFFER_FILE = "sensor_buffer.jsonl"
+BATCH_API_URL = API_URL + "/batch"  # пакетная загрузка буфера (POST /data/batch)
+BUFFER_FILE = "sensor_buffer.jsonl"  # старый формат буфера, переносится в журнал при старте
+JOURNAL_DIR = "sensor_journal"       # журнал неотправленных данных (сегменты + checkpoint)
+SEGMENT_MAX_BYTES = 256 * 1024       # размер одного сегмента журнала
+REPLAY_BATCH_SIZE = 500              # записей в одном запросе при выгрузке журнала
 SERIAL_PORT = '/dev/ttyUSB0'  # Проверьте ваш порт
 BAUD_RATE = 9600
 
+# --- ОПРОС И ОТПРАВКА ---
+SAMPLE_INTERVAL = 5.0        # период опроса датчика, с (не зависит от сети)
+UPLOAD_QUEUE_SIZE = 1000     # показаний между потоком опроса и отправки
+UPLOAD_BATCH_SIZE = 50       # максимум показаний в одном запросе
+BACKOFF_MIN = 1.0            # пауза после первой неудачной отправки, с
+BACKOFF_MAX = 300.0          # предел экспоненциальной паузы, с
+
+# --- ФОРМАТ ОТПРАВКИ ---
+# "binary" - компактный формат (44 байта на показание, см. backend/wire_format.py),
+# "json" - как раньше. Если сервер не понимает binary, скрипт сам перейдёт на json.
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "binary")
+GZIP_MIN_BYTES = 1024        # тело больше этого размера сжимается gzip
+
 # --- АУТЕНТИФИКАЦИЯ УСТРОЙСТВА ---
 # Получите этот токен через POST /device/token (admin-only) на backend.
 # Пример: curl -X POST http://<backend>/device/token \
@@ -39,159 +66,562 @@ CAL = {
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
 def calculate_checksum(data):
-    return (~sum(data[1:25]) + 1) & 0xFF
+    # -(сумма байтов 1..24) по модулю 256; считается по всему кадру без копии среза
+    return (data[0] + data[25] - sum(data)) & 0xFF
+
+class SegmentJournal:
+    """
+    Журнал неотправленных показаний: append-only сегменты фиксированного
+    размера (seg-00000001.jsonl, ...) и checkpoint с позицией последней
+    подтверждённой сервером записи.
+
+    Чтение идёт потоково от checkpoint, память не зависит от размера
+    журнала. Полностью подтверждённые сегменты удаляются целиком, файлы
+    никогда не переписываются. Доставка "как минимум один раз": если
+    питание пропадёт между ответом сервера и записью checkpoint, последняя
+    пачка уйдёт повторно.
+    """
+
+    def __init__(self, directory, segment_max_bytes=SEGMENT_MAX_BYTES):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.checkpoint_path = os.path.join(directory, "checkpoint.json")
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            int(name[4:-6]) for name in os.listdir(directory)
+            if name.startswith("seg-") and name.endswith(".jsonl")
+        )
+        self.position = self._load_checkpoint()
+        self._repair_tail()
+
+    def _repair_tail(self):
+        # После обрыва питания последняя строка может быть недописана;
+        # перевод строки не даёт следующей записи к ней приклеиться
+        if not self.segments:
+            return
+        path = self._segment_path(self.segments[-1])
+        with open(path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"seg-{seq:08d}.jsonl")
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                cp = json.load(f)
+            return int(cp["segment"]), int(cp["offset"])
+        except (OSError, ValueError, KeyError):
+            return (self.segments[0] if self.segments else 1), 0
+
+    def _save_checkpoint(self):
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": self.position[0], "offset": self.position[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_path)
+
+    def append(self, record):
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self.lock:
+            if not self.segments:
+                self.segments.append(max(self.position[0], 1))
+            path = self._segment_path(self.segments[-1])
+            if os.path.exists(path) and os.path.getsize(path) + len(line) > self.segment_max_bytes:
+                self.segments.append(self.segments[-1] + 1)
+                path = self._segment_path(self.segments[-1])
+            with open(path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
 
-def save_to_buffer(data):
-    """Сохраняет данные в файл при отсутствии интернета."""
+    def has_pending(self):
+        with self.lock:
+            if not self.segments:
+                return False
+            if len(self.segments) > 1:
+                return True
+            try:
+                return os.path.getsize(self._segment_path(self.segments[0])) > self.position[1]
+            except OSError:
+                return False
+
+    def read_batch(self, max_records):
+        """
+        До max_records записей начиная с checkpoint.
+        Возвращает (records, position); position передаётся в commit() после
+        того, как сервер принял пачку.
+        """
+        records = []
+        with self.lock:
+            segments = list(self.segments)
+        seq, offset = self.position
+        for seg in segments:
+            if seg < seq:
+                continue
+            if seg > seq:
+                seq, offset = seg, 0
+            is_last = seg == segments[-1]
+            with open(self._segment_path(seg), "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Недописанная строка: в активном сегменте ещё пишется,
+                        # в старом - обрыв записи при отключении питания
+                        if not is_last:
+                            offset += len(line)
+                        break
+                    offset += len(line)
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        print("⚠ Повреждённая строка в журнале пропущена")
+                        continue
+                    if len(records) >= max_records:
+                        return records, (seq, offset)
+        return records, (seq, offset)
+
+    def commit(self, position):
+        """Сохраняет checkpoint и удаляет полностью отправленные сегменты."""
+        with self.lock:
+            seq, offset = position
+            done = [s for s in self.segments if s < seq]
+            # Активный сегмент отправлен до конца - его тоже можно удалить
+            last_path = self._segment_path(seq)
+            if self.segments and seq == self.segments[-1] and os.path.exists(last_path) \
+                    and os.path.getsize(last_path) == offset:
+                done.append(seq)
+                seq, offset = seq + 1, 0
+            self.position = (seq, offset)
+            self._save_checkpoint()
+            for s in done:
+                try:
+                    os.remove(self._segment_path(s))
+                except FileNotFoundError:
+                    pass
+            self.segments = [s for s in self.segments if s not in done]
+
+    def import_legacy_file(self, path):
+        """Переносит старый sensor_buffer.jsonl в журнал (построчно) и удаляет его."""
+        if not os.path.exists(path):
+            return
+        count = 0
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    self.append(json.loads(line))
+                    count += 1
+                except ValueError:
+                    continue
+        os.remove(path)
+        print(f"📦 Старый буфер перенесён в журнал: {count} записей")
+
+
+# Одно keep-alive соединение на все запросы к серверу
+session = requests.Session()
+session.headers['Content-Type'] = 'application/json'
+if DEVICE_TOKEN:
+    session.headers['Authorization'] = f'Bearer {DEVICE_TOKEN}'
+
+# None - ещё не проверяли, есть ли на сервере /data/batch
+batch_endpoint_available = None
+
+
+def save_to_buffer(journal, data):
+    """Сохраняет данные в журнал при отсутствии интернета."""
     try:
-        with open(BUFFER_FILE, 'a') as f:
-            f.write(json.dumps(data) + '\n')
+        journal.append(data)
         print(f"💾 Данные сохранены в буфер.")
     except Exception as e:
         print(f"💥 Ошибка записи в буфер: {e}")
 
-def send_buffered_data():
-    """Отправляет накопленные данные."""
-    if not os.path.exists(BUFFER_FILE):
-        return
 
-    print("📡 Отправка данных из буфера...")
-    try:
-        with open(BUFFER_FILE, 'r') as f:
-            lines = f.readlines()
+# Компактный формат: заголовок (magic, версия, device_id, site, количество),
+# затем 11 float32 на показание. Должен совпадать с backend/wire_format.py.
+WIRE_CONTENT_TYPE = "application/vnd.breez.readings"
+WIRE_VERSION = 1
+WIRE_FIELDS = ("pm1", "pm25", "pm10", "co2", "voc", "temp", "hum", "ch2o", "co", "o3", "no2")
+WIRE_READING = struct.Struct(">" + "f" * len(WIRE_FIELDS))
 
-        remaining_lines = []
-        sent_count = 0
 
-        for line in lines:
-            if not line.strip(): continue
-            try:
-                record = json.loads(line)
-                buf_headers = {'Content-Type': 'application/json'}
-                if DEVICE_TOKEN:
-                    buf_headers['Authorization'] = f'Bearer {DEVICE_TOKEN}'
-                response = requests.post(API_URL, json=record, headers=buf_headers, timeout=5)
-                if response.status_code == 200:
-                    sent_count += 1
-                else:
-                    remaining_lines.append(line)
-            except:
-                remaining_lines.append(line)
+def encode_readings(records):
+    """Пачка показаний одного устройства в компактном формате (или None, если устройств несколько)."""
+    device_id, site = records[0]["device_id"], records[0]["site"]
+    if any(r["device_id"] != device_id or r["site"] != site for r in records):
+        return None
+    device_raw, site_raw = device_id.encode("utf-8"), site.encode("utf-8")
+    parts = [
+        struct.pack(">3sB", b"BRZ", WIRE_VERSION),
+        bytes([len(device_raw)]), device_raw,
+        bytes([len(site_raw)]), site_raw,
+        struct.pack(">I", len(records)),
+    ]
+    parts.extend(WIRE_READING.pack(*(float(r[name]) for name in WIRE_FIELDS)) for r in records)
+    return b"".join(parts)
 
-        if not remaining_lines:
-            os.remove(BUFFER_FILE)
-            print(f"✅ Буфер очищен! Отправлено: {sent_count}")
-        else:
-            with open(BUFFER_FILE, 'w') as f:
-                f.writelines(remaining_lines)
-            print(f"⚠ Осталось в буфере: {len(remaining_lines)}")
 
+def batch_request_body(records):
+    """Тело и заголовки запроса на /data/batch с учётом WIRE_FORMAT и gzip."""
+    body = encode_readings(records) if WIRE_FORMAT == "binary" else None
+    if body is not None:
+        headers = {"Content-Type": WIRE_CONTENT_TYPE}
+    else:
+        body = json.dumps(records, separators=(",", ":")).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+    if len(body) > GZIP_MIN_BYTES:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+def upload_batch(records):
+    """
+    Отправляет пачку через /data/batch.
+    True - сервер принял пачку, False - нет связи/ошибка,
+    None - на сервере нет пакетного endpoint.
+    """
+    global WIRE_FORMAT
+    body, headers = batch_request_body(records)
+    response = session.post(BATCH_API_URL, data=body, headers=headers, timeout=30)
+    if response.status_code in (404, 405):
+        return None
+    if response.status_code in (400, 415) and headers["Content-Type"] == WIRE_CONTENT_TYPE:
+        # Старый сервер без компактного формата - дальше отправляем JSON
+        print("ℹ️ Сервер не поддерживает компактный формат, переход на JSON")
+        WIRE_FORMAT = "json"
+        return upload_batch(records)
+    if response.status_code != 200:
+        return False
+    rejected = response.json().get("rejected", 0)
+    if rejected:
+        # Некорректные записи сервер не примет никогда - не держим их в журнале
+        print(f"⚠ Сервер отклонил {rejected} записей из буфера")
+    return True
+
+
+def upload_one_by_one(records):
+    """Старый путь: по одной записи на /data. Возвращает число отправленных подряд."""
+    sent = 0
+    for record in records:
+        try:
+            response = session.post(API_URL, json=record, timeout=5)
+        except requests.RequestException:
+            break
+        if response.status_code != 200:
+            break
+        sent += 1
+    return sent
+
+
+def upload_records(records):
+    """
+    Отправляет показания: пачкой через /data/batch, если он есть, иначе по
+    одной на /data. Возвращает, сколько записей с начала списка доставлено.
+    """
+    global batch_endpoint_available
+    # В компактном формате даже одно показание выгоднее слать через /data/batch
+    if (len(records) > 1 or WIRE_FORMAT == "binary") and batch_endpoint_available is not False:
+        ok = upload_batch(records)
+        if ok is not None:
+            batch_endpoint_available = True
+            return len(records) if ok else 0
+        batch_endpoint_available = False
+        print("ℹ️ /data/batch недоступен, отправка по одной записи")
+    return upload_one_by_one(records)
+
+
+def send_buffered_data(journal):
+    """
+    Отправляет накопленные данные пачками от checkpoint.
+    Возвращает True, если журнал выгружен полностью.
+    """
+    if not journal.has_pending():
+        return True
+
+    print("📡 Отправка данных из буфера...")
+    sent_count = 0
+    try:
+        while True:
+            records, position = journal.read_batch(REPLAY_BATCH_SIZE)
+            if not records:
+                journal.commit(position)
+                break
+            sent = upload_records(records)
+            sent_count += sent
+            if sent < len(records):
+                # Подтверждаем только отправленное начало пачки
+                if sent:
+                    journal.commit(journal.read_batch(sent)[1])
+                print(f"⚠ Сервер не принял пачку, повтор позже. Отправлено: {sent_count}")
+                return False
+            journal.commit(position)
+        print(f"✅ Буфер очищен! Отправлено: {sent_count}")
+        return True
+    except requests.RequestException:
+        print(f"⚠ Связь пропала. Отправлено: {sent_count}, остальное в буфере")
     except Exception as e:
         print(f"Ошибка буфера: {e}")
+    return False
+
 
-def send_data_to_server(data):
-    """Отправка JSON на сервер."""
-    headers = {'Content-Type': 'application/json'}
-    if DEVICE_TOKEN:
-        headers['Authorization'] = f'Bearer {DEVICE_TOKEN}'
+def drain_queue(q, max_items, timeout):
+    """Ждёт первое показание до timeout секунд и добирает остальные без ожидания."""
     try:
-        response = requests.post(API_URL, json=data, headers=headers, timeout=5)
-        if response.status_code == 200:
-            print("✅ Успешно отправлено на сервер.")
-            send_buffered_data()
+        items = [q.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(items) < max_items:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+
+def upload_worker(q, stop, journal):
+    """
+    Поток отправки: забирает показания из очереди пачками. Пока в журнале
+    есть неотправленное, новые показания дописываются в его конец, чтобы
+    сервер получал их по порядку. При ошибке - экспоненциальная пауза
+    с джиттером; опрос датчика в это время продолжается.
+    """
+    backoff = BACKOFF_MIN
+    while not stop.is_set():
+        batch = drain_queue(q, UPLOAD_BATCH_SIZE, timeout=1.0)
+        pending = journal.has_pending()
+        if not batch and not pending:
+            continue
+        if pending:
+            for record in batch:
+                save_to_buffer(journal, record)
+            delivered = send_buffered_data(journal)
         else:
-            print(f"❌ Ошибка сервера {response.status_code}. В буфер.")
-            save_to_buffer(data)
-    except requests.RequestException:
-        print("❌ Нет связи. В буфер.")
-        save_to_buffer(data)
+            try:
+                sent = upload_records(batch)
+            except requests.RequestException:
+                sent = 0
+            delivered = sent == len(batch)
+            if delivered:
+                print(f"✅ Успешно отправлено на сервер: {sent}")
+            else:
+                print("❌ Нет связи или ошибка сервера. В буфер.")
+                for record in batch[sent:]:
+                    save_to_buffer(journal, record)
+        if delivered:
+            backoff = BACKOFF_MIN
+        else:
+            stop.wait(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, BACKOFF_MAX)
+    # Остаток очереди при остановке - в журнал, отправится при следующем старте
+    for record in drain_queue(q, q.maxsize or UPLOAD_QUEUE_SIZE, timeout=0):
+        save_to_buffer(journal, record)
+
+
+def acquisition_worker(ser, q, stop, journal):
+    """
+    Поток опроса: читает датчик строго каждые SAMPLE_INTERVAL секунд по
+    монотонным часам. Сеть сюда не попадает: показание кладётся в очередь
+    без ожидания, а если очередь полна - сразу в журнал.
+    """
+    frames = FrameBuffer()
+    next_tick = time.monotonic()
+    try:
+        while not stop.is_set():
+            ser.write(CMD_READ)
+            frames.feed(ser.read(FRAME_LEN))
+
+            for sensor_data in decode_frames(frames.pop_frames()):
+                print(json.dumps(sensor_data, indent=4))
+                try:
+                    q.put_nowait(sensor_data)
+                except queue.Full:
+                    save_to_buffer(journal, sensor_data)
+
+            next_tick += SAMPLE_INTERVAL
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                # Чтение порта заняло больше периода - начинаем отсчёт заново
+                next_tick = time.monotonic()
+                delay = 0
+            stop.wait(delay)
+    except serial.SerialException as e:
+        print(f"❌ Ошибка порта: {e}")
+    finally:
+        stop.set()
+
+# --- ДЕКОДИРОВАНИЕ КАДРОВ ---
+# Кадр 26 байт, big-endian: FF, cmd, pm1, pm25, pm10, co2 (u16), tvoc (u8),
+# temp, hum, ch2o, co, o3, no2 (u16), 2 резервных байта, checksum
+FRAME = struct.Struct(">2x4HB6H2xB")
+FRAME_START = 0xFF
+
+# Поля в порядке кадра: (имя, смещение сырого значения, множитель, знаков после запятой).
+# Физическое значение = (raw + смещение) * множитель, затем калибровка CAL.
+# None - целое (дробная часть отбрасывается, как раньше int()).
+FIELDS = (
+    ("pm1", 0, 1, None),
+    ("pm25", 0, 1, None),
+    ("pm10", 0, 1, None),
+    ("co2", 0, 1, None),
+    ("voc", 0, 1, 2),
+    ("temp", -435, 0.1, 1),
+    ("hum", -10, 1.0, 1),
+    ("ch2o", 0, 0.001, 2),
+    ("co", 0, 0.1, 1),
+    ("o3", 0, 0.01, 1),
+    ("no2", 0, 0.01, 1),
+)
+
+
+def build_decode_table():
+    """Таблица (имя, смещение, множитель, cal_множитель, cal_смещение, знаки) из FIELDS и CAL."""
+    return [
+        (name, raw_offset, raw_scale, *CAL.get(name, (1.0, 0.0)), digits)
+        for name, raw_offset, raw_scale, digits in FIELDS
+    ]
+
+
+DECODE_TABLE = build_decode_table()
+
+if np is not None:
+    FRAME_DTYPE = np.dtype(
+        [("start", "u1"), ("cmd", "u1")]
+        + [(name, "u1" if name == "voc" else ">u2") for name, *_ in FIELDS]
+        + [("reserved", "u1", (2,)), ("checksum", "u1")]
+    )
+    _RAW_OFFSET = np.array([row[1] for row in DECODE_TABLE], dtype=np.float64)
+    _RAW_SCALE = np.array([row[2] for row in DECODE_TABLE], dtype=np.float64)
+    _CAL_SCALE = np.array([row[3] for row in DECODE_TABLE], dtype=np.float64)
+    _CAL_OFFSET = np.array([row[4] for row in DECODE_TABLE], dtype=np.float64)
+
+
+def calibrate(raw):
+    """Сырые поля кадра (как из FRAME.unpack) -> откалиброванные значения."""
+    return [
+        ((r + raw_offset) * raw_scale) * cal_scale + cal_offset
+        for r, (_, raw_offset, raw_scale, cal_scale, cal_offset, _) in zip(raw, DECODE_TABLE)
+    ]
+
+
+def make_record(values):
+    """Словарь для сервера из откалиброванных значений в порядке FIELDS."""
+    data = {"device_id": DEVICE_ID, "site": SITE_NAME}
+    for (name, _, _, _, _, digits), value in zip(DECODE_TABLE, values):
+        data[name] = int(value) if digits is None else round(float(value), digits)
+    return data
+
 
 def parse_sensor_data(buf):
-    """Парсинг и формирование JSON."""
+    """Парсинг одного кадра и формирование JSON."""
     if len(buf) != FRAME_LEN: return None
     if calculate_checksum(buf) != buf[25]:
         print("⚠ Checksum mismatch")
         return None
 
-    # Расчет значений
-    pm1  = buf[2] << 8 | buf[3]
-    pm25 = buf[4] << 8 | buf[5]
-    pm10 = buf[6] << 8 | buf[7]
-    co2  = buf[8] << 8 | buf[9]
-    tvoc = buf[10]
-
-    temp_raw = (buf[11] << 8) | buf[12]
-    temp = (temp_raw - 435) * 0.1
-
-    hum_raw = (buf[13] << 8) | buf[14]
-    hum = (hum_raw - 10) * 1.0 
-
-    ch2o = ((buf[15] << 8) | buf[16]) * 0.001
-    co   = ((buf[17] << 8) | buf[18]) * 0.1
-    o3   = ((buf[19] << 8) | buf[20]) * 0.01
-    no2  = ((buf[21] << 8) | buf[22]) * 0.01
-
-    # Применение калибровки к сырым значениям
-    # (кроме device_id и site, их тут пока нет)
-    raw_vals = {"pm1": pm1, "pm25": pm25, "pm10": pm10, "co2": co2, "hum": hum}
-    
-    for k, v in raw_vals.items():
-        if k in CAL:
-            s, o = CAL[k]
-            if k == "hum": hum = v * s + o
-            elif k == "co2": co2 = int(v * s + o)
-            elif k == "pm1": pm1 = int(v * s + o)
-            elif k == "pm25": pm25 = int(v * s + o)
-            elif k == "pm10": pm10 = int(v * s + o)
-
-    # --- ФОРМИРОВАНИЕ ИТОГОВОГО JSON ---
-    data = {
-        "device_id": DEVICE_ID,    # <-- Добавлено
-        "site": SITE_NAME,         # <-- Добавлено
-        "pm1": pm1,
-        "pm25": pm25,
-        "pm10": pm10,
-        "co2": co2,
-        "voc": round(float(tvoc), 2),     # Приводим к формату вашего примера
-        "temp": round(temp, 1),
-        "hum": round(hum, 1),
-        "ch2o": round(ch2o, 2),
-        "co": round(co, 1),
-        "o3": round(o3, 1),
-        "no2": round(no2, 1)
-    }
+    return make_record(calibrate(FRAME.unpack_from(buf)))
+
+
+def decode_frames(block):
+    """
+    Декодирует подряд идущие кадры (bytes/bytearray длиной кратной FRAME_LEN)
+    за один проход. С NumPy - векторно по всем кадрам сразу, без NumPy -
+    через FRAME.iter_unpack по memoryview без копирования. Кадры с неверной
+    контрольной суммой пропускаются.
+    """
+    if not block:
+        return []
+    if np is not None:
+        frames = np.frombuffer(block, dtype=FRAME_DTYPE)
+        raw_bytes = np.frombuffer(block, dtype=np.uint8).reshape(-1, FRAME_LEN)
+        valid = (raw_bytes[:, 1:].sum(axis=1, dtype=np.uint32) & 0xFF) == 0
+        raw = np.stack([frames[name] for name, *_ in FIELDS], axis=1).astype(np.float64)[valid]
+        values = ((raw + _RAW_OFFSET) * _RAW_SCALE) * _CAL_SCALE + _CAL_OFFSET
+        return [make_record(row) for row in values.tolist()]
+
+    records = []
+    view = memoryview(block)
+    for i, raw in enumerate(FRAME.iter_unpack(view)):
+        offset = i * FRAME_LEN
+        # Сумма байтов 1..25 (вместе с checksum) кратна 256; срез memoryview не копирует
+        if sum(view[offset + 1:offset + FRAME_LEN]) & 0xFF:
+            continue
+        records.append(make_record(calibrate(raw)))
+    return records
+
+
+class FrameBuffer:
+    """
+    Ограниченный bytearray-буфер байтов с порта. Выравнивает поток по началу
+    кадра (0xFF + верная контрольная сумма), так что лишний или потерянный
+    байт не сбивает все последующие кадры. pop_frames() отдаёт все целые
+    кадры одним непрерывным блоком для decode_frames().
+    """
+
+    def __init__(self, capacity_frames=256):
+        self.capacity = capacity_frames * FRAME_LEN
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+        if len(self.buf) > self.capacity:
+            # Переполнение - отбрасываем самые старые байты
+            del self.buf[:len(self.buf) - self.capacity]
+
+    def pop_frames(self):
+        out = bytearray()
+        i = 0
+        with memoryview(self.buf) as view:
+            while len(view) - i >= FRAME_LEN:
+                if view[i] == FRAME_START and sum(view[i + 1:i + FRAME_LEN]) & 0xFF == 0:
+                    out += view[i:i + FRAME_LEN]
+                    i += FRAME_LEN
+                else:
+                    i += 1
+        del self.buf[:i]
+        return bytes(out)
 
-    return data
 
 # --- ОСНОВНОЙ ЦИКЛ ---
 def main():
     print(f"🚀 Старт. ID: {DEVICE_ID}, Site: {SITE_NAME}")
+    journal = SegmentJournal(JOURNAL_DIR)
+    journal.import_legacy_file(BUFFER_FILE)
     ser = None
+    stop = threading.Event()
+    upload_queue = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    threads = []
     try:
         ser = serial.Serial(SERIAL_PORT, baudrate=BAUD_RATE, timeout=1)
         print("✅ Порт открыт.")
 
-        while True:
-            ser.write(CMD_READ)
-            frame = ser.read(FRAME_LEN)
-
-            if len(frame) < FRAME_LEN:
-                time.sleep(2)
-                continue
-
-            sensor_data = parse_sensor_data(frame)
-
-            if sensor_data:
-                print(json.dumps(sensor_data, indent=4))
-                send_data_to_server(sensor_data)
-
-            time.sleep(5) 
+        threads = [
+            threading.Thread(target=acquisition_worker, args=(ser, upload_queue, stop, journal), name="acquisition"),
+            threading.Thread(target=upload_worker, args=(upload_queue, stop, journal), name="uploader"),
+        ]
+        for t in threads:
+            t.start()
+        while not stop.wait(1):
+            pass
 
     except serial.SerialException as e:
         print(f"❌ Ошибка порта: {e}")
     except KeyboardInterrupt:
         print("\n🛑 Стоп.")
     finally:
+        stop.set()
+        for t in threads:
+            t.join()
         if ser and ser.is_open: ser.close()
 
 if __name__ == "__main__":